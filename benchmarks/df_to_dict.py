@@ -0,0 +1,129 @@
+"""
+Compares functions.df_to_dict with the implementation it replaced, which
+converted object columns through .loc and localized every datetime column
+with ambiguous="infer", mutating the frame it was given.
+
+Checks that both produce the same output for a batch_pull sized frame with
+many text columns and prints how long each takes, along with df_to_dict
+using polars for the datetime columns.
+
+    python benchmarks/df_to_dict.py [rows] [text columns] [datetime columns]
+"""
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions import df_to_dict  # noqa: E402
+
+
+def legacy_df_to_dict(df: pd.DataFrame, table_object: dict | None = None) -> dict:
+    for col in df.select_dtypes(include=["object"]).columns:
+        col = str(col)
+        df.loc[df[col].notnull(), col] = df.loc[df[col].notnull(), col].astype(str)
+
+    if table_object is not None:
+        for col, dtype in zip(df.columns, df.dtypes):
+            if str(dtype) == "datetime64[ns]":
+                if (
+                    table_object["column_timezones"] is not None
+                    and col in table_object["column_timezones"]
+                ):
+                    df[col] = df[col].dt.tz_localize(
+                        table_object["column_timezones"][col],
+                        ambiguous="infer",
+                        nonexistent="shift_backward",
+                    )
+                else:
+                    df[col] = df[col].dt.tz_localize(
+                        "UTC", ambiguous="infer", nonexistent="shift_backward"
+                    )
+
+    return {
+        "values": df.to_json(
+            orient="values",
+            date_format="iso",
+            default_handler=str,
+            date_unit="s",
+        ),
+        "columns": df.columns.tolist(),
+        "dtypes": list(df.dtypes.astype(str)),
+    }
+
+
+def make_frame(rows: int, text_columns: int, datetime_columns: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    data = {
+        "id": np.arange(rows),
+        "amount": rng.random(rows) * 1000,
+        "created": pd.Timestamp("2024-03-01")
+        + pd.to_timedelta(rng.integers(0, 90 * 24 * 60, rows), unit="min"),
+        "local_time": pd.Timestamp("2024-03-01")
+        + pd.to_timedelta(np.sort(rng.integers(0, 90 * 24 * 60, rows)), unit="min"),
+        # local mean time before 1901 and zone history that polars' timezone
+        # rules don't agree with pandas on
+        "historical": pd.Timestamp("1850-05-05 10:10:10")
+        + pd.to_timedelta(np.sort(rng.integers(0, 150 * 365, rows)), unit="D"),
+        # mixed values, like decimals and numbers in a text column
+        "mixed": [
+            Decimal(i) / 7 if i % 3 == 0 else (i if i % 3 == 1 else None)
+            for i in range(rows)
+        ],
+    }
+    words = np.array(["alpha", 'say "hi"', "naïve", "", "x" * 40])
+    for column in range(text_columns):
+        values = words[rng.integers(0, len(words), rows)].astype(object)
+        values[rng.random(rows) < 0.1] = None
+        data[f"text_{column}"] = values
+    for column in range(datetime_columns):
+        data[f"datetime_{column}"] = data["created"] + pd.Timedelta(hours=column)
+    return pd.DataFrame(data)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    text_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    datetime_columns = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    df = make_frame(rows, text_columns, datetime_columns)
+    table_object = {
+        "column_timezones": {
+            "local_time": "America/Chicago",
+            "historical": "Asia/Kolkata",
+        }
+    }
+
+    original = df.copy()
+    new = df_to_dict(df, table_object)
+    assert df.equals(original), "df_to_dict changed the frame it was given"
+    legacy = legacy_df_to_dict(df.copy(), table_object)
+    assert new == legacy, "df_to_dict output differs from the legacy encoder"
+    polars = df_to_dict(df, table_object, engine="polars")
+    assert polars == new, "the polars engine's output differs from pandas"
+
+    runs = 10
+    legacy_time = (
+        timeit.timeit(lambda: legacy_df_to_dict(df.copy(), table_object), number=runs)
+        / runs
+    )
+    copy_time = timeit.timeit(df.copy, number=runs) / runs
+    new_time = timeit.timeit(lambda: df_to_dict(df, table_object), number=runs) / runs
+    polars_time = (
+        timeit.timeit(
+            lambda: df_to_dict(df, table_object, engine="polars"), number=runs
+        )
+        / runs
+    )
+    print(f"{rows} rows, {len(df.columns)} columns, identical output")
+    print(f"legacy df_to_dict: {(legacy_time - copy_time) * 1000:8.1f} ms")
+    print(f"df_to_dict:        {new_time * 1000:8.1f} ms")
+    print(f"speedup:           {(legacy_time - copy_time) / new_time:8.1f}x")
+    print(f"df_to_dict polars: {polars_time * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measures how long encoding a big data_update message stalls the websocket
+event loop, the way sync_agent_class.send encoded messages before and after
+json_codec.
+
+A task on the loop sleeps 5 ms at a time and records how late it wakes up
+while the message is encoded a few times, on the loop with the json module,
+on the loop with json_codec, in an executor with json_codec.dumps and in an
+executor with json_codec.dumps_sliced, which is what send does now.
+
+    python benchmarks/event_loop_lag.py [rows] [text columns]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_codec  # noqa: E402
+import ws_messages  # noqa: E402
+from df_to_dict import make_frame  # noqa: E402
+from functions import df_to_dict  # noqa: E402
+
+TICK = 0.005
+RUNS = 3
+
+
+async def ticker(lags: list[float]):
+    while True:
+        then = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - then - TICK)
+
+
+async def measure(name: str, encode, message: dict):
+    lags: list[float] = []
+    task = asyncio.create_task(ticker(lags))
+    await asyncio.sleep(0.05)
+    then = time.perf_counter()
+    for _ in range(RUNS):
+        await encode(message)
+    elapsed = (time.perf_counter() - then) / RUNS
+    await asyncio.sleep(0.05)
+    task.cancel()
+    print(
+        f"{name:28} {elapsed * 1000:8.1f} ms per message, "
+        f"worst loop lag {max(lags) * 1000:6.1f} ms"
+    )
+
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    text_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    df = make_frame(rows, text_columns)
+    table_object = {"column_timezones": {"local_time": "America/Chicago"}}
+    message = {
+        "token": "token",
+        "message_type": "data_update",
+        "message_body": {
+            "table_uuid": "table",
+            "new_rows": df_to_dict(df, table_object),
+            "updated_rows": df_to_dict(df.head(0), table_object),
+        },
+    }
+    assert ws_messages.build_frames(message, True) == ws_messages.build_frames(
+        message
+    ), "dumps_sliced output differs from dumps"
+    size = len(ws_messages.build_frames(message)[0])
+    print(f"{rows} rows, {len(df.columns)} columns, {size / 1024 / 1024:.1f} MB")
+
+    loop = asyncio.get_running_loop()
+
+    async def on_loop_json(message):
+        json.dumps(message)
+
+    async def on_loop(message):
+        ws_messages.build_frames(message)
+
+    async def executor(message):
+        await loop.run_in_executor(None, ws_messages.build_frames, message)
+
+    async def executor_sliced(message):
+        await loop.run_in_executor(None, ws_messages.build_frames, message, True)
+
+    await measure("on the loop, json", on_loop_json, message)
+    for backend in json_codec.BACKENDS:
+        json_codec.use_backend(backend)
+        await measure(f"on the loop, {backend}", on_loop, message)
+        await measure(f"executor, {backend}", executor, message)
+        await measure(f"sliced executor, {backend}", executor_sliced, message)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,227 @@
+"""
+Deleted row detection for big tables using primary key range checksums.
+
+The numeric primary keys of a table are grouped into a tree of buckets. The
+top level has at most TOP_LEVEL_BUCKETS buckets, every bucket is split into
+FANOUT buckets on the level below it, and the leaf buckets hold around
+LEAF_ROWS rows. Each bucket's row count and sum of key hashes is computed in
+the source database and compared with the values stored by the last check.
+Only the buckets that changed are drilled into, and only the keys of the leaf
+buckets that changed are sent to the server, so a check where nothing was
+deleted sends nothing and reads a few hundred aggregate rows.
+"""
+from typing import Any, Callable
+
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+import sqliteDB_setup
+from functions import log
+from integration_mapping import integration_map
+
+FANOUT = 16
+TOP_LEVEL_BUCKETS = 256
+LEAF_ROWS = 50000
+# Number of leaf ranges whose keys are sent in one payload
+RANGES_PER_PAYLOAD = 100
+
+# (bucket_width, bucket) -> (row_count, checksum)
+Checksums = dict[tuple[int, int], tuple[int, int]]
+
+
+def supports_checksums(conn_type: str) -> bool:
+    integration = integration_map[conn_type]
+    return hasattr(integration, "get_key_checksums") and hasattr(
+        integration, "get_primary_keys_in_ranges"
+    )
+
+
+def plan_bucket_widths(min_value, max_value, row_count: int) -> tuple[int, int]:
+    """Returns the top and leaf bucket widths, both powers of FANOUT"""
+    key_span = max(float(max_value) - float(min_value) + 1, 1)
+    rows_per_key = row_count / key_span
+    leaf_width = 1
+    while rows_per_key * leaf_width * FANOUT <= LEAF_ROWS:
+        leaf_width *= FANOUT
+    top_width = leaf_width
+    while key_span / top_width > TOP_LEVEL_BUCKETS:
+        top_width *= FANOUT
+    return top_width, leaf_width
+
+
+def read_checksums(df: pd.DataFrame) -> dict[int, tuple[int, int]]:
+    """Turns a get_key_checksums result into {bucket: (row_count, checksum)}"""
+    return {
+        int(bucket): (int(row_count), int(checksum))
+        for bucket, row_count, checksum in zip(
+            df["bucket"], df["row_count"], df["checksum"]
+        )
+    }
+
+
+def merge_ranges(buckets: list[int], bucket_width: int) -> list[list[int]]:
+    """Turns sorted buckets into [lower, upper) key ranges, joining neighbours"""
+    ranges: list[list[int]] = []
+    for bucket in buckets:
+        lower = bucket * bucket_width
+        if ranges and ranges[-1][1] == lower:
+            ranges[-1][1] = lower + bucket_width
+        else:
+            ranges.append([lower, lower + bucket_width])
+    return ranges
+
+
+def baseline_checksums(
+    table_object: dict, source: dict, conn_type: str
+) -> Checksums | None:
+    """
+    Computes the whole checksum tree for a table, or returns None if its
+    primary key isn't numeric. The leaf level is read from the source and
+    the levels above it are added up from it.
+    """
+    integration = integration_map[conn_type]
+    # the newest key alone is an index seek, and tells whether the key is
+    # numeric before the whole key range is read
+    newest = integration.get_key_range(
+        table_object, source, table_object["primary_key"], 1
+    )
+    if newest.empty or int(newest.loc[0, "row_count"]) == 0:
+        return {}
+    dtype = newest["max_value"].dtype
+    if is_bool_dtype(dtype) or not is_numeric_dtype(dtype):
+        log("the primary key isn't numeric, can't check for deleted rows by range")
+        return None
+    bounds = integration.get_key_range(
+        table_object, source, table_object["primary_key"], 10**12
+    )
+
+    top_width, leaf_width = plan_bucket_widths(
+        bounds.loc[0, "min_value"],
+        bounds.loc[0, "max_value"],
+        int(bounds.loc[0, "row_count"]),
+    )
+    leaves = read_checksums(
+        integration.get_key_checksums(table_object, source, leaf_width)
+    )
+    checksums: Checksums = {
+        (leaf_width, bucket): values for bucket, values in leaves.items()
+    }
+    bucket_width = leaf_width
+    level = leaves
+    while bucket_width < top_width:
+        parents: dict[int, tuple[int, int]] = {}
+        for bucket, (row_count, checksum) in level.items():
+            parent = bucket // FANOUT
+            parent_count, parent_checksum = parents.get(parent, (0, 0))
+            parents[parent] = (parent_count + row_count, parent_checksum + checksum)
+        bucket_width *= FANOUT
+        level = parents
+        checksums.update(
+            {(bucket_width, bucket): values for bucket, values in parents.items()}
+        )
+    log(f"computed {len(checksums)} primary key checksums")
+    return checksums
+
+
+def changed_key_ranges(
+    table_object: dict, source: dict, conn_type: str, stored: Checksums
+) -> tuple[list[list[int]], Checksums]:
+    """
+    Walks down the checksum tree from the top level, only reading the
+    buckets under the ones that changed. Returns the key ranges of the
+    changed leaf buckets and the updated checksums.
+    """
+    integration = integration_map[conn_type]
+    bucket_widths = {bucket_width for bucket_width, _ in stored}
+    bucket_width, leaf_width = max(bucket_widths), min(bucket_widths)
+    checksums = dict(stored)
+    key_ranges = None
+    queries = 0
+    while True:
+        current = read_checksums(
+            integration.get_key_checksums(
+                table_object, source, bucket_width, key_ranges
+            )
+        )
+        queries += 1
+        previous = {
+            bucket: values
+            for (width, bucket), values in stored.items()
+            if width == bucket_width
+            and (
+                key_ranges is None
+                or any(
+                    lower <= bucket * bucket_width < upper
+                    for lower, upper in key_ranges
+                )
+            )
+        }
+        for bucket in previous:
+            del checksums[(bucket_width, bucket)]
+        checksums.update(
+            {(bucket_width, bucket): values for bucket, values in current.items()}
+        )
+
+        changed = sorted(
+            bucket
+            for bucket in previous.keys() | current.keys()
+            if previous.get(bucket) != current.get(bucket)
+        )
+        key_ranges = merge_ranges(changed, bucket_width)
+        if not key_ranges or bucket_width <= leaf_width:
+            break
+        bucket_width //= FANOUT
+
+    log(
+        f"{len(key_ranges)} primary key ranges changed, ",
+        f"found with {queries} checksum queries",
+    )
+    return key_ranges, checksums
+
+
+def check_for_deleted_rows(
+    table_object: dict,
+    source: dict,
+    conn_type: str,
+    table_uuid: str,
+    send_keys: Callable[[pd.DataFrame, list[list[int]]], Any],
+    legacy_check: Callable[[], Any],
+):
+    """
+    Sends the primary keys of the ranges whose checksum changed since the
+    last check with send_keys. The first check of a table computes the
+    checksums and runs legacy_check instead. The checksums are only stored
+    once every payload has been sent, so a failed check is redone in full.
+    """
+    stored_df = sqliteDB_setup.get_key_checksums(table_uuid)
+    if stored_df is None or stored_df.empty:
+        checksums = baseline_checksums(table_object, source, conn_type)
+        legacy_check()
+    else:
+        stored = {
+            (int(bucket_width), int(bucket)): (int(row_count), int(checksum))
+            for bucket_width, bucket, row_count, checksum in stored_df.itertuples(
+                index=False
+            )
+        }
+        key_ranges, checksums = changed_key_ranges(
+            table_object, source, conn_type, stored
+        )
+        integration = integration_map[conn_type]
+        for start in range(0, len(key_ranges), RANGES_PER_PAYLOAD):
+            payload_ranges = key_ranges[start : start + RANGES_PER_PAYLOAD]
+            send_keys(
+                integration.get_primary_keys_in_ranges(
+                    table_object, source, payload_ranges
+                ),
+                payload_ranges,
+            )
+
+    if checksums:
+        sqliteDB_setup.set_key_checksums(
+            table_uuid,
+            [
+                (bucket_width, bucket, row_count, checksum)
+                for (bucket_width, bucket), (row_count, checksum) in checksums.items()
+            ],
+        )
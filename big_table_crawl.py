@@ -0,0 +1,205 @@
+"""
+Functions for crawling the old rows of big tables.
+
+A big table's initial load can be split into disjoint ranges of its
+ordering key (or primary key) so each range is pulled by its own worker
+connection. The progress of every range is kept in the range dictionaries,
+which are checkpointed in table_sync_info as their pages are acknowledged
+so an interrupted load can pick up where it stopped.
+"""
+from threading import Lock
+from typing import Any, Iterator
+
+import numpy as np
+import pandas as pd
+import psutil
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
+
+from functions import json_safe_value, log
+from integration_mapping import integration_map
+
+
+def new_range(index: int, column: str | None, lower, upper) -> dict[str, Any]:
+    """A range of a big table to crawl. A None column means the whole table"""
+    return {
+        "index": index,
+        "column": column,
+        "lower": json_safe_value(lower),
+        "upper": json_safe_value(upper),
+        "cursor": None,
+        "pages": 0,
+        "rows": 0,
+        "completed": False,
+    }
+
+
+def restore_value(value, like: pd.Series):
+    """Turns a value from a checkpoint back into the type of a column"""
+    if value is None or not is_datetime64_any_dtype(like.dtype):
+        return value
+    timestamp = pd.Timestamp(value)
+    if like.dt.tz is not None and timestamp.tzinfo is None:
+        return timestamp.tz_localize(like.dt.tz)
+    return timestamp
+
+
+def split_values(min_value, max_value, parts: int) -> list:
+    """Returns up to parts - 1 evenly spaced boundaries between two values"""
+    if isinstance(min_value, pd.Timestamp):
+        boundaries = list(pd.date_range(min_value, max_value, periods=parts + 1))
+    else:
+        boundaries = list(np.linspace(min_value, max_value, parts + 1))
+        if isinstance(min_value, (int, np.integer)):
+            boundaries = [int(round(boundary)) for boundary in boundaries]
+    # Drop the end points and any boundaries that collapsed onto each other
+    return sorted(
+        {boundary for boundary in boundaries[1:-1] if min_value < boundary <= max_value}
+    )
+
+
+def plan_initial_load_ranges(
+    table_object: dict, source: dict, conn_type: str, parallelism: int
+) -> list[dict[str, Any]]:
+    """
+    Splits the newest large_table_row_limit rows of a table into up to
+    parallelism ranges, using min/max probes on the ordering key or the
+    primary key if the ordering key isn't a number or a date. Tables that
+    can't be split are crawled as a single range, like tables without a
+    primary key, whose offset crawl can't be limited to a range.
+    """
+    whole_table = [new_range(0, None, None, None)]
+    integration = integration_map[conn_type]
+    if (
+        parallelism < 2
+        or not table_object.get("primary_key")
+        or not hasattr(integration, "get_key_range")
+    ):
+        return whole_table
+
+    for column in (table_object["last_update"], table_object["primary_key"]):
+        if not column:
+            continue
+        bounds = integration.get_key_range(
+            table_object, source, column, table_object["large_table_row_limit"]
+        )
+        if bounds.empty or int(bounds.loc[0, "row_count"]) == 0:
+            return whole_table
+        min_value = bounds.loc[0, "min_value"]
+        max_value = bounds.loc[0, "max_value"]
+        dtype = bounds["min_value"].dtype
+        if is_bool_dtype(dtype) or not (
+            is_numeric_dtype(dtype) or is_datetime64_any_dtype(dtype)
+        ):
+            continue
+
+        boundaries = split_values(min_value, max_value, parallelism)
+        # If the probe didn't reach the end of the table only the newest rows are loaded
+        lower = (
+            min_value
+            if int(bounds.loc[0, "row_count"]) >= table_object["large_table_row_limit"]
+            else None
+        )
+        ranges = []
+        for index, upper in enumerate(boundaries + [None]):
+            ranges.append(new_range(index, column, lower, upper))
+            lower = upper
+        log(f"split the initial load into {len(ranges)} ranges on {column}")
+        return ranges
+
+    return whole_table
+
+
+class PageSizer:
+    """
+    Picks the number of rows to pull per page. The bytes per row of the pages
+    pulled so far and the memory left in the budget decide how many rows
+    fit in a page, given how many pages can be held in memory at once.
+    Shared by every range of a load.
+    """
+
+    MIN_ROWS = 1000
+    MAX_ROWS = 2000000
+
+    def __init__(self, memory_budget_mb: float, pages_in_flight: int, rows: int):
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.pages_in_flight = pages_in_flight
+        self.rows = rows
+        self.bytes_per_row: float | None = None
+        self.process = psutil.Process()
+        # memory in use before any pages are pulled, like imported libraries
+        self.base_rss = self.process.memory_info().rss
+        self.lock = Lock()
+
+    def record(self, df: pd.DataFrame):
+        """Measures the bytes per row of a page"""
+        if len(df) == 0:
+            return
+        bytes_per_row = df.memory_usage(index=False, deep=True).sum() / len(df)
+        with self.lock:
+            if self.bytes_per_row is None:
+                self.bytes_per_row = bytes_per_row
+            else:
+                self.bytes_per_row = 0.7 * self.bytes_per_row + 0.3 * bytes_per_row
+
+    def next_size(self) -> int:
+        """The number of rows to pull in the next page"""
+        with self.lock:
+            if self.bytes_per_row is None:
+                return self.rows
+            page_budget = (
+                max(self.memory_budget - self.base_rss, 0) / self.pages_in_flight
+            )
+            rows = int(page_budget / self.bytes_per_row)
+            if self.process.memory_info().rss > self.memory_budget:
+                # over budget, back off no matter what the estimate says
+                rows = min(rows, self.rows // 2)
+            self.rows = min(max(rows, self.MIN_ROWS), self.MAX_ROWS)
+            return self.rows
+
+
+def crawl_range(
+    table_object: dict,
+    source: dict,
+    conn_type: str,
+    crawler_range: dict[str, Any],
+    number_of_rows: int,
+    row_limit: int | None = None,
+    page_sizer: PageSizer | None = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yields pages of old rows from one range of a big table, newest first.
+    The range's cursor and counts are updated before each page is yielded.
+    Pages are number_of_rows rows, or sized by page_sizer if there is one.
+    Tables without a primary key are paged with OFFSET page * page size,
+    so their pages keep the size of the range's first page instead.
+    """
+    offset_paging = not table_object.get("primary_key")
+    if offset_paging:
+        number_of_rows = crawler_range.setdefault("page_rows", number_of_rows)
+        page_sizer = None
+    range_table_object = {
+        **table_object,
+        # the page the offset crawl of tables without a primary key is on
+        "crawler_step": crawler_range["pages"],
+        "crawler_cursor": crawler_range["cursor"],
+        "crawler_step_info": "completed" if crawler_range["completed"] else None,
+        "crawler_range": crawler_range if crawler_range["column"] else None,
+    }
+    while range_table_object["crawler_step_info"] != "completed" and (
+        row_limit is None or crawler_range["rows"] < row_limit
+    ):
+        if page_sizer is not None:
+            number_of_rows = page_sizer.next_size()
+        df = integration_map[conn_type].get_old_rows(
+            range_table_object, {}, source, number_of_rows
+        )
+        if page_sizer is not None:
+            page_sizer.record(df)
+        crawler_range["cursor"] = range_table_object["crawler_cursor"]
+        crawler_range["pages"] += 1
+        range_table_object["crawler_step"] += 1
+        crawler_range["rows"] += len(df)
+        crawler_range["completed"] = (
+            range_table_object["crawler_step_info"] == "completed"
+        )
+        yield df
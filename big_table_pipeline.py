@@ -0,0 +1,163 @@
+"""
+A pipelined executor for big table pages.
+
+Reader threads pull pages from the source, an encoder thread turns them
+into payloads and an uploader thread sends them, all connected by bounded
+queues. Page N+1 is queried while page N is encoded and page N-1 is sent,
+and no more than queue_depth pages wait between any two stages.
+"""
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Iterable
+
+from functions import log
+
+# Marks that a stage won't put anything else on its output queue
+_DONE = object()
+
+
+@dataclass
+class StageTimings:
+    """Seconds a stage spent working and waiting on its neighbours"""
+
+    busy: float = 0.0
+    waiting: float = 0.0
+    items: int = 0
+
+
+class PipelineStopped(Exception):
+    """Raised inside a stage when another stage has failed"""
+
+
+class PagePipeline:
+    """
+    Runs the reader, encoder and uploader stages for a big table load.
+    Each reader is an iterable of pages and gets its own thread, encode turns
+    a page into a payload and upload sends a payload.
+    """
+
+    def __init__(
+        self,
+        readers: list[Iterable[Any]],
+        encode: Callable[[Any], Any],
+        upload: Callable[[Any], None],
+        queue_depth: int = 2,
+    ):
+        self.readers = readers
+        self.encode = encode
+        self.upload = upload
+        self.pages: queue.Queue = queue.Queue(maxsize=queue_depth)
+        self.payloads: queue.Queue = queue.Queue(maxsize=queue_depth)
+        self.timings = {
+            "reading": StageTimings(),
+            "encoding": StageTimings(),
+            "uploading": StageTimings(),
+        }
+        self.timings_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.errors: list[Exception] = []
+
+    def run(self) -> dict[str, Any]:
+        """Runs every stage to completion and returns the stage timings"""
+        threads = [
+            threading.Thread(target=self.stage, args=(self.read, reader))
+            for reader in self.readers
+        ]
+        threads.append(threading.Thread(target=self.stage, args=(self.encode_pages,)))
+        threads.append(
+            threading.Thread(target=self.stage, args=(self.upload_payloads,))
+        )
+        then = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats: dict[str, Any] = {
+            stage: asdict(timings) for stage, timings in self.timings.items()
+        }
+        stats["elapsed"] = time.time() - then
+        if self.errors:
+            raise self.errors[0]
+        return stats
+
+    def stage(self, target: Callable, *args):
+        try:
+            target(*args)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            log("big table pipeline stage failed: ", e)
+            self.errors.append(e)
+            self.stopped.set()
+
+    def add_time(self, stage: str, busy: float = 0.0, waiting: float = 0.0):
+        with self.timings_lock:
+            self.timings[stage].busy += busy
+            self.timings[stage].waiting += waiting
+            if busy:
+                self.timings[stage].items += 1
+
+    def put(self, stage: str, output: queue.Queue, item):
+        """Puts an item on a queue, giving up if another stage failed"""
+        then = time.time()
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped()
+            try:
+                output.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        self.add_time(stage, waiting=time.time() - then)
+
+    def get(self, stage: str, source: queue.Queue):
+        """Gets an item from a queue, giving up if another stage failed"""
+        then = time.time()
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped()
+            try:
+                item = source.get(timeout=0.5)
+                break
+            except queue.Empty:
+                pass
+        self.add_time(stage, waiting=time.time() - then)
+        return item
+
+    def read(self, reader: Iterable[Any]):
+        pages = iter(reader)
+        while True:
+            then = time.time()
+            page = next(pages, _DONE)
+            if page is _DONE:
+                break
+            self.add_time("reading", busy=time.time() - then)
+            self.put("reading", self.pages, page)
+        self.put("reading", self.pages, _DONE)
+
+    def encode_pages(self):
+        readers_left = len(self.readers)
+        while readers_left > 0:
+            page = self.get("encoding", self.pages)
+            if page is _DONE:
+                readers_left -= 1
+                continue
+            then = time.time()
+            payload = self.encode(page)
+            del page
+            self.add_time("encoding", busy=time.time() - then)
+            self.put("encoding", self.payloads, payload)
+        self.put("encoding", self.payloads, _DONE)
+
+    def upload_payloads(self):
+        while True:
+            payload = self.get("uploading", self.payloads)
+            if payload is _DONE:
+                break
+            then = time.time()
+            self.upload(payload)
+            del payload
+            self.add_time("uploading", busy=time.time() - then)
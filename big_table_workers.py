@@ -0,0 +1,137 @@
+"""
+A bounded pool of processes for big table syncs.
+
+Big tables are synced in a fixed number of long lived worker processes
+instead of a new process per table. Due tables wait in a queue per source
+and are started round robin across the sources, so a source with many big
+tables can't hold every worker, and no source runs more than its own
+big_table_workers limit at once.
+"""
+import concurrent.futures
+from collections import OrderedDict, deque
+from concurrent.futures.process import BrokenProcessPool
+from threading import RLock
+from typing import Any, Callable
+
+from functions import log, log_error
+from integration_mapping import integration_map
+
+# Sources the current worker process has connected to, by source uuid
+_worker_sources: dict[str, dict[str, Any]] = {}
+
+
+def worker_source(
+    source_uuid: str, source: dict[str, Any], refresh: bool = False
+) -> dict[str, Any]:
+    """
+    Returns a connected copy of a source inside a worker process. Engines
+    can't be sent between processes, so each worker makes its own and keeps
+    it until the source's credentials change or refresh is set.
+    """
+    cached = _worker_sources.get(source_uuid)
+    if not refresh and cached is not None and cached["creds"] == source["creds"]:
+        return {**source, "conn": cached["conn"], "creds_uri": cached.get("creds_uri")}
+    source = {**source, "conn": None}
+    integration_map[source["connection_type"]].refresh_conn(source)
+    _worker_sources[source_uuid] = source
+    return source
+
+
+def picklable_source(source: dict[str, Any]) -> dict[str, Any]:
+    """The parts of a source a worker process needs to connect to it"""
+    return {
+        key: value for key, value in source.items() if key not in ("conn", "tables")
+    }
+
+
+class BigTableWorkerPool:
+    """
+    Runs big table syncs in at most max_workers processes. run_job is called
+    in a worker process with the source uuid, a copy of the source without
+    its engine, and the arguments the job was queued with.
+    """
+
+    def __init__(self, run_job: Callable, max_workers: int):
+        self.run_job = run_job
+        self.max_workers = max_workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        # reentrant because a future that's already done runs its callback right away
+        self.lock = RLock()
+        # table uuid -> (source, job arguments), by source uuid
+        self.queues: OrderedDict[str, OrderedDict[str, tuple]] = OrderedDict()
+        self.running: dict[str, str] = {}
+        self.source_limits: dict[str, int] = {}
+        self.turns: deque[str] = deque()
+
+    def submit(
+        self,
+        source_uuid: str,
+        source: dict[str, Any],
+        table_uuid: str,
+        *args,
+    ) -> bool:
+        """
+        Queues a big table sync. Returns False if the table is already
+        running. A table that's already queued keeps its place but will
+        run with the newest arguments.
+        """
+        with self.lock:
+            if table_uuid in self.running:
+                return False
+            self.source_limits[source_uuid] = source.get(
+                "big_table_workers", self.max_workers
+            )
+            if source_uuid not in self.queues:
+                self.queues[source_uuid] = OrderedDict()
+                self.turns.append(source_uuid)
+            self.queues[source_uuid][table_uuid] = (
+                picklable_source(source),
+                args,
+            )
+            self.dispatch()
+        return True
+
+    def running_for(self, source_uuid: str) -> int:
+        return sum(1 for running in self.running.values() if running == source_uuid)
+
+    def dispatch(self):
+        """Starts queued jobs while there are free workers, taking turns between sources"""
+        while len(self.running) < self.max_workers:
+            for _ in range(len(self.turns)):
+                source_uuid = self.turns[0]
+                self.turns.rotate(-1)
+                if self.queues[source_uuid] and self.running_for(
+                    source_uuid
+                ) < self.source_limits.get(source_uuid, self.max_workers):
+                    break
+            else:
+                return
+
+            table_uuid, (source, args) = self.queues[source_uuid].popitem(last=False)
+            self.running[table_uuid] = source_uuid
+            try:
+                future = self.executor.submit(
+                    self.run_job, source_uuid, source, table_uuid, *args
+                )
+            except BrokenProcessPool:
+                # a worker was killed, start a new set of processes
+                log("big table worker pool broke, restarting it")
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers
+                )
+                future = self.executor.submit(
+                    self.run_job, source_uuid, source, table_uuid, *args
+                )
+            future.add_done_callback(
+                lambda future, table_uuid=table_uuid: self.finished(table_uuid, future)
+            )
+
+    def finished(self, table_uuid: str, future: concurrent.futures.Future):
+        try:
+            future.result()
+        except Exception as e:
+            log(f"big table worker failed for {table_uuid}")
+            log_error(e)
+        with self.lock:
+            self.running.pop(table_uuid, None)
+            self.dispatch()
@@ -555,4 +555,5 @@ def display_timer(n):
 
 
 if __name__ == "__main__":
+    sqliteDB_setup.setup_database()
     app.run_server("0.0.0.0", "8050", debug=True, dev_tools_silence_routes_logging=True)
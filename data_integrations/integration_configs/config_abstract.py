@@ -1,5 +1,5 @@
 # This files contains the integration specific configurations.
-# Each configuration is a class that contains urls, headers, 
+# Each configuration is a class that contains urls, headers,
 # endpoint payloads, and other information.
 # The configuration class is then imported into the integration
 # file and used to create the integration.
@@ -11,8 +11,7 @@ class ConfigAbstract(metaclass=ABCMeta):
     """
     Abstract class for configs.
     """
-    
-    
+
     @property
     @abstractmethod
     def header(self):
@@ -23,7 +22,6 @@ class ConfigAbstract(metaclass=ABCMeta):
     def header(self, header):
         pass
 
-
     @property
     @abstractmethod
     def endpoint(self):
@@ -32,4 +30,4 @@ class ConfigAbstract(metaclass=ABCMeta):
     @endpoint.setter
     @abstractmethod
     def endpoint(self, endpoint_name):
-        pass
\ No newline at end of file
+        pass
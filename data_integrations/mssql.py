@@ -1,3 +1,4 @@
+import re
 from datetime import datetime
 from os import listdir
 from os.path import isfile, join
@@ -8,12 +9,23 @@ from pandas.api.types import is_numeric_dtype
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
 
-from functions import log, log_error
+from data_integrations.read_engine import read_sql
+from functions import (
+    advance_crawler_cursor,
+    crawler_columns,
+    crawler_keyset,
+    key_range_condition,
+    log,
+    log_error,
+    updated_rows_keyset,
+)
 
 has_row_updates = True
 
 odbc_driver_path = "/opt/microsoft/msodbcsql17/lib64/"
 
+iso_datetime_pattern = re.compile(r"^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}")
+
 
 class NoMSSQLdriver(Exception):
     """Thrown when the MS SQL ODBC driver didn't get installed properly"""
@@ -116,18 +128,55 @@ def get_table_preview(source, table_name, number_of_rows):
         FROM {table_name}
         ORDER BY 1 DESC;
     """
-    df = pd.read_sql(sql, source["conn"])
+    df = read_sql(sql, source)
     return df
 
 
 def get_old_rows(table_object, message, source, batch_pull_size):
     """function for pulling in old rows"""
+    relevant_columns, table_name = (
+        table_object["relevant_columns"],
+        table_object["table_name"],
+    )
+    if not table_object.get("primary_key"):
+        return get_old_rows_by_offset(table_object, message, source, batch_pull_size)
+
+    condition, order_by = crawler_keyset(table_object, quote, sql_literal)
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        condition += f" AND ({where})"
+
+    # Tables that were part way through an offset crawl seek to where it left off once
+    offset = 0
+    if table_object.get("crawler_cursor") is None and table_object["crawler_step"]:
+        offset = batch_pull_size * table_object["crawler_step"]
+
+    columns = crawler_columns(table_object)
+    sql = f"""
+        SELECT {','.join(quote(column) for column in columns)}
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        OFFSET {offset} ROWS
+        FETCH NEXT {batch_pull_size} ROWS ONLY;
+    """
+
+    new_rows_df = read_sql(sql, source)
+    advance_crawler_cursor(new_rows_df, table_object, message, batch_pull_size)
+
+    # Drop the cursor keys if they aren't relevant columns
+    if len(columns) > len(relevant_columns):
+        new_rows_df = new_rows_df[relevant_columns]
+    return new_rows_df
+
+
+def get_old_rows_by_offset(table_object, message, source, batch_pull_size):
+    """function for pulling in old rows on tables without a primary key"""
     ordering_key, relevant_columns, table_name = (
         table_object["last_update"],
         table_object["relevant_columns"],
         table_object["table_name"],
     )
-    data_connection = source["conn"]
     sql = f"""
         SELECT {','.join(relevant_columns)}
         FROM {table_name}
@@ -137,7 +186,7 @@ def get_old_rows(table_object, message, source, batch_pull_size):
         FETCH NEXT {batch_pull_size} ROWS ONLY;
     """
 
-    new_rows_df = pd.read_sql(sql, data_connection)
+    new_rows_df = read_sql(sql, source)
 
     if len(new_rows_df) < batch_pull_size:
         message["crawler_step_info"] = "completed"
@@ -148,53 +197,26 @@ def get_old_rows(table_object, message, source, batch_pull_size):
 
 def get_updated_rows(table_object, source):
     """function for getting new rows from a table"""
-    data_connection = source["conn"]
-    ordering_key, relevant_columns, last_pulled_update, table_name = (
-        table_object["last_update"],
+    relevant_columns, table_name = (
         table_object["relevant_columns"],
-        table_object["last_update_value"],
         table_object["table_name"],
     )
+    # rows after the last one pulled on (ordering key, primary key)
+    condition, order_by = updated_rows_keyset(table_object, quote, sql_literal)
     where = create_where_clause(table_object, source, no_where=True)
     if where != "":
-        where = f" and ({where})"
-
-    # If the last update value is a number, don't update its format
-    if pd.api.types.is_numeric_dtype(type(last_pulled_update)):
-        sql = f"""
-            SELECT {','.join(relevant_columns)}
-            FROM {table_name}
-            WHERE {ordering_key} > {last_pulled_update} {where}
-            """
-    else:
-        # First, try to convert the last_pulled_update to a datetime and then
-        # back to a date string with a format of YYYY-MM-DD HH:MM:SS.SSS
-        try:
-            last_pulled_update_dt = pd.to_datetime(last_pulled_update)
-            last_pulled_update = last_pulled_update_dt.strftime("%Y-%m-%d %H:%M:%S.%f")
-            # We only want the first 3 digits of the milliseconds since MSSQL
-            # only supports 3 digits of milliseconds
-            last_pulled_update = last_pulled_update[:-3]
-            sql = f"""
-                SELECT {','.join(relevant_columns)}
-                FROM {table_name}
-                WHERE {ordering_key} > '{last_pulled_update}' {where}
-                """
-        except ValueError:
-            # get all the rows that have  been updated since the last pull
-            sql = f"""
-                SELECT {','.join(relevant_columns)}
-                FROM {table_name}
-                WHERE {ordering_key} > '{last_pulled_update}' {where}
-                """
-
-    df = pd.read_sql(sql, data_connection)
-    return df
+        condition += f" AND ({where})"
+    sql = f"""
+        SELECT {','.join(relevant_columns)}
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        """
+    return read_sql(sql, source)
 
 
 def get_primary_keys(table_object, source, number_of_rows=20000):
     """function for getting the primary keys of the most recent rows"""
-    data_connection = source["conn"]
     primary_key, ordering_key, table_name = (
         table_object["primary_key"],
         table_object["last_update"],
@@ -206,7 +228,55 @@ def get_primary_keys(table_object, source, number_of_rows=20000):
         {create_where_clause(table_object,source)}
         ORDER BY {ordering_key} DESC;
     """
-    return pd.read_sql(sql, data_connection)
+    return read_sql(sql, source)
+
+
+def get_key_range(table_object, source, column, row_limit):
+    """function for getting the range of the newest row_limit values of a column"""
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT MIN("{column}") AS min_value, MAX("{column}") AS max_value, COUNT(*) AS row_count
+        FROM (
+            SELECT TOP {row_limit} "{column}"
+            FROM {table_object['table_name']}
+            WHERE "{column}" IS NOT NULL {where}
+            ORDER BY "{column}" DESC
+        ) AS newest_rows;
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_key_checksums(table_object, source, bucket_width, key_ranges=None):
+    """function for getting the row count and a checksum of the primary keys in each bucket"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    if key_ranges is not None:
+        where += f" AND ({key_range_condition(quote(primary_key), key_ranges)})"
+    sql = f"""
+        SELECT FLOOR(CAST("{primary_key}" AS DECIMAL(38, 0)) / {bucket_width}) AS bucket, COUNT(*) AS row_count, SUM(CAST(CAST(SUBSTRING(HASHBYTES('MD5', CAST("{primary_key}" AS NVARCHAR(100))), 1, 4) AS INT) AS BIGINT)) AS checksum
+        FROM {table_object['table_name']}
+        WHERE "{primary_key}" IS NOT NULL {where}
+        GROUP BY FLOOR(CAST("{primary_key}" AS DECIMAL(38, 0)) / {bucket_width});
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_primary_keys_in_ranges(table_object, source, key_ranges):
+    """function for getting every primary key in a list of [lower, upper) ranges"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT "{primary_key}"
+        FROM {table_object['table_name']}
+        WHERE ({key_range_condition(quote(primary_key), key_ranges)}) {where};
+    """
+    return read_sql(sql, source)
 
 
 def initial_pull(table_object, source, batch_pull_size):
@@ -222,10 +292,13 @@ def initial_pull(table_object, source, batch_pull_size):
         {create_where_clause(table_object,source)}
         ORDER BY {ordering_key} DESC;
     """
-    return pd.read_sql(sql, source["conn"])
+    return read_sql(sql, source)
 
 
 def create_where_clause(table_object, source, no_where=False):
+    if table_object.get("sync_plan") is not None:
+        # compiled once per table config by sync_plan.plan_for
+        return table_object["sync_plan"].where_clause(no_where)
     sql = ""
     first = True
     logical_operators = {"and": "and", "or": "or"}
@@ -267,6 +340,27 @@ def create_where_clause(table_object, source, no_where=False):
     return sql
 
 
+def quote(identifier):
+    """quote a column name"""
+    return f'"{identifier}"'
+
+
+def sql_literal(value):
+    """format a python value as a sql literal"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    value = str(value)
+    if iso_datetime_pattern.match(value):
+        # a plain literal is compared as a datetime, which only keeps
+        # milliseconds, so cursors with microseconds would skip rows
+        timestamp = pd.Timestamp(value)
+        value = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f") + str(
+            timestamp.nanosecond // 100
+        )
+        return f"CAST(N'{value}' AS DATETIME2(7))"
+    return "N'" + value.replace("'", "''") + "'"
+
+
 def sql_escape(s):
     """escape single quotes and backslashes so you can put anything in a string"""
     return s.replace("\\", "\\\\").replace("'", "''")
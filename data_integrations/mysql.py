@@ -5,7 +5,15 @@ from pandas.api.types import is_numeric_dtype
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
 
-from functions import log_error
+from data_integrations.read_engine import read_sql
+from functions import (
+    advance_crawler_cursor,
+    crawler_columns,
+    crawler_keyset,
+    key_range_condition,
+    log_error,
+    updated_rows_keyset,
+)
 
 has_row_updates = True
 
@@ -81,18 +89,53 @@ def get_table_preview(source, table_name, number_of_rows):
         FROM {table_name}
         LIMIT {number_of_rows};
     """
-    df = pd.read_sql(sql, source["conn"])
+    df = read_sql(sql, source)
     return df
 
 
 def get_old_rows(table_object, message, source, batch_pull_size):
     """function for pulling in old rows"""
+    relevant_columns, table_name = (
+        table_object["relevant_columns"],
+        table_object["table_name"],
+    )
+    if not table_object.get("primary_key"):
+        return get_old_rows_by_offset(table_object, message, source, batch_pull_size)
+
+    condition, order_by = crawler_keyset(table_object, quote, sql_literal)
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        condition += f" AND ({where})"
+
+    # Tables that were part way through an offset crawl seek to where it left off once
+    offset = ""
+    if table_object.get("crawler_cursor") is None and table_object["crawler_step"]:
+        offset = f"OFFSET {batch_pull_size*table_object['crawler_step']}"
+
+    columns = crawler_columns(table_object)
+    sql = f"""
+        SELECT {','.join(quote(column) for column in columns)}
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        LIMIT {batch_pull_size} {offset};
+    """
+    new_rows_df = read_sql(sql, source)
+    advance_crawler_cursor(new_rows_df, table_object, message, batch_pull_size)
+
+    # Drop the cursor keys if they aren't relevant columns
+    if len(columns) > len(relevant_columns):
+        new_rows_df = new_rows_df[relevant_columns]
+    return new_rows_df
+
+
+def get_old_rows_by_offset(table_object, message, source, batch_pull_size):
+    """function for pulling in old rows on tables without a primary key"""
     ordering_key, relevant_columns, table_name = (
         table_object["last_update"],
         table_object["relevant_columns"],
         table_object["table_name"],
     )
-    data_connection = source["conn"]
     sql = f"""
         SELECT `{'`,`'.join(relevant_columns)}`
         FROM {table_name}
@@ -100,47 +143,37 @@ def get_old_rows(table_object, message, source, batch_pull_size):
         ORDER BY `{ordering_key}` DESC
         LIMIT {batch_pull_size} OFFSET {batch_pull_size*table_object['crawler_step']};
     """
-    new_rows_df = pd.read_sql(sql, data_connection)
+    new_rows_df = read_sql(sql, source)
+
+    if len(new_rows_df) < batch_pull_size:
+        message["crawler_step_info"] = "completed"
+        table_object["crawler_step_info"] = "completed"
 
     return new_rows_df
 
 
 def get_updated_rows(table_object, source):
     """function for getting new rows from a table"""
-    data_connection = source["conn"]
-    ordering_key, relevant_columns, last_pulled_update, table_name = (
-        table_object["last_update"],
+    relevant_columns, table_name = (
         table_object["relevant_columns"],
-        table_object["last_update_value"],
         table_object["table_name"],
     )
+    # rows after the last one pulled on (ordering key, primary key)
+    condition, order_by = updated_rows_keyset(table_object, quote, sql_literal)
     where = create_where_clause(table_object, source, no_where=True)
     if where != "":
-        where = f" and ({where})"
-    try:
-        float(last_pulled_update)
-        sql = f"""
-            SELECT `{'`,`'.join(relevant_columns)}`
-            FROM {table_name}
-            WHERE {ordering_key} > {last_pulled_update} {where}
-            """
-    except ValueError:
-        sql = f"""
-            SELECT `{'`,`'.join(relevant_columns)}`
-            FROM {table_name}
-            WHERE {ordering_key} > '{last_pulled_update}' {where}
-            """
-
-    updated_rows = pd.read_sql(
-        sql,
-        data_connection,
-    )
-    return updated_rows
+        condition += f" AND ({where})"
+    sql = f"""
+        SELECT `{'`,`'.join(relevant_columns)}`
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        """
+    return read_sql(sql, source)
 
 
 def get_primary_keys(table_object, source, number_of_rows=20000):
     """function for getting the primary keys of the most recent rows"""
-    data_connection = source["conn"]
     primary_key, ordering_key, table_name = (
         table_object["primary_key"],
         table_object["last_update"],
@@ -154,7 +187,56 @@ def get_primary_keys(table_object, source, number_of_rows=20000):
         LIMIT {number_of_rows};
     """
 
-    return pd.read_sql(sql, data_connection)
+    return read_sql(sql, source)
+
+
+def get_key_range(table_object, source, column, row_limit):
+    """function for getting the range of the newest row_limit values of a column"""
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT MIN(`{column}`) AS min_value, MAX(`{column}`) AS max_value, COUNT(*) AS row_count
+        FROM (
+            SELECT `{column}`
+            FROM {table_object['table_name']}
+            WHERE `{column}` IS NOT NULL {where}
+            ORDER BY `{column}` DESC
+            LIMIT {row_limit}
+        ) AS newest_rows;
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_key_checksums(table_object, source, bucket_width, key_ranges=None):
+    """function for getting the row count and a checksum of the primary keys in each bucket"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    if key_ranges is not None:
+        where += f" AND ({key_range_condition(quote(primary_key), key_ranges)})"
+    sql = f"""
+        SELECT FLOOR(`{primary_key}` / {bucket_width}) AS bucket, COUNT(*) AS row_count, SUM(CRC32(`{primary_key}`)) AS checksum
+        FROM {table_object['table_name']}
+        WHERE `{primary_key}` IS NOT NULL {where}
+        GROUP BY FLOOR(`{primary_key}` / {bucket_width});
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_primary_keys_in_ranges(table_object, source, key_ranges):
+    """function for getting every primary key in a list of [lower, upper) ranges"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT `{primary_key}`
+        FROM {table_object['table_name']}
+        WHERE ({key_range_condition(quote(primary_key), key_ranges)}) {where};
+    """
+    return read_sql(sql, source)
 
 
 def initial_pull(table_object, source, batch_pull_size):
@@ -164,7 +246,6 @@ def initial_pull(table_object, source, batch_pull_size):
         table_object["relevant_columns"],
         table_object["table_name"],
     )
-    data_connection = source["conn"]
     sql = f"""
         SELECT `{'`,`'.join(relevant_columns)}`
         FROM {table_name}
@@ -172,10 +253,13 @@ def initial_pull(table_object, source, batch_pull_size):
         ORDER BY `{ordering_key}` DESC
         LIMIT {batch_pull_size};
     """
-    return pd.read_sql(sql, data_connection)
+    return read_sql(sql, source)
 
 
 def create_where_clause(table_object, source, no_where=False):
+    if table_object.get("sync_plan") is not None:
+        # compiled once per table config by sync_plan.plan_for
+        return table_object["sync_plan"].where_clause(no_where)
     sql = ""
     first = True
     logical_operators = {"and": "and", "or": "or"}
@@ -202,6 +286,18 @@ def create_where_clause(table_object, source, no_where=False):
     return sql
 
 
+def quote(identifier):
+    """quote a column name"""
+    return f"`{identifier}`"
+
+
+def sql_literal(value):
+    """format a python value as a sql literal"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return f"'{sql_escape(str(value))}'"
+
+
 def sql_escape(s):
     """escape single quotes and backslashes so you can put anything in a string"""
     return s.replace("\\", "\\\\").replace("'", "''")
@@ -1,14 +1,34 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from urllib.parse import quote_plus as qp
 
-import connectorx as cx
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
 
+import json_codec
+from data_integrations.read_engine import read_sql, read_sql_sqlalchemy
+from functions import (
+    advance_crawler_cursor,
+    crawler_columns,
+    crawler_cursor_after,
+    crawler_keyset,
+    key_range_condition,
+    updated_rows_keyset,
+)
+
 has_row_updates = True
 
+# the output plugin change capture decodes the WAL with, it has to be installed on the server
+CHANGE_CAPTURE_PLUGIN = "wal2json"
+# Every table with change capture has a replication slot of its own. Each
+# one counts against the server's max_replication_slots, 10 by default, and
+# decodes the whole database's WAL when it's read, so it's for a handful of
+# busy tables rather than every table of a source.
+
+# changes collapsed by primary key are looked up this many at a time
+CHANGE_LOOKUP_SIZE = 1000
+
 
 def format_creds(creds_row):
     source_creds = creds_row["creds"]
@@ -67,18 +87,65 @@ def get_table_preview(source, table_name, number_of_rows):
         FROM "{table_name}"
         LIMIT {number_of_rows};
     """
-    df = pd.read_sql(sql, source["conn"])
+    df = read_sql(sql, source)
     return df
 
 
 def get_old_rows(table_object, message, source, batch_pull_size):
     """function for pulling in old rows"""
+    relevant_columns, table_name = (
+        table_object["relevant_columns"],
+        table_object["table_name"],
+    )
+    if not table_object.get("primary_key"):
+        return get_old_rows_by_offset(table_object, message, source, batch_pull_size)
+
+    condition, order_by = crawler_keyset(table_object, quote, sql_literal)
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        condition += f" AND ({where})"
+
+    # Tables that were part way through an offset crawl seek to where it left off
+    # once. That crawl had the rows with a null ordering key first, so they're
+    # taken off the rows to skip and crawled again at the end instead.
+    offset = ""
+    if table_object.get("crawler_cursor") is None and table_object["crawler_step"]:
+        null_condition = f"{quote(table_object['last_update'])} IS NULL"
+        if where != "":
+            null_condition += f" AND ({where})"
+        null_rows = read_sql(
+            f"SELECT COUNT(*) AS null_rows FROM {table_name} WHERE {null_condition};",
+            source,
+        )["null_rows"].iloc[0]
+        skip = batch_pull_size * table_object["crawler_step"] - int(null_rows)
+        if skip > 0:
+            offset = f"OFFSET {skip}"
+
+    columns = crawler_columns(table_object)
+    sql = f"""
+        SELECT {', '.join(quote(column) for column in columns)}
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        LIMIT {batch_pull_size} {offset};
+    """
+
+    new_rows_df = read_sql(sql, source)
+    advance_crawler_cursor(new_rows_df, table_object, message, batch_pull_size)
+
+    # Drop the cursor keys if they aren't relevant columns
+    if len(columns) > len(relevant_columns):
+        new_rows_df = new_rows_df[relevant_columns]
+    return new_rows_df
+
+
+def get_old_rows_by_offset(table_object, message, source, batch_pull_size):
+    """function for pulling in old rows on tables without a primary key"""
     ordering_key, relevant_columns, table_name = (
         table_object["last_update"],
         table_object["relevant_columns"],
         table_object["table_name"],
     )
-    data_connection = source["conn"]
     sql = f"""
         SELECT "{'", "'.join(relevant_columns)}"
         FROM {table_name}
@@ -87,7 +154,7 @@ def get_old_rows(table_object, message, source, batch_pull_size):
         LIMIT {batch_pull_size} OFFSET {batch_pull_size*table_object['crawler_step']};
     """
 
-    new_rows_df = pd.read_sql(sql, data_connection)
+    new_rows_df = read_sql(sql, source)
 
     if len(new_rows_df) < batch_pull_size:
         message["crawler_step_info"] = "completed"
@@ -98,34 +165,26 @@ def get_old_rows(table_object, message, source, batch_pull_size):
 
 def get_updated_rows(table_object, source):
     """function for getting new rows from a table"""
-    data_connection = source["conn"]
-    ordering_key, relevant_columns, last_pulled_update, table_name = (
-        table_object["last_update"],
+    relevant_columns, table_name = (
         table_object["relevant_columns"],
-        table_object["last_update_value"],
         table_object["table_name"],
     )
+    # rows after the last one pulled on (ordering key, primary key)
+    condition, order_by = updated_rows_keyset(table_object, quote, sql_literal)
     where = create_where_clause(table_object, source, no_where=True)
     if where != "":
-        where = f" and ({where})"
-    if str(last_pulled_update).isdecimal():
-        sql = f"""
-            SELECT "{'", "'.join(relevant_columns)}"
-            FROM {table_name}
-            WHERE "{ordering_key}" > {last_pulled_update} {where}
-            """
-    else:
-        sql = f"""
-            SELECT "{'", "'.join(relevant_columns)}"
-            FROM {table_name}
-            WHERE "{ordering_key}" > '{last_pulled_update}' {where}
-            """
-    return pd.read_sql(sql, data_connection)
+        condition += f" AND ({where})"
+    sql = f"""
+        SELECT "{'", "'.join(relevant_columns)}"
+        FROM {table_name}
+        WHERE {condition}
+        ORDER BY {order_by}
+        """
+    return read_sql(sql, source)
 
 
 def get_primary_keys(table_object, source, number_of_rows=20000):
     """function for getting the primary keys of the most recent rows"""
-    data_connection = source["conn"]
     primary_key, ordering_key, table_name = (
         table_object["primary_key"],
         table_object["last_update"],
@@ -138,23 +197,245 @@ def get_primary_keys(table_object, source, number_of_rows=20000):
         ORDER BY "{ordering_key}" DESC
         LIMIT {number_of_rows};
     """
-    return pd.read_sql(sql, data_connection)
+    return read_sql(sql, source)
+
+
+def get_key_range(table_object, source, column, row_limit):
+    """function for getting the range of the newest row_limit values of a column"""
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT MIN("{column}") AS min_value, MAX("{column}") AS max_value, COUNT(*) AS row_count
+        FROM (
+            SELECT "{column}"
+            FROM {table_object['table_name']}
+            WHERE "{column}" IS NOT NULL {where}
+            ORDER BY "{column}" DESC
+            LIMIT {row_limit}
+        ) AS newest_rows;
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_key_checksums(table_object, source, bucket_width, key_ranges=None):
+    """function for getting the row count and a checksum of the primary keys in each bucket"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    if key_ranges is not None:
+        where += f" AND ({key_range_condition(quote(primary_key), key_ranges)})"
+    sql = f"""
+        SELECT FLOOR("{primary_key}"::numeric / {bucket_width}) AS bucket, COUNT(*) AS row_count, SUM(hashtext("{primary_key}"::text)::bigint) AS checksum
+        FROM {table_object['table_name']}
+        WHERE "{primary_key}" IS NOT NULL {where}
+        GROUP BY FLOOR("{primary_key}"::numeric / {bucket_width});
+    """
+    return pd.read_sql(sql, source["conn"])
+
+
+def get_primary_keys_in_ranges(table_object, source, key_ranges):
+    """function for getting every primary key in a list of [lower, upper) ranges"""
+    primary_key = table_object["primary_key"]
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    sql = f"""
+        SELECT "{primary_key}"
+        FROM {table_object['table_name']}
+        WHERE ({key_range_condition(quote(primary_key), key_ranges)}) {where};
+    """
+    return read_sql(sql, source)
 
 
 def initial_pull(table_object, source, batch_pull_size):
-    """function for doing initial pulls on tables"""
+    """
+    function for doing initial pulls on tables. On tables with a primary key
+    the rows come in the crawler's order and the crawler cursor is set to
+    the last one, so crawling the old rows carries on right after them.
+    """
+    if not table_object.get("primary_key"):
+        sql = f"""
+            SELECT "{'", "'.join(table_object['relevant_columns'])}"
+            FROM "{table_object['table_name']}"
+            {create_where_clause(table_object,source)}
+            ORDER BY "{table_object['last_update']}" DESC
+            LIMIT {batch_pull_size}
+        """
+        return read_sql(sql, source)
 
+    columns = crawler_columns(table_object)
     sql = f"""
-        SELECT "{'", "'.join(table_object['relevant_columns'])}"
+        SELECT {', '.join(quote(column) for column in columns)}
         FROM "{table_object['table_name']}"
         {create_where_clause(table_object,source)}
-        ORDER BY "{table_object['last_update']}" DESC
+        ORDER BY {quote(table_object['last_update'])} DESC NULLS LAST,
+            {quote(table_object['primary_key'])} DESC
         LIMIT {batch_pull_size}
     """
-    return cx.read_sql(source["creds_uri"], sql)
+    new_rows_df = read_sql(sql, source)
+    table_object["crawler_cursor"] = crawler_cursor_after(new_rows_df, table_object)
+    return new_rows_df[table_object["relevant_columns"]]
+
+
+def replication_slot_name(table_uuid):
+    return f"sync_agent_{table_uuid.replace('-', '').lower()}"[:63]
+
+
+def replication_connection(source):
+    """A connection for the slot functions, which can't be rolled back anyway"""
+    return source["conn"].connect().execution_options(isolation_level="AUTOCOMMIT")
+
+
+class NoReplicationSlots(Exception):
+    """Thrown when every replication slot the server allows is taken"""
+
+
+def create_replication_slot(source, table_uuid):
+    """
+    Creates the table's logical replication slot if it doesn't exist.
+    Returns True if it was created, so there's no position to resume from.
+    """
+    slot_name = replication_slot_name(table_uuid)
+    with replication_connection(source) as conn:
+        exists = conn.exec_driver_sql(
+            f"SELECT 1 FROM pg_replication_slots WHERE slot_name = '{slot_name}';"
+        ).first()
+        if exists:
+            return False
+        max_slots, used_slots = conn.exec_driver_sql(
+            """SELECT current_setting('max_replication_slots')::int,
+            (SELECT COUNT(*) FROM pg_replication_slots);"""
+        ).first()
+        if used_slots >= max_slots:
+            raise NoReplicationSlots(
+                f"all {max_slots} replication slots of the server are in use, "
+                "raise max_replication_slots or turn change capture off for a table"
+            )
+        conn.exec_driver_sql(
+            f"SELECT pg_create_logical_replication_slot('{slot_name}', '{CHANGE_CAPTURE_PLUGIN}');"
+        )
+    return True
+
+
+def drop_replication_slot(source, table_uuid):
+    """Drops the table's replication slot so the server stops keeping WAL for it"""
+    slot_name = replication_slot_name(table_uuid)
+    with replication_connection(source) as conn:
+        conn.exec_driver_sql(
+            f"""SELECT pg_drop_replication_slot(slot_name)
+            FROM pg_replication_slots WHERE slot_name = '{slot_name}';"""
+        )
+
+
+def get_changes(
+    table_object, source, table_uuid, confirmed_lsn, max_changes, max_seconds
+):
+    """
+    function for getting the rows changed since confirmed_lsn from the table's
+    replication slot. Returns the current version of the inserted and updated
+    rows, the primary keys of the deleted rows and the lsn to confirm once
+    they've been sent, or None if there weren't any changes.
+
+    The slot is moved up to confirmed_lsn first, so changes that weren't
+    confirmed are read again. A batch stops at the end of the transaction
+    that takes it to max_changes rows, or to max_seconds of commits.
+    """
+    slot_name = replication_slot_name(table_uuid)
+    primary_key = table_object["primary_key"]
+    table_name = table_object["table_name"]
+    if confirmed_lsn is not None:
+        with replication_connection(source) as conn:
+            conn.exec_driver_sql(
+                f"""SELECT pg_replication_slot_advance(slot_name, '{confirmed_lsn}')
+                FROM pg_replication_slots
+                WHERE slot_name = '{slot_name}' AND confirmed_flush_lsn < '{confirmed_lsn}'::pg_lsn;"""
+            )
+
+    # wal2json matches tables by schema.table
+    add_tables = table_name.replace('"', "")
+    if "." not in add_tables:
+        add_tables = f"*.{add_tables}"
+    sql = f"""
+        SELECT lsn::text AS lsn, data
+        FROM pg_logical_slot_peek_changes(
+            '{slot_name}', NULL, {max_changes},
+            'format-version', '2', 'include-timestamp', '1',
+            'add-tables', E'{sql_escape(add_tables)}'
+        );
+    """
+    # pg_lsn isn't a type connectorx reads
+    changes = read_sql_sqlalchemy(sql, source, "pandas")
+
+    # primary key -> whether the row still exists after its last change
+    changed = {}
+    lsn = None
+    rows = 0
+    first_commit = None
+    for change_lsn, data in zip(changes["lsn"], changes["data"]):
+        change = json_codec.loads(data)
+        action = change["action"]
+        if action in ("I", "U"):
+            # an update that changed the primary key has the old one in identity
+            for column in change.get("identity", []):
+                if column["name"] == primary_key:
+                    changed[column["value"]] = False
+            for column in change["columns"]:
+                if column["name"] == primary_key:
+                    changed[column["value"]] = True
+            rows += 1
+        elif action == "D":
+            for column in change["identity"]:
+                if column["name"] == primary_key:
+                    changed[column["value"]] = False
+            rows += 1
+        elif action == "C":
+            # the slot is only ever moved to the end of a transaction
+            lsn = change_lsn
+            if "timestamp" in change:
+                commit_time = pd.Timestamp(change["timestamp"])
+                first_commit = first_commit or commit_time
+                if commit_time - first_commit >= timedelta(seconds=max_seconds):
+                    break
+            if rows >= max_changes:
+                break
+
+    # the rows as they are now, so they have the same types as a normal pull
+    upserted = [key for key, exists in changed.items() if exists]
+    frames = []
+    where = create_where_clause(table_object, source, no_where=True)
+    if where != "":
+        where = f" AND ({where})"
+    for start in range(0, len(upserted), CHANGE_LOOKUP_SIZE):
+        keys = ", ".join(
+            sql_literal(key) for key in upserted[start : start + CHANGE_LOOKUP_SIZE]
+        )
+        frames.append(
+            read_sql(
+                f"""
+                SELECT "{'", "'.join(table_object['relevant_columns'])}"
+                FROM {table_name}
+                WHERE "{primary_key}" IN ({keys}) {where};
+                """,
+                source,
+            )
+        )
+    updated_rows = (
+        pd.concat(frames, ignore_index=True)
+        if frames
+        else pd.DataFrame(columns=table_object["relevant_columns"])
+    )
+    deleted_rows = pd.DataFrame(
+        {primary_key: [key for key, exists in changed.items() if not exists]}
+    )
+    return updated_rows, deleted_rows, lsn
 
 
 def create_where_clause(table_object, source, no_where=False):
+    if table_object.get("sync_plan") is not None:
+        # compiled once per table config by sync_plan.plan_for
+        return table_object["sync_plan"].where_clause(no_where)
     sql = ""
     first = True
     logical_operators = {"and": "and", "or": "or"}
@@ -181,6 +462,18 @@ def create_where_clause(table_object, source, no_where=False):
     return sql
 
 
+def quote(identifier):
+    """quote a column name"""
+    return f'"{identifier}"'
+
+
+def sql_literal(value):
+    """format a python value as a sql literal"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return f"E'{sql_escape(str(value))}'"
+
+
 def sql_escape(s):
     """escape single quotes and backslashes so you can put anything in a string"""
     return s.replace("\\", "\\\\").replace("'", "''")
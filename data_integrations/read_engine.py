@@ -0,0 +1,215 @@
+"""
+Reads query results for the SQL integrations.
+
+Queries run through connectorx, which reads the rows straight into Arrow,
+when the source's driver is one it supports, and through pd.read_sql on the
+source's SQLAlchemy engine otherwise. Either way the result has the dtypes
+pd.read_sql would give it, so the rest of the sync doesn't see which engine
+was used.
+
+A source whose query fails in connectorx because of a column type or a
+connection option connectorx doesn't handle, or because connectorx can't
+connect to it, is read with SQLAlchemy. If SQLAlchemy reads it, it's read
+with SQLAlchemy from then on, in this process, whatever copy of the source
+dict the query comes with, since the source's driver can reach it with
+TLS or auth settings connectorx doesn't take. Other connectorx errors are
+raised like SQLAlchemy's would be.
+source["read_engine"] can also be set to "sqlalchemy" to never use
+connectorx for a source.
+
+Queries run inside a deadline get the time left as a server side timeout,
+so a hung query fails instead of holding its thread: statement_timeout on
+PostgreSQL, a MAX_EXECUTION_TIME hint on MySQL, and the ODBC query timeout
+on SQL Server. SQL Server has no timeout connectorx can pass, so queries
+with a deadline are read through SQLAlchemy there.
+"""
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Literal
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import pandas as pd
+import pyarrow as pa
+
+from functions import log
+
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+
+# SQLAlchemy dialects connectorx can read, and the scheme it knows them by
+CONNECTORX_SCHEMES = {
+    "postgresql": "postgresql",
+    "postgres": "postgresql",
+    "mysql": "mysql",
+    "mssql": "mssql",
+}
+
+# connectorx errors, or panics, for column types and connection options it doesn't handle
+UNSUPPORTED_BY_CONNECTORX = re.compile(
+    r"not implemented|not supported|unsupported|no conversion rule"
+    r"|unknown option|invalid connection option|unknown connection url parameter",
+    re.IGNORECASE,
+)
+
+# connectorx errors for a connection it couldn't make, or authenticate
+CONNECTORX_CONNECT_FAILED = re.compile(
+    r"connect|tls|ssl|certificate|handshake|auth|login failed|access denied"
+    r"|password",
+    re.IGNORECASE,
+)
+
+_local = threading.local()
+# creds_uri of the sources connectorx can't read
+_sqlalchemy_sources: set[str] = set()
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextmanager
+def deadline(at: float | None) -> Iterator[None]:
+    """Gives the queries run in this thread until the time at, or no limit if it's None"""
+    previous = getattr(_local, "deadline", None)
+    _local.deadline = at
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def statement_timeout_ms() -> int | None:
+    """Milliseconds left until this thread's deadline, None if it has none"""
+    at = getattr(_local, "deadline", None)
+    if at is None:
+        return None
+    left = at - time.time()
+    if left <= 0:
+        raise DeadlineExceeded("the sync job's deadline passed")
+    return max(1, int(left * 1000))
+
+
+def dialect(creds_uri: str | None) -> str | None:
+    if not creds_uri:
+        return None
+    # mssql+pyodbc -> mssql
+    return CONNECTORX_SCHEMES.get(urlsplit(creds_uri).scheme.split("+")[0])
+
+
+def connectorx_uri(creds_uri: str | None, timeout_ms: int | None = None) -> str | None:
+    """The connectorx uri for a SQLAlchemy uri, or None if connectorx can't read it"""
+    scheme = dialect(creds_uri)
+    if cx is None or scheme is None:
+        return None
+    if timeout_ms is not None and scheme == "mssql":
+        return None
+    parts = urlsplit(creds_uri)
+    # the query holds driver options like the odbc driver's path
+    query = ""
+    if timeout_ms is not None and scheme == "postgresql":
+        query = "options=" + quote(f"-c statement_timeout={timeout_ms}")
+    return urlunsplit((scheme, parts.netloc, parts.path, query, ""))
+
+
+def with_mysql_timeout(sql: str, timeout_ms: int) -> str:
+    """Adds a MAX_EXECUTION_TIME hint to a select"""
+    return re.sub(
+        r"^\s*select\b",
+        f"select /*+ MAX_EXECUTION_TIME({timeout_ms}) */",
+        sql,
+        count=1,
+        flags=re.IGNORECASE,
+    )
+
+
+def read_sql(
+    sql: str,
+    source: dict[str, Any],
+    return_type: Literal["pandas", "arrow"] = "pandas",
+) -> pd.DataFrame | pa.Table:
+    """Runs a query on a source and returns the rows as a dataframe or Arrow table"""
+    timeout_ms = statement_timeout_ms()
+    if timeout_ms is not None and dialect(source.get("creds_uri")) == "mysql":
+        sql = with_mysql_timeout(sql, timeout_ms)
+    uri = connectorx_uri(source.get("creds_uri"), timeout_ms)
+    if (
+        uri is None
+        or source.get("read_engine", "connectorx") != "connectorx"
+        or source["creds_uri"] in _sqlalchemy_sources
+    ):
+        return read_sql_sqlalchemy(sql, source, return_type)
+
+    try:
+        table = cx.read_sql(uri, sql, return_type="arrow")
+    except BaseException as e:
+        # connectorx panics on some types it can't read, which aren't Exceptions
+        if not (unsupported_by_connectorx(e) or connectorx_connect_failed(e)):
+            raise
+        # a query that fails in sqlalchemy too is raised from here, so a
+        # source neither can reach is tried with connectorx again next time
+        result = read_sql_sqlalchemy(sql, source, return_type)
+        log(
+            f"connectorx can't read {source.get('source_name', 'a source')},",
+            f"reading it with sqlalchemy from now on: {e}",
+        )
+        _sqlalchemy_sources.add(source["creds_uri"])
+        return result
+    if return_type == "arrow":
+        return table
+    return arrow_to_pandas(table)
+
+
+def unsupported_by_connectorx(e: BaseException) -> bool:
+    """Whether connectorx failed on something SQLAlchemy could read instead"""
+    return (
+        isinstance(e, RuntimeError) or type(e).__name__ == "PanicException"
+    ) and UNSUPPORTED_BY_CONNECTORX.search(str(e)) is not None
+
+
+def connectorx_connect_failed(e: BaseException) -> bool:
+    """Whether connectorx failed to connect, which the source's own driver may not"""
+    return (
+        isinstance(e, RuntimeError) or type(e).__name__ == "PanicException"
+    ) and CONNECTORX_CONNECT_FAILED.search(str(e)) is not None
+
+
+def read_sql_sqlalchemy(
+    sql: str, source: dict[str, Any], return_type: str
+) -> pd.DataFrame | pa.Table:
+    timeout_ms = statement_timeout_ms()
+    engine = dialect(source.get("creds_uri"))
+    if timeout_ms is None or engine not in ("postgresql", "mssql"):
+        # mysql's timeout is a hint in the sql
+        df = pd.read_sql(sql, source["conn"])
+    else:
+        with source["conn"].connect() as conn, conn.begin():
+            if engine == "postgresql":
+                # only lasts until the end of the transaction
+                conn.exec_driver_sql(f"set local statement_timeout = {timeout_ms}")
+            else:
+                # pyodbc's query timeout, in whole seconds
+                conn.connection.dbapi_connection.timeout = -(-timeout_ms // 1000)
+            df = pd.read_sql(sql, conn)
+    if return_type == "arrow":
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return df
+
+
+def arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """
+    Converts a connectorx result to a dataframe with pd.read_sql's dtypes.
+    Integer columns with nulls become float64, dates, times and decimals
+    stay python objects and datetimes are in nanoseconds.
+    """
+    df = table.to_pandas(date_as_object=True)
+    for index, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            if dtype.unit != "ns":
+                df.isetitem(index, df.iloc[:, index].dt.as_unit("ns"))
+        elif dtype.kind == "M" and dtype != "datetime64[ns]":
+            df.isetitem(index, df.iloc[:, index].astype("datetime64[ns]"))
+    return df
@@ -1,5 +1,8 @@
 """
 The abstract base class for all data integrations.
+
+SQL integrations read rows with data_integrations.read_engine.read_sql,
+which uses connectorx when it can, instead of pd.read_sql.
 """
 from abc import ABC, abstractmethod
 from typing import Any
@@ -99,46 +102,52 @@ class IntegrationSyncFunctions(ABC):
         source: dict[str, Any],
         batch_pull_size: int,
     ) -> pd.DataFrame:
-        """This function is for crawling through older database rows"""
-        # ordering_key, relevant_columns, table_name = table_object['last_update'],table_object['relevant_columns'],table_object['table_name']
+        """
+        This function is for crawling through older database rows.
+        Pages are pulled with a keyset cursor on (ordering key, primary key)
+        that's kept in table_object['crawler_cursor'] instead of an OFFSET.
+        """
+        # relevant_columns, table_name = table_object['relevant_columns'], table_object['table_name']
+        # # functions.crawler_keyset builds the condition from the cursor
+        # condition, order_by = crawler_keyset(table_object, quote, sql_literal)
         # #example of sql that would be used
         # sql = f"""
-        #     SELECT {','.join(relevant_columns)}
+        #     SELECT {','.join(crawler_columns(table_object))}
         #     FROM {table_name}
-        #     ORDER BY `{ordering_key}` DESC
-        #     LIMIT {batch_pull_size} OFFSET {batch_pull_size*table_object['crawler_step']};
+        #     WHERE {condition}
+        #     ORDER BY {order_by}
+        #     LIMIT {batch_pull_size};
         # """
 
-        # new_rows_df = pd.read_sql(sql, source['conn'])
+        # new_rows_df = read_sql(sql, source)
 
-        # # update the crawler step on the sync_agent memory and in the message to be sent to the slave_driver
-        # if len(new_rows_df) < batch_pull_size:
-        #     message['crawler_step_info'] = 'completed'
-        #     table_object['crawler_step_info'] = 'completed'
-        # return new_rows_df
+        # # move the cursor on the sync_agent memory and in the message to be sent to the slave_driver
+        # # and mark the crawl completed once every row has been pulled
+        # advance_crawler_cursor(new_rows_df, table_object, message, batch_pull_size)
+        # return new_rows_df[relevant_columns]
 
     @abstractmethod
     def get_updated_rows(
         self, table_object: dict[str, Any], source: dict[str, Any]
     ) -> pd.DataFrame:
-        """This function returns new rows from a table based on the ordering column"""
-        # ordering_key, relevant_columns, last_pulled_update, table_name = table_object['last_update'], table_object['relevant_columns'],table_object['last_update_value'], table_object['table_name']
-        # sql example
-        # also try to support any type of ordering key ex. number, datetime, string
-        # try:
-        #     float(last_pulled_update)
-        #     sql = f"""
-        #         SELECT {','.join(relevant_columns)}
-        #         FROM {table_name}
-        #         WHERE {ordering_key} > {last_pulled_update}
-        #         """
-        # except:
-        #     sql = f"""
-        #         SELECT {','.join(relevant_columns)}
-        #         FROM {table_name}
-        #         WHERE {ordering_key} > '{last_pulled_update}'
-        #         """
-        # return pd.read_sql(sql, source['conn'])
+        """
+        This function returns new rows from a table based on the ordering column.
+        Rows are returned after table_object['last_update_pk'] on
+        (ordering key, primary key) and ordered by them, so rows sharing the
+        last ordering key value aren't pulled twice.
+        """
+        # relevant_columns, table_name = table_object['relevant_columns'], table_object['table_name']
+        # # functions.updated_rows_keyset builds the condition from the last update value and primary key,
+        # # and supports any type of ordering key ex. number, datetime, string
+        # condition, order_by = updated_rows_keyset(table_object, quote, sql_literal)
+        # #example of sql that would be used
+        # sql = f"""
+        #     SELECT {','.join(relevant_columns)}
+        #     FROM {table_name}
+        #     WHERE {condition}
+        #     ORDER BY {order_by}
+        #     """
+        # return read_sql(sql, source)
 
     @abstractmethod
     def get_primary_keys(
@@ -156,8 +165,98 @@ class IntegrationSyncFunctions(ABC):
         #     ORDER BY `{ordering_key}` DESC
         #     LIMIT {number_of_rows};
         # """
+        # return read_sql(sql, source)
+
+    def get_key_range(
+        self,
+        table_object: dict[str, Any],
+        source: dict[str, Any],
+        column: str,
+        row_limit: int,
+    ) -> pd.DataFrame:
+        """
+        Optional. This function returns the min_value, max_value and row_count of
+        the newest row_limit non null values of a column. It's used to split a big
+        table's initial load into ranges that are pulled in parallel.
+        """
+        # sql example
+        # sql = f"""
+        #     SELECT MIN(`{column}`) AS min_value, MAX(`{column}`) AS max_value, COUNT(*) AS row_count
+        #     FROM (
+        #         SELECT `{column}` FROM {table_object['table_name']}
+        #         WHERE `{column}` IS NOT NULL
+        #         ORDER BY `{column}` DESC
+        #         LIMIT {row_limit}
+        #     ) AS newest_rows;
+        # """
+        # return pd.read_sql(sql, source['conn'])
+
+    def get_key_checksums(
+        self,
+        table_object: dict[str, Any],
+        source: dict[str, Any],
+        bucket_width: int,
+        key_ranges: list[list] | None = None,
+    ) -> pd.DataFrame:
+        """
+        Optional. This function returns the bucket, row_count and checksum (a sum of
+        hashes) of the numeric primary keys grouped into buckets of bucket_width keys,
+        optionally limited to a list of [lower, upper) key ranges. Together with
+        get_primary_keys_in_ranges it lets big tables check for deleted rows by
+        comparing checksums instead of sending every primary key.
+        """
+        # sql example
+        # sql = f"""
+        #     SELECT FLOOR(`{primary_key}` / {bucket_width}) AS bucket, COUNT(*) AS row_count,
+        #         SUM(CRC32(`{primary_key}`)) AS checksum
+        #     FROM {table_object['table_name']}
+        #     WHERE `{primary_key}` IS NOT NULL
+        #     GROUP BY FLOOR(`{primary_key}` / {bucket_width});
+        # """
         # return pd.read_sql(sql, source['conn'])
 
+    def get_primary_keys_in_ranges(
+        self,
+        table_object: dict[str, Any],
+        source: dict[str, Any],
+        key_ranges: list[list],
+    ) -> pd.DataFrame:
+        """Optional. This function returns every primary key in a list of [lower, upper) ranges"""
+        # sql example
+        # sql = f"""
+        #     SELECT `{primary_key}`
+        #     FROM {table_object['table_name']}
+        #     WHERE (`{primary_key}` >= {lower} AND `{primary_key}` < {upper}) OR ...;
+        # """
+        # return read_sql(sql, source)
+
+    def create_replication_slot(self, source: dict[str, Any], table_uuid: str) -> bool:
+        """
+        Optional, along with get_changes and drop_replication_slot, for tables
+        with change_capture set to "logical". This function creates the
+        table's replication slot if it doesn't exist and returns whether it
+        had to. It raises if the server has no slot left for it.
+        """
+
+    def get_changes(
+        self,
+        table_object: dict[str, Any],
+        source: dict[str, Any],
+        table_uuid: str,
+        confirmed_lsn: str | None,
+        max_changes: int,
+        max_seconds: float,
+    ) -> tuple[pd.DataFrame, pd.DataFrame, str | None]:
+        """
+        Optional. This function moves the table's replication slot up to
+        confirmed_lsn and returns the rows changed after it: the inserted and
+        updated rows as they are now, the primary keys of the deleted rows,
+        and the position to confirm once they've been sent to the server.
+        """
+
+    def drop_replication_slot(self, source: dict[str, Any], table_uuid: str) -> None:
+        """Optional. This function drops the table's replication slot"""
+
     @abstractmethod
     def initial_pull(
         self, table_object: dict[str, Any], source: dict[str, Any], batch_pull_size: int
@@ -170,4 +269,4 @@ class IntegrationSyncFunctions(ABC):
         #     ORDER BY `{table_object['last_update']}` DESC
         #     LIMIT {batch_pull_size};
         # """
-        # return pd.read_sql(sql, source['conn'])
+        # return read_sql(sql, source)
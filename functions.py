@@ -10,8 +10,17 @@ from datetime import datetime
 from inspect import getframeinfo, stack
 from typing import Type, get_args, get_origin
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pandas.api.types import infer_dtype
 from pydantic import BaseModel
+from pytz import AmbiguousTimeError
+
+try:
+    import polars as pl
+except ImportError:
+    pl = None
 
 
 def log(*args):
@@ -47,46 +56,333 @@ def log_error(e: Exception, reraise=False):
         raise Exception(e)
 
 
-def df_to_dict(df: pd.DataFrame, table_object: dict | None = None) -> dict:
-    """convert df to dict for json serialization"""
-    # Covert all object columns to string
-    for col in df.select_dtypes(include=["object"]).columns:
-        col = str(col)
-        # Convert where value is not null
-        df.loc[df[col].notnull(), col] = df.loc[df[col].notnull(), col].astype(str)
-
-    # Convert tz-naive datetime columns to UTC or user specified timezone
-    if table_object is not None:
-        for col, dtype in zip(df.columns, df.dtypes):
-            if str(dtype) == "datetime64[ns]":
-                if (
-                    table_object["column_timezones"] is not None
-                    and col in table_object["column_timezones"]
-                ):
-                    df[col] = df[col].dt.tz_localize(
-                        table_object["column_timezones"][col],
-                        ambiguous="infer",
-                        nonexistent="shift_backward",
-                    )
-                else:
-                    df[col] = df[col].dt.tz_localize(
-                        "UTC", ambiguous="infer", nonexistent="shift_backward"
-                    )
+def df_to_dict(
+    df: pd.DataFrame,
+    table_object: dict | None = None,
+    binary: bool = False,
+    engine: str = "pandas",
+) -> dict:
+    """
+    convert df to dict for json serialization. With binary the values are
+    an Arrow IPC stream under "arrow" instead of a json string under "values",
+    to be sent as a binary websocket frame. With engine="polars" the datetime
+    columns of json values are converted by polars_datetime_strings
+    """
+    column_timezones = (table_object or {}).get("column_timezones") or {}
+    polars_columns = {}
+    if engine == "polars" and pl is not None and not binary:
+        polars_columns = polars_datetime_strings(df, table_object)
+    encoded_columns = []
+    dtypes = []
+    for index, dtype in enumerate(df.dtypes):
+        column = df.iloc[:, index]
+        if index in polars_columns:
+            # already formatted for json, keeping the dtype pandas would localize to
+            column, dtype = polars_columns[index]
+        elif dtype == object:
+            # Convert all object columns to string, where the value is not null
+            column = stringify_column(column)
+            dtype = column.dtype
+        elif table_object is not None and str(dtype) == "datetime64[ns]":
+            # Convert tz-naive datetime columns to UTC or user specified timezone
+            column = localize_column(
+                column, column_timezones.get(df.columns[index], "UTC")
+            )
+            dtype = column.dtype
+        encoded_columns.append(column)
+        dtypes.append(str(dtype))
+    # the columns that didn't need converting are shared with the caller's frame,
+    # which is left untouched
+    if encoded_columns:
+        df = pd.concat(encoded_columns, axis=1, copy=False).set_axis(df.columns, axis=1)
 
     df_dict = {
-        "values": df.to_json(
-            orient="values",
-            date_format="iso",
-            default_handler=str,
-            date_unit="s",
-        ),
         "columns": df.columns.tolist(),
-        "dtypes": list(df.dtypes.astype(str)),
+        "dtypes": dtypes,
     }
+    if binary:
+        try:
+            df_dict["arrow"] = df_to_arrow(df)
+            return df_dict
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+            log("can't convert the rows to arrow, sending them as json: ", e)
 
+    # to_json turns tz-aware datetimes into Timestamp objects one by one,
+    # formatting them up front is much faster and writes the same strings
+    json_df = df
+    for index, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            if json_df is df:
+                json_df = df.copy(deep=False)
+            json_df.isetitem(index, iso_datetime_strings(df.iloc[:, index]))
+    df_dict["values"] = json_df.to_json(
+        orient="values",
+        date_format="iso",
+        default_handler=str,
+        date_unit="s",
+    )
     return df_dict
 
 
+def stringify_column(column: pd.Series) -> pd.Series:
+    """Converts the non null values of an object column to strings"""
+    if infer_dtype(column, skipna=True) in ("string", "empty"):
+        return column
+    values = column.to_numpy(dtype=object, copy=True)
+    not_null = pd.notna(values)
+    values[not_null] = pd.Series(values[not_null], dtype=object).astype(str).values
+    return pd.Series(values, index=column.index, name=column.name, dtype=object)
+
+
+def localize_column(column: pd.Series, timezone: str) -> pd.Series:
+    """Localizes a tz-naive datetime column, inferring ambiguous times only if there are any"""
+    if timezone == "UTC":
+        return column.dt.tz_localize("UTC")
+    try:
+        return column.dt.tz_localize(
+            timezone, ambiguous="raise", nonexistent="shift_backward"
+        )
+    except AmbiguousTimeError:
+        return column.dt.tz_localize(
+            timezone, ambiguous="infer", nonexistent="shift_backward"
+        )
+
+
+def iso_datetime_strings(column: pd.Series) -> pd.Series:
+    """Formats a tz-aware datetime column like to_json does, in UTC to the second"""
+    values = column.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()
+    strings = np.datetime_as_string(values.astype("datetime64[s]"), unit="s")
+    strings = np.char.add(strings, "Z").astype(object)
+    strings[np.isnat(values)] = None
+    return pd.Series(strings, index=column.index, name=column.name, dtype=object)
+
+
+def polars_datetime_strings(
+    df: pd.DataFrame, table_object: dict | None
+) -> dict[int, tuple[pd.Series, pd.DatetimeTZDtype]]:
+    """
+    Does what df_to_dict does to the datetime columns of a frame, localizing
+    tz-naive ones and formatting them like iso_datetime_strings, in one lazy
+    polars query that runs on every column at once. Returns the formatted
+    columns and the dtype pandas would've localized them to, by position.
+    Columns in a timezone other than UTC are localized by localize_column
+    first, polars' timezone rules differ from pandas' for old dates and
+    some zones' history.
+    """
+    column_timezones = (table_object or {}).get("column_timezones") or {}
+    columns = {}
+    expressions = {}
+    dtypes = {}
+    for index, dtype in enumerate(df.dtypes):
+        name = f"column_{index}"
+        column = df.iloc[:, index]
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            expression = pl.col(name)
+        elif table_object is not None and str(dtype) == "datetime64[ns]":
+            timezone = column_timezones.get(df.columns[index], "UTC")
+            if timezone == "UTC":
+                expression = pl.col(name).dt.replace_time_zone("UTC")
+                dtype = pd.DatetimeTZDtype("ns", "UTC")
+            else:
+                column = localize_column(column, timezone)
+                expression = pl.col(name)
+                dtype = column.dtype
+        else:
+            continue
+        dtypes[index] = dtype
+        columns[index] = column.set_axis(range(len(column))).rename(name)
+        expressions[index] = (
+            expression.dt.convert_time_zone("UTC")
+            .dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+            .alias(name)
+        )
+    if not expressions:
+        return {}
+
+    frame = pl.from_pandas(pd.concat(columns.values(), axis=1, copy=False)).lazy()
+    results = frame.select(list(expressions.values())).collect().get_columns()
+    return {
+        index: (
+            pd.Series(
+                result.to_numpy(), index=df.index, name=df.columns[index], dtype=object
+            ),
+            dtypes[index],
+        )
+        for index, result in zip(expressions, results)
+    }
+
+
+def df_to_arrow(df: pd.DataFrame) -> bytes:
+    """Encodes a dataframe as a zstd compressed Arrow IPC stream"""
+    table = pa.Table.from_pandas(
+        df.set_axis([str(column) for column in df.columns], axis=1),
+        preserve_index=False,
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(
+        sink, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+    ) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def json_safe_value(value):
+    """Converts numpy and pandas scalars to values that can be json serialized"""
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        # numpy scalars
+        return value.item()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def crawler_columns(table_object: dict) -> list[str]:
+    """The relevant columns plus the keys the crawler cursor is built from"""
+    return table_object["relevant_columns"] + [
+        key
+        for key in (table_object["last_update"], table_object["primary_key"])
+        if key not in table_object["relevant_columns"]
+    ]
+
+
+def crawler_keyset(table_object: dict, quote, literal) -> tuple[str, str]:
+    """
+    Builds the where condition and order by for the next page of old rows.
+    Rows are crawled newest first on (ordering key, primary key) so every page
+    is an index seek past the crawler cursor instead of a growing OFFSET.
+    Rows with a null ordering key are crawled last, by primary key.
+    quote and literal are the integration's identifier and value formatters.
+    """
+    ordering_key = quote(table_object["last_update"])
+    primary_key = quote(table_object["primary_key"])
+    cursor = table_object.get("crawler_cursor")
+
+    if cursor is not None and cursor["last_update"] is None:
+        condition = f"{ordering_key} IS NULL"
+        if cursor["primary_key"] is not None:
+            condition += f" AND {primary_key} < {literal(cursor['primary_key'])}"
+        return (
+            condition + crawler_range_condition(table_object, quote, literal, True),
+            f"{primary_key} DESC",
+        )
+
+    condition = f"{ordering_key} IS NOT NULL"
+    if cursor is not None:
+        last_update = literal(cursor["last_update"])
+        condition += (
+            f" AND {ordering_key} <= {last_update}"
+            f" AND ({ordering_key} < {last_update}"
+            f" OR {primary_key} < {literal(cursor['primary_key'])})"
+        )
+    return (
+        condition + crawler_range_condition(table_object, quote, literal, False),
+        f"{ordering_key} DESC, {primary_key} DESC",
+    )
+
+
+def crawler_range_condition(
+    table_object: dict, quote, literal, null_ordering_keys: bool
+) -> str:
+    """
+    Limits the crawl to table_object['crawler_range'] when a big table's
+    initial load is split into ranges. A missing bound is open ended, and
+    when ranges are split on the ordering key only the lowest one crawls
+    the rows with a null ordering key.
+    """
+    crawler_range = table_object.get("crawler_range")
+    if crawler_range is None:
+        return ""
+    if (
+        null_ordering_keys
+        and crawler_range["column"] == table_object["last_update"]
+        and crawler_range["lower"] is None
+    ):
+        return ""
+
+    column = quote(crawler_range["column"])
+    condition = ""
+    if crawler_range["lower"] is not None:
+        condition += f" AND {column} >= {literal(crawler_range['lower'])}"
+    if crawler_range["upper"] is not None:
+        condition += f" AND {column} < {literal(crawler_range['upper'])}"
+    return condition
+
+
+def updated_rows_keyset(table_object: dict, quote, literal) -> tuple[str, str]:
+    """
+    Builds the where condition and order by for rows updated since the last
+    pull. When the last pull ended part way through rows sharing an ordering
+    key, table_object['last_update_pk'] is the primary key of the last row
+    pulled, and only the rows after it on (ordering key, primary key) match.
+    quote and literal are the integration's identifier and value formatters.
+    """
+    ordering_key = quote(table_object["last_update"])
+    last_update = table_object["last_update_value"]
+    try:
+        # numbers, and numbers stored as strings, aren't quoted
+        float(last_update)
+        last_update = str(last_update)
+    except (TypeError, ValueError):
+        last_update = literal(last_update)
+
+    condition = f"{ordering_key} > {last_update}"
+    if not table_object.get("primary_key"):
+        return condition, ordering_key
+
+    primary_key = quote(table_object["primary_key"])
+    if table_object.get("last_update_pk") is not None:
+        condition = (
+            f"({condition} OR ({ordering_key} = {last_update}"
+            f" AND {primary_key} > {literal(table_object['last_update_pk'])}))"
+        )
+    return condition, f"{ordering_key}, {primary_key}"
+
+
+def key_range_condition(column: str, key_ranges: list[list]) -> str:
+    """Matches the rows whose column is in any of the [lower, upper) ranges"""
+    return " OR ".join(
+        f"({column} >= {lower} AND {column} < {upper})" for lower, upper in key_ranges
+    )
+
+
+def crawler_cursor_after(df: pd.DataFrame, table_object: dict) -> dict | None:
+    """The crawler cursor for the last row of df, None if it's empty"""
+    if len(df) == 0:
+        return None
+    last_row = df.iloc[-1]
+    return {
+        "last_update": json_safe_value(last_row[table_object["last_update"]]),
+        "primary_key": json_safe_value(last_row[table_object["primary_key"]]),
+    }
+
+
+def advance_crawler_cursor(
+    df: pd.DataFrame, table_object: dict, message: dict, batch_pull_size: int
+):
+    """
+    Moves the crawler cursor past the last row of a page pulled with
+    crawler_keyset and marks the crawl completed once the rows with
+    a null ordering key have been crawled too.
+    """
+    previous_cursor = table_object.get("crawler_cursor")
+    cursor = crawler_cursor_after(df, table_object) or previous_cursor
+
+    if len(df) < batch_pull_size:
+        if previous_cursor is None or previous_cursor["last_update"] is not None:
+            # all the rows with an ordering key have been pulled
+            cursor = {"last_update": None, "primary_key": None}
+        else:
+            message["crawler_step_info"] = "completed"
+            table_object["crawler_step_info"] = "completed"
+
+    table_object["crawler_cursor"] = cursor
+    message["crawler_cursor"] = cursor
+
+
 def check_if_contains_pydantic(field_annotation: Type):
     """Recursively checks if a given type contains a pydantic model"""
 
@@ -0,0 +1,447 @@
+"""
+Helpers for sending big table data to the Resplendent data-ingest endpoint.
+
+Payloads are encoded a chunk of rows at a time and handed to requests as a
+generator, so they are sent with chunked transfer encoding instead of being
+written to a temp file and read back into memory.
+
+Tables can opt into a columnar payload format (Arrow IPC stream or Parquet,
+both zstd compressed) with their ingest_format setting. The format is sent
+in the Payload-Format header and if the server answers 415 the payload is
+sent again in the legacy csv/feather format.
+
+Payloads are posted with a shared IngestClient, which keeps connections to
+the endpoint alive, can compress csv bodies with gzip or zstd and retries
+posts that never reached the server. Tables whose ingest_idempotency_keys
+setting says the server drops repeats of a payload by its Idempotency-Key
+header get one on every payload, and those are retried after any failure.
+"""
+import random
+import threading
+import time
+import uuid
+import zlib
+from typing import Callable, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from functions import log
+
+# Number of rows encoded per chunk of a streamed payload
+STREAM_CHUNK_ROWS = 50000
+
+COLUMNAR_FORMATS = ("arrow", "parquet")
+
+# The format each message type is sent in when a columnar format isn't used
+LEGACY_FORMATS = {
+    "table_metadata": "feather",
+    "initial_table_data": "csv",
+    "update_table_data": "csv",
+    "check_for_deleted_rows": "feather",
+    "check_for_deleted_rows_in_ranges": "feather",
+}
+
+CONTENT_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "feather": "application/vnd.apache.arrow.file",
+    "csv": "text/csv",
+}
+
+# Request body compression for payload formats that aren't compressed already
+CONTENT_ENCODINGS = ("gzip", "zstd")
+UNCOMPRESSED_FORMATS = ("csv",)
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+# Responses that are worth sending an idempotent payload again for
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class ChunkSink:
+    """
+    A write-only file-like object that buffers whatever is written to it
+    until the buffered bytes are drained by the generator streaming them.
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def csv_chunks(
+    df: pd.DataFrame, chunk_rows: int = STREAM_CHUNK_ROWS
+) -> Iterator[bytes]:
+    """Encodes the dataframe as headerless csv, chunk_rows rows at a time"""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start : start + chunk_rows].to_csv(
+            header=False, na_rep="\\N", index=False
+        ).encode("utf-8")
+
+
+def arrow_table_chunks(
+    df: pd.DataFrame,
+    schema: pa.Schema,
+    open_writer: Callable,
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+) -> Iterator[bytes]:
+    """
+    Encodes the dataframe with an Arrow based writer, only converting
+    one chunk of rows to Arrow at a time. open_writer gets the sink and the
+    schema and returns a writer with write_table and close methods.
+    """
+    sink = ChunkSink()
+    writer = open_writer(pa.PythonFile(sink, mode="w"), schema)
+    for start in range(0, len(df), chunk_rows):
+        writer.write_table(
+            pa.Table.from_pandas(
+                df.iloc[start : start + chunk_rows],
+                schema=schema,
+                preserve_index=False,
+            )
+        )
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def feather_chunks(
+    df: pd.DataFrame,
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+    schema: pa.Schema | None = None,
+) -> Iterator[bytes]:
+    """Encodes the dataframe as a feather (Arrow IPC file) payload"""
+    return arrow_table_chunks(
+        df,
+        schema or pa.Schema.from_pandas(df, preserve_index=False),
+        lambda sink, schema: pa.ipc.new_file(
+            sink, schema, options=pa.ipc.IpcWriteOptions(compression="lz4")
+        ),
+        chunk_rows,
+    )
+
+
+def arrow_stream_chunks(
+    df: pd.DataFrame,
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+    schema: pa.Schema | None = None,
+) -> Iterator[bytes]:
+    """Encodes the dataframe as a zstd compressed Arrow IPC stream"""
+    return arrow_table_chunks(
+        df,
+        schema or pa.Schema.from_pandas(df, preserve_index=False),
+        lambda sink, schema: pa.ipc.new_stream(
+            sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+        ),
+        chunk_rows,
+    )
+
+
+def parquet_chunks(
+    df: pd.DataFrame,
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+    schema: pa.Schema | None = None,
+) -> Iterator[bytes]:
+    """Encodes the dataframe as zstd compressed Parquet, a row group per chunk"""
+    return arrow_table_chunks(
+        df,
+        schema or pa.Schema.from_pandas(df, preserve_index=False),
+        lambda sink, schema: pq.ParquetWriter(sink, schema, compression="zstd"),
+        chunk_rows,
+    )
+
+
+def encode_dataframe(
+    df: pd.DataFrame,
+    payload_format: str,
+    chunk_rows: int = STREAM_CHUNK_ROWS,
+    schema: pa.Schema | None = None,
+) -> Iterator[bytes]:
+    """Encodes the dataframe in the given payload format"""
+    if payload_format == "csv":
+        return csv_chunks(df, chunk_rows)
+    if payload_format == "feather":
+        return feather_chunks(df, chunk_rows, schema)
+    if payload_format == "arrow":
+        return arrow_stream_chunks(df, chunk_rows, schema)
+    if payload_format == "parquet":
+        return parquet_chunks(df, chunk_rows, schema)
+    raise ValueError(f"Unknown payload format: {payload_format}")
+
+
+def gzip_chunks(chunks: Iterator[bytes], level: int) -> Iterator[bytes]:
+    """Compresses a stream of chunks into a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def zstd_chunks(chunks: Iterator[bytes], level: int) -> Iterator[bytes]:
+    """Compresses each chunk into its own zstd frame, which decode as one stream"""
+    codec = pa.Codec("zstd", compression_level=level)
+    for chunk in chunks:
+        if chunk:
+            yield codec.compress(chunk, asbytes=True)
+
+
+def compress_chunks(
+    chunks: Iterator[bytes], encoding: str, level: int | None = None
+) -> Iterator[bytes]:
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[encoding]
+    if encoding == "gzip":
+        return gzip_chunks(chunks, level)
+    if encoding == "zstd":
+        return zstd_chunks(chunks, level)
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+def is_connect_error(e: requests.RequestException) -> bool:
+    """True if the request failed before any of it reached the server"""
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.exceptions.ConnectionError):
+        return False
+    # requests wraps urllib3's MaxRetryError, whose reason is the error it
+    # gave up on, a NewConnectionError (or NameResolutionError) if it never
+    # connected
+    error = e.args[0] if e.args else None
+    seen = set()
+    while isinstance(error, BaseException) and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, urllib3.exceptions.NewConnectionError):
+            return True
+        error = getattr(error, "reason", None) or error.__cause__
+    return False
+
+
+class IngestClient:
+    """
+    Posts payloads to the data-ingest endpoint over a pool of keep-alive
+    connections. Payloads with an Idempotency-Key header are sent again
+    when the connection drops or the server answers with a retryable
+    status, other payloads are only retried if they never reached the server.
+    Retries wait at most max_delay seconds, whatever Retry-After asks for.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 8,
+        retries: int = 3,
+        backoff: float = 1.0,
+        max_delay: float = 30.0,
+        timeout: tuple[int, int] = (10, 60),
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def retry_delay(self, attempt: int, response: requests.Response | None) -> float:
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            delay = float(response.headers["Retry-After"])
+        else:
+            delay = self.backoff * 2**attempt * (0.5 + random.random())
+        return min(delay, self.max_delay)
+
+    def post(
+        self,
+        url: str,
+        make_chunks: Callable[[], Iterator[bytes]],
+        headers: dict[str, str],
+        stream: bool = True,
+        compression: str | None = None,
+        compression_level: int | None = None,
+    ) -> tuple[requests.Response, int]:
+        """
+        Posts the chunks returned by make_chunks and returns the response and
+        the number of bytes sent. make_chunks is called again for each retry.
+        When stream is False the chunks are joined in memory first, for
+        servers that need a Content-Length header.
+        """
+        headers = dict(headers)
+        if compression:
+            headers["Content-Encoding"] = compression
+        idempotent = "Idempotency-Key" in headers
+        attempt = 0
+        while True:
+            bytes_sent = 0
+
+            def counted_chunks():
+                nonlocal bytes_sent
+                chunks = make_chunks()
+                if compression:
+                    chunks = compress_chunks(chunks, compression, compression_level)
+                for chunk in chunks:
+                    bytes_sent += len(chunk)
+                    yield chunk
+
+            body = counted_chunks() if stream else b"".join(counted_chunks())
+            try:
+                response = self.session.post(
+                    url, body, headers=headers, timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                if attempt >= self.retries or not (idempotent or is_connect_error(e)):
+                    raise
+                response = None
+                log(f"posting {headers.get('Message-Type')} failed, retrying: ", e)
+            else:
+                if (
+                    response.status_code not in RETRY_STATUSES
+                    or not idempotent
+                    or attempt >= self.retries
+                ):
+                    return response, bytes_sent
+                log(
+                    f"posting {headers.get('Message-Type')} got a ",
+                    f"{response.status_code}, retrying",
+                )
+            time.sleep(self.retry_delay(attempt, response))
+            attempt += 1
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def ingest_client() -> IngestClient:
+    """The client shared by every thread of this process"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = IngestClient()
+        return _client
+
+
+def post_payload(
+    url: str,
+    make_chunks: Callable[[], Iterator[bytes]],
+    headers: dict[str, str],
+    stream: bool = True,
+    compression: str | None = None,
+    compression_level: int | None = None,
+    idempotency_keys: bool = False,
+) -> tuple[requests.Response, int]:
+    """
+    Posts a payload with the shared client and returns the response and the
+    number of bytes sent. With idempotency_keys, for servers that drop
+    repeats of a payload, it gets an Idempotency-Key so it's retried if the
+    post fails. compression only applies to payload formats that aren't
+    compressed already.
+    """
+    if idempotency_keys:
+        headers = {"Idempotency-Key": str(uuid.uuid4()), **headers}
+    if headers.get("Payload-Format") not in UNCOMPRESSED_FORMATS:
+        compression = None
+    return ingest_client().post(
+        url,
+        make_chunks,
+        headers,
+        stream=stream,
+        compression=compression,
+        compression_level=compression_level,
+    )
+
+
+def dataframe_payload(
+    df: pd.DataFrame, headers: dict[str, str], ingest_format: str = "csv"
+) -> tuple[Iterator[bytes], dict[str, str]]:
+    """
+    Returns the lazily encoded chunks and the headers for posting a dataframe.
+    Columnar ingest formats are used for every message type, otherwise the
+    message type's legacy format is used.
+    """
+    message_type = headers["Message-Type"]
+    payload_format = LEGACY_FORMATS[message_type]
+    schema = None
+    if ingest_format in COLUMNAR_FORMATS:
+        try:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            payload_format = ingest_format
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            log(f"can't send {message_type} as {ingest_format}, using csv: ", e)
+
+    return encode_dataframe(df, payload_format, schema=schema), {
+        **headers,
+        "Payload-Format": payload_format,
+        "Content-Type": CONTENT_TYPES[payload_format],
+    }
+
+
+def post_dataframe(
+    url: str,
+    df: pd.DataFrame,
+    headers: dict[str, str],
+    ingest_format: str = "csv",
+    stream: bool = True,
+    compression: str | None = None,
+    compression_level: int | None = None,
+    idempotency_keys: bool = False,
+) -> str:
+    """
+    Posts a dataframe to the data-ingest endpoint and raises if the server
+    doesn't accept it. Returns the ingest format to use for the rest of the
+    table's payloads, which is "csv" once the server has rejected a columnar one.
+    """
+    chunks, payload_headers = dataframe_payload(df, headers, ingest_format)
+    unsent = [chunks]
+
+    def make_chunks():
+        # retries encode the dataframe again
+        return (
+            unsent.pop() if unsent else dataframe_payload(df, headers, ingest_format)[0]
+        )
+
+    response, bytes_sent = post_payload(
+        url,
+        make_chunks,
+        payload_headers,
+        stream=stream,
+        compression=compression,
+        compression_level=compression_level,
+        idempotency_keys=idempotency_keys,
+    )
+    payload_format = payload_headers["Payload-Format"]
+    log(f"sent {bytes_sent} bytes of {headers['Message-Type']} as {payload_format}")
+
+    if response.status_code == 415 and payload_format in COLUMNAR_FORMATS:
+        log(f"server doesn't accept {payload_format} payloads, falling back to csv")
+        return post_dataframe(
+            url,
+            df,
+            headers,
+            "csv",
+            stream,
+            compression,
+            compression_level,
+            idempotency_keys,
+        )
+    response.raise_for_status()
+    return ingest_format
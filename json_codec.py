@@ -0,0 +1,117 @@
+"""
+JSON encoding for messages sent over and received from the websocket.
+
+python-rapidjson is used when it's installed, it's faster than the json
+module for the many small objects in a message and for parsing the long
+strings df_to_dict makes. Anything rapidjson can't encode, like dicts with
+non string keys, is encoded with the json module instead.
+
+Encoding holds the GIL, so running a big message through dumps in a thread
+still stalls the event loop. dumps_sliced escapes long strings a slice at a
+time instead, letting the loop run between the slices.
+"""
+import json
+import uuid
+from typing import Any, Callable
+
+from functions import log
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+# Messages bigger than this are encoded in an executor with dumps_sliced
+OFF_LOOP_BYTES = 1024 * 1024
+# Strings longer than this are escaped a slice at a time by dumps_sliced
+SLICE_CHARS = 256 * 1024
+
+BACKENDS: dict[str, tuple[Callable[[Any], str], Callable[[Any], Any]]] = {
+    "json": (json.dumps, json.loads),
+}
+if rapidjson is not None:
+    BACKENDS["rapidjson"] = (rapidjson.dumps, rapidjson.loads)
+
+backend = "rapidjson" if rapidjson is not None else "json"
+
+
+def use_backend(name: str):
+    """Picks the backend used by dumps and loads, falling back to json"""
+    global backend
+    if name not in BACKENDS:
+        log(f"json backend {name} isn't available, using json")
+        name = "json"
+    backend = name
+
+
+def dumps(obj: Any) -> str:
+    try:
+        return BACKENDS[backend][0](obj)
+    except TypeError:
+        if backend == "json":
+            raise
+        return json.dumps(obj)
+
+
+def loads(data: str | bytes) -> Any:
+    return BACKENDS[backend][1](data)
+
+
+def estimated_size(obj: Any, limit: int = OFF_LOOP_BYTES) -> int:
+    """
+    Roughly how long obj is once encoded, counting the strings in it and a
+    few characters for anything else. Bytes are left out as they're sent in
+    binary frames. Stops counting past limit.
+    """
+    size = 0
+    stack = [obj]
+    while stack and size <= limit:
+        item = stack.pop()
+        if isinstance(item, str):
+            size += len(item) + 2
+        elif isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+            size += 2
+        else:
+            size += 8
+    return size
+
+
+def dumps_sliced(obj: Any) -> str:
+    """
+    Same output as dumps, but strings longer than SLICE_CHARS are escaped
+    SLICE_CHARS at a time so the GIL is given up between slices.
+    """
+    long_strings: list[str] = []
+    marker = uuid.uuid4().hex
+
+    def swap(item):
+        if isinstance(item, dict):
+            return {key: swap(value) for key, value in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [swap(value) for value in item]
+        if isinstance(item, str) and len(item) > SLICE_CHARS:
+            long_strings.append(item)
+            return f"{marker}{len(long_strings) - 1}"
+        return item
+
+    skeleton = dumps(swap(obj))
+    if not long_strings:
+        return skeleton
+
+    pieces = []
+    position = 0
+    for index, string in enumerate(long_strings):
+        placeholder = dumps(f"{marker}{index}")
+        start = skeleton.index(placeholder, position)
+        pieces.append(skeleton[position:start])
+        pieces.append('"')
+        for offset in range(0, len(string), SLICE_CHARS):
+            pieces.append(dumps(string[offset : offset + SLICE_CHARS])[1:-1])
+        pieces.append('"')
+        position = start + len(placeholder)
+    pieces.append(skeleton[position:])
+    return "".join(pieces)
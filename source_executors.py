@@ -0,0 +1,192 @@
+"""
+Threads for running a source's queries, kept apart per source.
+
+Every source gets its own thread pool and is held to its
+max_parallel_queries table syncs at once, so a source with hundreds of
+tables queues behind itself instead of filling the loop's default
+executor, and a slow database only ties up its own threads. Jobs waiting
+for a slot are the source's queue depth, which depths returns along with
+the jobs running.
+
+Interactive requests from the web app, like table previews, run in the
+same lanes but have interactive_reserved slots of their own on top of
+the sync ones, and when they do have to wait they go ahead of every
+queued sync. Ones slower than interactive_latency_target are logged.
+
+A job cancelled while it runs keeps its slot until its thread returns.
+"""
+import asyncio
+import concurrent.futures
+import time
+from collections import deque
+from typing import Any, Callable
+
+from functions import log
+
+DEFAULT_MAX_PARALLEL_QUERIES = 4
+DEFAULT_INTERACTIVE_RESERVED = 1
+DEFAULT_INTERACTIVE_LATENCY_TARGET = 2
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+
+class SourceLane:
+    """
+    A source's thread pool with limit slots for background jobs and
+    reserved more that only interactive jobs can use
+    """
+
+    def __init__(self, source_uuid: str, limit: int, reserved: int):
+        self.limit = limit
+        self.reserved = reserved
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=limit + reserved,
+            thread_name_prefix=f"source-{source_uuid[:8]}",
+        )
+        self.waiting: dict[str, deque[asyncio.Future]] = {
+            INTERACTIVE: deque(),
+            BACKGROUND: deque(),
+        }
+        self.running = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.retired = False
+
+    @property
+    def queued(self) -> int:
+        return sum(
+            not waiter.done() for waiters in self.waiting.values() for waiter in waiters
+        )
+
+    def has_waiting(self, kind: str) -> bool:
+        return any(not waiter.done() for waiter in self.waiting[kind])
+
+    def idle(self) -> bool:
+        return self.queued == 0 and sum(self.running.values()) == 0
+
+    def has_slot(self, kind: str) -> bool:
+        if sum(self.running.values()) >= self.limit + self.reserved:
+            return False
+        return kind == INTERACTIVE or self.running[BACKGROUND] < self.limit
+
+    async def acquire(self, kind: str):
+        # background jobs don't skip interactive ones that are waiting
+        if not self.has_waiting(INTERACTIVE) and not (
+            kind == BACKGROUND and self.has_waiting(BACKGROUND)
+        ):
+            if self.has_slot(kind):
+                self.running[kind] += 1
+                return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiting[kind].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # it was given a slot just as it was cancelled
+                self.release(kind)
+            raise
+
+    def release(self, kind: str):
+        self.running[kind] -= 1
+        for waiting_kind in (INTERACTIVE, BACKGROUND):
+            waiters = self.waiting[waiting_kind]
+            while waiters and self.has_slot(waiting_kind):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.running[waiting_kind] += 1
+                    waiter.set_result(None)
+
+
+class SourceExecutors:
+    def __init__(
+        self,
+        default_limit: int = DEFAULT_MAX_PARALLEL_QUERIES,
+        interactive_reserved: int = DEFAULT_INTERACTIVE_RESERVED,
+        interactive_latency_target: float = DEFAULT_INTERACTIVE_LATENCY_TARGET,
+    ):
+        self.default_limit = default_limit
+        self.interactive_reserved = interactive_reserved
+        self.interactive_latency_target = interactive_latency_target
+        self.lanes: dict[str, SourceLane] = {}
+
+    def lane(self, source_uuid: str, source: dict[str, Any]) -> SourceLane:
+        """
+        Returns the source's lane, making a new one if its limit changed.
+        Jobs already in the old lane finish there and its threads are shut
+        down when it empties.
+        """
+        limit = max(1, int(source.get("max_parallel_queries") or self.default_limit))
+        lane = self.lanes.get(source_uuid)
+        if lane is None or lane.limit != limit:
+            if lane is not None:
+                self.retire(lane)
+            lane = self.lanes[source_uuid] = SourceLane(
+                source_uuid, limit, self.interactive_reserved
+            )
+        return lane
+
+    async def run(
+        self,
+        source_uuid: str,
+        source: dict[str, Any],
+        func: Callable,
+        *args,
+        interactive: bool = False,
+    ) -> Any:
+        """
+        Runs func(*args) in the source's threads once there's a slot for it.
+        Interactive jobs go ahead of background ones.
+        """
+        kind = INTERACTIVE if interactive else BACKGROUND
+        lane = self.lane(source_uuid, source)
+        then = time.time()
+        await lane.acquire(kind)
+        future = asyncio.get_running_loop().run_in_executor(lane.executor, func, *args)
+        left_running = False
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done():
+                # a thread can't be stopped, so the job keeps its slot until it
+                # returns, which its statement timeout should make it do soon
+                left_running = True
+                future.add_done_callback(
+                    lambda future: self.finished(lane, kind, future)
+                )
+            raise
+        finally:
+            if not left_running:
+                self.finished(lane, kind)
+            took = time.time() - then
+            if interactive and took > self.interactive_latency_target:
+                log(
+                    f"{getattr(func, '__name__', func)} for {source_uuid} took {took:.1f}s, ",
+                    f"over the {self.interactive_latency_target}s target",
+                )
+
+    def finished(
+        self, lane: SourceLane, kind: str, future: asyncio.Future | None = None
+    ):
+        if future is not None and not future.cancelled() and future.exception():
+            log(f"a cancelled job failed after its deadline: {future.exception()}")
+        lane.release(kind)
+        if lane.retired and lane.idle():
+            lane.executor.shutdown(wait=False)
+
+    def retire(self, lane: SourceLane):
+        lane.retired = True
+        if lane.idle():
+            lane.executor.shutdown(wait=False)
+
+    def forget(self, source_uuid: str):
+        """Drops a deleted source's lane once its jobs are done"""
+        lane = self.lanes.pop(source_uuid, None)
+        if lane is not None:
+            self.retire(lane)
+
+    def depths(self) -> dict[str, tuple[int, int, int]]:
+        """{source uuid: (jobs queued, jobs running, max_parallel_queries)}"""
+        return {
+            source_uuid: (lane.queued, sum(lane.running.values()), lane.limit)
+            for source_uuid, lane in self.lanes.items()
+        }
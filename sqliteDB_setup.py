@@ -1,8 +1,32 @@
+import json
 import sqlite3
 from sqlite3 import Error
+from threading import Lock
 import time
 import pandas as pd
 
+# Columns added to table_sync_info after it was first released.
+# They're added to existing databases by add_missing_columns.
+TABLE_SYNC_INFO_COLUMNS = [
+    "crawl_checkpoint",
+    "stage_timings",
+    "page_size",
+    "replication_lsn",
+    "crawler_cursor",
+]
+
+# Tables added after the first release, created by add_missing_tables
+NEW_TABLES = {
+    "key_checksums": "(table_uuid, bucket_width, bucket, row_count, checksum)",
+    "websocket_bytes": "(message_type primary key, frames, payload_bytes, wire_bytes)",
+    "source_queues": "(source_uuid primary key, queued, running, max_parallel_queries, last_update)",
+    "replication_slots": "(table_uuid primary key, source_uuid)",
+}
+
+# databases set up by this process
+_set_up: set[str] = set()
+_set_up_lock = Lock()
+
 
 def sql_escape(s):
     """escape single quotes and backslashes so you can put anything in a string"""
@@ -15,50 +39,10 @@ def create_connection(db_file, sql_to_run=None, return_values=False):
     """create a database connection to a SQLite database"""
     conn = None
     try:
+        setup_database(db_file)
         conn = sqlite3.connect(db_file)
         c = conn.cursor()
 
-        # Gets all tables
-        sql = """
-            SELECT name FROM sqlite_master WHERE type='table';
-            """
-        c.execute(sql)
-        available_tables = c.fetchall()
-
-        # If there aren't any tables, make the appropriate tables.
-        if len(available_tables) == 0:
-            sql = """
-                CREATE TABLE connection_info
-                (connection_name, connection_uuid, connection_status, connection_error, last_update);
-                
-                CREATE TABLE sync_info
-                (sync_time, last_update);
-
-                CREATE TABLE agent_errors
-                (error, status, last_update);
-
-                CREATE TABLE agent_commands
-                (command, last_update);
-
-                CREATE TABLE table_sync_info
-                (table_uuid, last_update, in_progress, heartbeat, checked_for_deleted_rows);
-
-                INSERT INTO sync_info (sync_time, last_update)
-                VALUES (0, CURRENT_TIMESTAMP);
-
-                INSERT INTO agent_errors (error, status, last_update)
-                VALUES ('authentication', 'Not Authenticated', CURRENT_TIMESTAMP);
-                INSERT INTO agent_errors (error, status, last_update)
-                VALUES ('agent_connection', 'Not Connected', CURRENT_TIMESTAMP);
-                INSERT INTO agent_errors (error, status, last_update)
-                VALUES ('agent_failure', 'Failed', CURRENT_TIMESTAMP);
-
-                INSERT INTO agent_commands (command, last_update)
-                VALUES ('continue', CURRENT_TIMESTAMP);
-                """
-            c.executescript(sql)
-            conn.commit()
-
         if sql_to_run is not None:
             # Return selected values
             if return_values:
@@ -77,6 +61,76 @@ def create_connection(db_file, sql_to_run=None, return_values=False):
             conn.close()
 
 
+def setup_database(db_file="sync_info.db"):
+    """
+    Creates the tables, and the ones and columns newer versions added, once
+    per process. The processes started together can all get here at once,
+    so it's done in a transaction that holds the database's write lock.
+    """
+    with _set_up_lock:
+        if db_file in _set_up:
+            return
+        # autocommit, so the transaction is only the one begun here
+        conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE;")
+            try:
+                # Gets all tables
+                c.execute("SELECT name FROM sqlite_master WHERE type='table';")
+                # If there aren't any tables, make the appropriate tables.
+                if len(c.fetchall()) == 0:
+                    create_tables(c)
+                add_missing_columns(c)
+                add_missing_tables(c)
+                c.execute("COMMIT;")
+            except BaseException:
+                c.execute("ROLLBACK;")
+                raise
+        finally:
+            conn.close()
+        _set_up.add(db_file)
+
+
+def create_tables(c):
+    """Makes the tables of the first release"""
+    for sql in (
+        """CREATE TABLE connection_info
+        (connection_name, connection_uuid, connection_status, connection_error, last_update);""",
+        "CREATE TABLE sync_info (sync_time, last_update);",
+        "CREATE TABLE agent_errors (error, status, last_update);",
+        "CREATE TABLE agent_commands (command, last_update);",
+        """CREATE TABLE table_sync_info
+        (table_uuid, last_update, in_progress, heartbeat, checked_for_deleted_rows);""",
+        """INSERT INTO sync_info (sync_time, last_update)
+        VALUES (0, CURRENT_TIMESTAMP);""",
+        """INSERT INTO agent_errors (error, status, last_update)
+        VALUES ('authentication', 'Not Authenticated', CURRENT_TIMESTAMP);""",
+        """INSERT INTO agent_errors (error, status, last_update)
+        VALUES ('agent_connection', 'Not Connected', CURRENT_TIMESTAMP);""",
+        """INSERT INTO agent_errors (error, status, last_update)
+        VALUES ('agent_failure', 'Failed', CURRENT_TIMESTAMP);""",
+        """INSERT INTO agent_commands (command, last_update)
+        VALUES ('continue', CURRENT_TIMESTAMP);""",
+    ):
+        c.execute(sql)
+
+
+def add_missing_columns(c):
+    """Adds columns from newer versions of the sync agent to table_sync_info"""
+    c.execute("PRAGMA table_info(table_sync_info);")
+    existing_columns = [row[1] for row in c.fetchall()]
+    for column in TABLE_SYNC_INFO_COLUMNS:
+        if column not in existing_columns:
+            c.execute(f"ALTER TABLE table_sync_info ADD COLUMN {column};")
+
+
+def add_missing_tables(c):
+    """Adds tables from newer versions of the sync agent"""
+    for table, columns in NEW_TABLES.items():
+        c.execute(f"CREATE TABLE IF NOT EXISTS {table} {columns};")
+
+
 def generate_connection_info_insert(
     connection_uuid, connection_name, connection_status, connection_error
 ):
@@ -166,9 +220,183 @@ def get_table_sync_info(table_uuid) -> pd.DataFrame:
 
 
 def reset_big_table_last_sync_time(table_uuid):
+    """Lets a new worker start right away, from the beginning of the table"""
+    create_connection(
+        "sync_info.db",
+        f"""
+        update table_sync_info set last_update=0, crawl_checkpoint=NULL where table_uuid='{table_uuid}';
+        delete from key_checksums where table_uuid='{table_uuid}';
+        """,
+    )
+
+
+def set_crawl_checkpoint(table_uuid, checkpoint):
+    """Stores the last acknowledged page of each range of a big table's initial load"""
+    checkpoint = json.dumps(checkpoint).replace("'", "''")
+    create_connection(
+        "sync_info.db",
+        f"""update table_sync_info set crawl_checkpoint='{checkpoint}' where table_uuid='{table_uuid}';""",
+    )
+
+
+def get_crawl_checkpoint(table_uuid) -> dict | None:
+    """Returns the checkpoint an interrupted initial load can resume from"""
+    res = get_table_sync_info(table_uuid)
+    if res is None or res.empty or not res.loc[0, "crawl_checkpoint"]:
+        return None
+    return json.loads(res.loc[0, "crawl_checkpoint"])
+
+
+def clear_crawl_checkpoint(table_uuid):
+    create_connection(
+        "sync_info.db",
+        f"""update table_sync_info set crawl_checkpoint=NULL where table_uuid='{table_uuid}';""",
+    )
+
+
+def set_replication_lsn(table_uuid, lsn):
+    """Stores how far the server has been sent a table's replication slot, None to forget it"""
+    value = "NULL" if lsn is None else f"'{lsn}'"
+    create_connection(
+        "sync_info.db",
+        f"""update table_sync_info set replication_lsn={value} where table_uuid='{table_uuid}';""",
+    )
+
+
+def get_replication_lsn(table_uuid) -> str | None:
+    res = get_table_sync_info(table_uuid)
+    if res is None or res.empty or not res.loc[0, "replication_lsn"]:
+        return None
+    return res.loc[0, "replication_lsn"]
+
+
+def set_crawler_cursor(table_uuid, cursor):
+    """
+    Stores where crawling a table's old rows has been sent up to, for
+    servers that don't send crawler_cursor back. None forgets it.
+    """
+    value = (
+        "NULL" if cursor is None else "'" + json.dumps(cursor).replace("'", "''") + "'"
+    )
     create_connection(
         "sync_info.db",
-        f"""update table_sync_info set last_update=0 where table_uuid='{table_uuid}';""",
+        f"""update table_sync_info set crawler_cursor={value} where table_uuid='{table_uuid}';""",
+    )
+
+
+def get_crawler_cursor(table_uuid) -> dict | None:
+    res = get_table_sync_info(table_uuid)
+    if res is None or res.empty or not res.loc[0, "crawler_cursor"]:
+        return None
+    return json.loads(res.loc[0, "crawler_cursor"])
+
+
+def add_replication_slot(table_uuid, source_uuid):
+    """Records that a table has a replication slot, so it's dropped when it isn't needed"""
+    create_connection(
+        "sync_info.db",
+        f"""insert or replace into replication_slots (table_uuid, source_uuid)
+        values ('{table_uuid}', '{source_uuid}');""",
+    )
+
+
+def remove_replication_slot(table_uuid):
+    create_connection(
+        "sync_info.db",
+        f"""delete from replication_slots where table_uuid='{table_uuid}';""",
+    )
+
+
+def get_replication_slots() -> pd.DataFrame:
+    """Returns the table_uuid and source_uuid of every table with a replication slot"""
+    return create_connection(
+        "sync_info.db", "select * from replication_slots;", return_values=True
+    )
+
+
+def set_stage_timings(table_uuid, stage_timings):
+    """Stores how long each stage of a big table's last load took"""
+    timings = json.dumps(stage_timings).replace("'", "''")
+    create_connection(
+        "sync_info.db",
+        f"""update table_sync_info set stage_timings='{timings}' where table_uuid='{table_uuid}';""",
+    )
+
+
+def set_page_size(table_uuid, page_size):
+    """Stores the number of rows per page a big table's initial load settled on"""
+    create_connection(
+        "sync_info.db",
+        f"""update table_sync_info set page_size={int(page_size)} where table_uuid='{table_uuid}';""",
+    )
+
+
+def get_page_size(table_uuid) -> int | None:
+    res = get_table_sync_info(table_uuid)
+    if res is None or res.empty or pd.isnull(res.loc[0, "page_size"]):
+        return None
+    return int(res.loc[0, "page_size"])
+
+
+def get_key_checksums(table_uuid) -> pd.DataFrame:
+    """Returns the primary key checksums stored by the last deleted rows check"""
+    return create_connection(
+        "sync_info.db",
+        f"""select bucket_width, bucket, row_count, checksum from key_checksums where table_uuid='{table_uuid}'""",
+        return_values=True,
+    )
+
+
+def set_key_checksums(table_uuid, checksums):
+    """Replaces a table's primary key checksums with a list of (bucket_width, bucket, row_count, checksum)"""
+    sql = f"delete from key_checksums where table_uuid='{table_uuid}';"
+    for start in range(0, len(checksums), 500):
+        values = ", ".join(
+            f"('{table_uuid}', {bucket_width}, {bucket}, {row_count}, '{checksum}')"
+            for bucket_width, bucket, row_count, checksum in checksums[
+                start : start + 500
+            ]
+        )
+        sql += f"insert into key_checksums (table_uuid, bucket_width, bucket, row_count, checksum) values {values};"
+    create_connection("sync_info.db", f"begin; {sql} commit;")
+
+
+def add_websocket_bytes(counts):
+    """Adds {message_type: (frames, payload_bytes, wire_bytes)} to the totals sent"""
+    sql = "".join(
+        f"""insert into websocket_bytes (message_type, frames, payload_bytes, wire_bytes)
+        values ('{message_type}', {frames}, {payload_bytes}, {wire_bytes})
+        on conflict (message_type) do update set
+        frames = frames + excluded.frames,
+        payload_bytes = payload_bytes + excluded.payload_bytes,
+        wire_bytes = wire_bytes + excluded.wire_bytes;"""
+        for message_type, (frames, payload_bytes, wire_bytes) in counts.items()
+    )
+    if sql:
+        create_connection("sync_info.db", f"begin; {sql} commit;")
+
+
+def get_websocket_bytes() -> pd.DataFrame:
+    return create_connection(
+        "sync_info.db", "select * from websocket_bytes;", return_values=True
+    )
+
+
+def set_source_queues(depths):
+    """Replaces the queue depths with {source_uuid: (queued, running, max_parallel_queries)}"""
+    sql = "".join(
+        f"""insert or replace into source_queues (source_uuid, queued, running, max_parallel_queries, last_update)
+        values ('{source_uuid}', {queued}, {running}, {limit}, {time.time()});"""
+        for source_uuid, (queued, running, limit) in depths.items()
+    )
+    create_connection(
+        "sync_info.db", f"begin; delete from source_queues; {sql} commit;"
+    )
+
+
+def get_source_queues() -> pd.DataFrame:
+    return create_connection(
+        "sync_info.db", "select * from source_queues;", return_values=True
     )
 
 
@@ -5,33 +5,79 @@ import concurrent.futures
 import json
 import os
 import random
-import sys
 import time
-from multiprocessing import Manager, Process
+from multiprocessing import Manager, Process, RawArray
 from multiprocessing import Queue as MPQueue
-from threading import Thread
+from threading import Lock, Thread
 from typing import Any, Dict, Optional
 
 import pandas as pd
 import psutil
-import requests
+import pyarrow as pa
 from Crypto.Cipher import AES, DES3, Blowfish  # bandit: disable=B110
 from pbkdf2 import PBKDF2
 from websockets.client import WebSocketClientProtocol, connect
 
+import big_table_checksums
+import ingest
+import json_codec
 import sqliteDB_setup
-from functions import TableAlreadyProcessingData, df_to_dict, log, log_error
+import sync_plan
+import sync_shards
+import ws_compression
+import ws_messages
+from big_table_crawl import (
+    PageSizer,
+    crawl_range,
+    plan_initial_load_ranges,
+    restore_value,
+)
+from big_table_pipeline import PagePipeline
+from big_table_workers import BigTableWorkerPool, picklable_source, worker_source
+from data_integrations import read_engine
+from functions import (
+    TableAlreadyProcessingData,
+    df_to_dict,
+    json_safe_value,
+    log,
+    log_error,
+)
 from integration_mapping import integration_map
+from source_executors import SourceExecutors
+from sync_scheduler import SyncScheduler
 
 
 def manage_sync_agent():
     """stuff"""
+    # before the processes that use it start
+    sqliteDB_setup.setup_database()
     ping_queue = MPQueue()
     timeout = 120
 
+    # sync worker processes, each watched on its own
+    shards = sync_worker_options()
+    workers: dict[int, Process] = {}
+    heartbeats = RawArray("d", shards["workers"]) if shards else None
+
+    def start_agent():
+        p = Process(target=sync_agent_class, args=(ping_queue, shards))
+        p.start()
+        return p
+
+    def start_worker(index):
+        heartbeats[index] = time.time()
+        worker = Process(
+            target=sync_shards.run_worker,
+            args=(index, shards["address"], shards["authkey"], heartbeats, SHARD_OPS),
+        )
+        worker.start()
+        return worker
+
     last_ping = time.time()
-    p = Process(target=sync_agent_class, args=(ping_queue,))
-    p.start()
+    p = start_agent()
+    if shards:
+        for index in range(shards["workers"]):
+            workers[index] = start_worker(index)
 
     while True:
         try:
@@ -43,16 +89,23 @@ def manage_sync_agent():
                 else:
                     log("timed out")
                     kill(p)
-                    p = Process(target=sync_agent_class, args=(ping_queue,))
-                    p.start()
+                    p = start_agent()
                     time.sleep(5)
                     last_ping = time.time()
             else:
                 log("The p was dead")
-                p = Process(target=sync_agent_class, args=(ping_queue,))
-                p.start()
+                p = start_agent()
                 time.sleep(5)
 
+            for index, worker in workers.items():
+                if not worker.is_alive():
+                    log(f"sync worker {index} was dead")
+                    workers[index] = start_worker(index)
+                elif time.time() - heartbeats[index] > timeout:
+                    log(f"sync worker {index} timed out")
+                    kill(worker)
+                    workers[index] = start_worker(index)
+
             # Command given from the config_server
             res = sqliteDB_setup.create_connection(
                 "sync_info.db", sqliteDB_setup.generate_select("agent_commands"), True
@@ -68,8 +121,10 @@ def manage_sync_agent():
                     "sync_info.db", sqliteDB_setup.update_command("continue")
                 )
                 kill(p)
-                p = Process(target=sync_agent_class, args=(ping_queue,))
-                p.start()
+                for index, worker in workers.items():
+                    kill(worker)
+                    workers[index] = start_worker(index)
+                p = start_agent()
                 time.sleep(5)
         except Exception as e:
             ping_queue = MPQueue()
@@ -78,6 +133,26 @@ def manage_sync_agent():
             time.sleep(5)
 
 
+def sync_worker_options() -> dict[str, Any] | None:
+    """
+    How many sync worker processes the config asks for with sync_workers and
+    where they reach the agent process, or None to sync in the agent process
+    """
+    try:
+        config = json.load(open("sync_agent_configs/sync_agent.json", encoding="utf-8"))
+        workers = int(config.get("sync_workers", 1))
+    except Exception as e:
+        log("failed to read sync_workers from the config: ", e)
+        return None
+    if workers <= 1:
+        return None
+    return {
+        "workers": workers,
+        "address": os.path.abspath("sync_workers.sock"),
+        "authkey": os.urandom(16),
+    }
+
+
 def kill(p: Process):
     try:
         pref = psutil.Process(p.pid)
@@ -97,7 +172,7 @@ def kill(p: Process):
 class sync_agent_class:
     """stuff"""
 
-    def __init__(self, ping_queue: MPQueue):
+    def __init__(self, ping_queue: MPQueue, shards: Optional[Dict[str, Any]] = None):
         self.ping_queue = ping_queue
         self.manager = Manager()
 
@@ -128,12 +203,45 @@ class sync_agent_class:
         self.uuid = config["uuid"]
 
         self.big_table_last_update_values = self.manager.dict()
+        # processes shared by every big table sync, 4 unless the config says otherwise
+        self.big_table_workers = BigTableWorkerPool(
+            run_big_table_job, config.get("big_table_workers", 4)
+        )
         self.data_sources: Dict[str, Any] = {}
         self.time_to_sleep = 20
         self.token: str
         self.token_dict: Dict[str, Any]
 
         self.websocket: Optional[WebSocketClientProtocol] = None
+        self.send_lock = asyncio.Lock()
+        # messages bigger than this are sent in parts, if it's set
+        self.websocket_part_size = config.get("websocket_part_size")
+        # bytes that can be waiting to be sent on a connection
+        self.websocket_send_buffer = config.get(
+            "websocket_send_buffer", 8 * 1024 * 1024
+        )
+        self.send_budget = ws_messages.SendBudget(self.websocket_send_buffer)
+        # permessage-deflate settings
+        self.websocket_options = ws_compression.connect_options(config)
+        json_codec.use_backend(config.get("json_backend", json_codec.backend))
+        # tables are synced less often the longer they go without changes
+        self.scheduler = SyncScheduler(
+            config.get("min_sync_interval", 60), config.get("max_sync_interval", 900)
+        )
+        # threads and a limit on parallel queries for each source
+        # with slots kept free for requests from the web app
+        self.source_executors = SourceExecutors(
+            config.get("max_parallel_queries", 4),
+            config.get("interactive_reserved", 1),
+            config.get("interactive_latency_target", 2),
+        )
+        # seconds a table sync gets before its queries time out and it's cancelled,
+        # under the 120 seconds manage_sync_agent waits for a ping
+        self.sync_timeout = config.get("sync_timeout", 90)
+        # how batch_pull transforms rows for tables that don't pick themselves
+        self.transform_engine = config.get("transform_engine", "pandas")
+        # worker processes that own the sources' connections, if there are any
+        self.shards = sync_shards.SyncShards(**shards) if shards else None
 
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
@@ -150,15 +258,90 @@ class sync_agent_class:
         self.loop.run_until_complete(tasks)
 
     async def send(self, message_type, message_body=None):
-        log("sending: ", message_type, f"message is {get_size_in_mb(message_body)} MB")
         message = {
             "token": self.token,
             "message_type": message_type,
             "message_body": message_body,
         }
-        message = json.dumps(message)
-        if self.websocket is not None:
-            await self.websocket.send(message)
+        # a json header frame, followed by any arrow payloads as binary frames
+        if json_codec.estimated_size(message) > json_codec.OFF_LOOP_BYTES:
+            # big messages are encoded in a thread, in slices so the loop keeps running
+            frames = await asyncio.get_running_loop().run_in_executor(
+                None, ws_messages.build_frames, message, True
+            )
+        else:
+            frames = ws_messages.build_frames(message)
+        return await self.send_encoded(message_type, frames)
+
+    async def send_encoded(self, message_type, frames):
+        """Sends a message that's already been turned into frames, returns whether it was"""
+        log("sending: ", message_type, f"message is {get_size_in_mb(frames):.3f} MB")
+        if self.websocket is None:
+            return False
+        # the compression extension counts the bytes it sends under this type
+        message_type_token = ws_compression.message_type.set(message_type)
+        try:
+            if (
+                self.websocket_part_size
+                and sum(len(frame) for frame in frames) > self.websocket_part_size
+            ):
+                # parts carry their message's sequence id so they can interleave
+                for part in ws_messages.message_parts(frames, self.websocket_part_size):
+                    await self.send_frames([part])
+            else:
+                await self.send_frames(frames)
+        finally:
+            ws_compression.message_type.reset(message_type_token)
+        return True
+
+    async def send_data_update(self, table_uuid, sending, progress):
+        """
+        Waits for a table's data_update to be sent, then records the crawler
+        cursor and replication slot position it got to, so neither is moved
+        past rows the server hasn't been sent
+        """
+        if not await sending:
+            return
+        sqliteDB_setup.set_crawler_cursor(table_uuid, progress["crawler_cursor"])
+        if progress["replication_lsn"] is not None:
+            sqliteDB_setup.set_replication_lsn(table_uuid, progress["replication_lsn"])
+
+    async def send_frames(self, frames):
+        """Sends frames back to back once the connection's send budget has room"""
+        send_budget = self.send_budget
+        reserved = await send_budget.acquire(sum(len(frame) for frame in frames))
+        try:
+            # keep another message's frames from landing between these
+            async with self.send_lock:
+                for frame in frames:
+                    await self.websocket.send(frame)
+                if not ws_compression.negotiated(self.websocket.extensions):
+                    size = sum(len(frame) for frame in frames)
+                    ws_compression.byte_counters.add(
+                        ws_compression.message_type.get(), len(frames), size, size
+                    )
+        finally:
+            await send_budget.release(reserved)
+
+    def record_websocket_bytes(self):
+        """Adds the bytes sent since the last call to the totals in sync_info.db"""
+        counts = ws_compression.byte_counters.take()
+        for message_type, (frames, payload_bytes, wire_bytes) in counts.items():
+            log(
+                f"sent {frames} {message_type} frames, {payload_bytes / 1048576:.2f} MB, ",
+                f"{wire_bytes / 1048576:.2f} MB after compression",
+            )
+        sqliteDB_setup.add_websocket_bytes(counts)
+
+    def record_source_queues(self):
+        """Writes how many table syncs each source has waiting and running to sync_info.db"""
+        depths = self.source_executors.depths()
+        for source_uuid, (queued, running, limit) in depths.items():
+            if queued > 0:
+                log(
+                    f"{source_uuid}: {queued} table syncs queued, {running} of {limit} running"
+                )
+        sqliteDB_setup.set_source_queues(depths)
 
     async def heartbeat(self):
         """Send a heartbeat to the server"""
@@ -170,16 +353,20 @@ class sync_agent_class:
     async def start_websocket(self):
         while True:
             try:
-                self.websocket = await connect(self.uri)
+                self.websocket = await connect(self.uri, **self.websocket_options)
                 self.websocket.close_timeout = 2
+                self.send_budget = ws_messages.SendBudget(self.websocket_send_buffer)
 
                 sqliteDB_setup.create_connection(
                     "sync_info.db",
                     sqliteDB_setup.update_auth_status("agent_connection", "Connected"),
                 )
                 # authenticate the websocket by requesting a token
-                auth_message = json.dumps({"agent_uuid": self.uuid, "key": self.key})
+                auth_message = json_codec.dumps(
+                    {"agent_uuid": self.uuid, "key": self.key}
+                )
 
+                ws_compression.message_type.set("auth")
                 await self.websocket.send(auth_message)
 
                 if await self.websocket.wait_closed():
@@ -200,7 +387,7 @@ class sync_agent_class:
         while True:
             try:
                 if self.websocket is not None and self.websocket.open:
-                    message = json.loads(await self.websocket.recv())
+                    message = json_codec.loads(await self.websocket.recv())
                     message_type = message["message_type"]
                     message_body = message["message_body"]
                     asyncio.ensure_future(
@@ -237,7 +424,7 @@ class sync_agent_class:
 
         elif message_type == "agent_info":
             try:
-                for key, value in json.loads(message_body).items():
+                for key, value in json_codec.loads(message_body).items():
                     self.data_sources[key] = value
                 # decrypt the database passwords
                 tasks = [
@@ -273,8 +460,10 @@ class sync_agent_class:
                 Response = None
                 error_message = ""
                 if message_type == "GET_TABLES_AND_VIEWS":
-                    Response = await self.loop.run_in_executor(
-                        None, self.get_tables_and_views, message_body["source_uuid"]
+                    Response = await self.run_interactive(
+                        message_body["source_uuid"],
+                        self.get_tables_and_views,
+                        message_body["source_uuid"],
                     )
 
                 elif message_type == "GET_TABLE_PREVIEW":
@@ -282,8 +471,8 @@ class sync_agent_class:
                     if "number_of_rows" in message_body:
                         number_of_rows = message_body["number_of_rows"]
                     table_preview = df_to_dict(
-                        await self.loop.run_in_executor(
-                            None,
+                        await self.run_interactive(
+                            message_body["source_uuid"],
                             self.get_table_preview,
                             message_body["source_uuid"],
                             message_body["table_name"],
@@ -300,12 +489,11 @@ class sync_agent_class:
                         integration_map[source["connection_type"]],
                         "get_table_requirements",
                     ):
-                        requirements = await self.loop.run_in_executor(
-                            None,
-                            integration_map[
-                                source["connection_type"]
-                            ].get_table_requirements,
-                            source,
+                        requirements = await self.run_interactive(
+                            message_body["source_uuid"],
+                            self.call_integration,
+                            message_body["source_uuid"],
+                            "get_table_requirements",
                             message_body["table_name"],
                         )
                         requirements = requirements.model_dump(by_alias=True)
@@ -319,8 +507,8 @@ class sync_agent_class:
 
                 elif message_type == "GET_TABLE_COLUMNS":
                     one_row_df = df_to_dict(
-                        await self.loop.run_in_executor(
-                            None,
+                        await self.run_interactive(
+                            message_body["source_uuid"],
                             self.get_table_preview,
                             message_body["source_uuid"],
                             message_body["table_name"],
@@ -335,6 +523,7 @@ class sync_agent_class:
                     table_object["sync_status"] = 1
                     table_object["crawler_step"] = 1
                     table_object["crawler_step_info"] = None
+                    table_object["crawler_cursor"] = None
                     table_object["primary_key_value"] = None
                     table_object["last_update_value"] = None
 
@@ -348,6 +537,13 @@ class sync_agent_class:
                     sqliteDB_setup.reset_big_table_last_sync_time(
                         message_body["pk_table_uuid"]
                     )
+                    await self.loop.run_in_executor(
+                        None,
+                        self.invalidate_plan,
+                        message_body["fk_source_uuid"],
+                        message_body["pk_table_uuid"],
+                    )
+                    self.scheduler.reset(message_body["pk_table_uuid"])
                     Response = True
                 elif message_type == "SAVE_DATA_SOURCE":
                     Response = {
@@ -420,7 +616,11 @@ class sync_agent_class:
                     ]["connected"]
 
                 elif message_type == "CHECK_SOURCE_STATUS":
-                    await self.refresh_conn(message_body["source_uuid"])
+                    await self.run_interactive(
+                        message_body["source_uuid"],
+                        self.refresh_conn_sync,
+                        message_body["source_uuid"],
+                    )
                     Response = {
                         "status": self.data_sources[message_body["source_uuid"]][
                             "connected"
@@ -431,15 +631,36 @@ class sync_agent_class:
                         "source_uuid": message_body["source_uuid"],
                     }
                 elif message_type == "DELETE_SOURCE":
+                    source = self.data_sources[message_body["source_uuid"]]
+                    slots = self.replication_slots().get(
+                        message_body["source_uuid"], set()
+                    ) | {
+                        table_uuid
+                        for table_uuid, table_object in source["tables"].items()
+                        if uses_change_capture(source, table_object)
+                    }
+                    # the source's connection is gone after this, so its slots go first
+                    for table_uuid in slots:
+                        await self.drop_replication_slot(
+                            message_body["source_uuid"], table_uuid
+                        )
                     del self.data_sources[message_body["source_uuid"]]
+                    self.source_executors.forget(message_body["source_uuid"])
                 elif message_type == "DELETE_TABLE":
-                    del self.data_sources[message_body["source_uuid"]]["tables"][
-                        message_body["table_uuid"]
-                    ]
+                    source = self.data_sources[message_body["source_uuid"]]
+                    if uses_change_capture(
+                        source, source["tables"][message_body["table_uuid"]]
+                    ):
+                        # the table stays until its slot is dropped, so a failed
+                        # drop is tried again when the table is deleted again
+                        await self.drop_replication_slot(
+                            message_body["source_uuid"], message_body["table_uuid"]
+                        )
+                    source["tables"].pop(message_body["table_uuid"])
 
                 elif message_type == "GET_COLUMN_VALUES_FROM_AGENT":
-                    df = await self.loop.run_in_executor(
-                        None,
+                    df = await self.run_interactive(
+                        message_body["source_uuid"],
                         self.get_table_preview,
                         message_body["source_uuid"],
                         message_body["table_name"],
@@ -466,8 +687,8 @@ class sync_agent_class:
                             for table in tables:
                                 try:
                                     table_preview = df_to_dict(
-                                        await self.loop.run_in_executor(
-                                            None,
+                                        await self.run_interactive(
+                                            source_uuid,
                                             self.get_table_preview,
                                             source_uuid,
                                             table,
@@ -501,6 +722,25 @@ class sync_agent_class:
                     },
                 )
 
+    def invalidate_plan(self, source_uuid, table_uuid):
+        sync_plan.invalidate(table_uuid)
+        if self.shards is not None:
+            try:
+                self.shards.call(source_uuid, "invalidate_plan", table_uuid)
+            except sync_shards.WorkerLost:
+                # a new worker process doesn't have any plans yet
+                pass
+
+    async def run_interactive(self, source_uuid, func, *args):
+        """Runs a request from the web app in the source's threads, ahead of table syncs"""
+        return await self.source_executors.run(
+            source_uuid,
+            self.data_sources.get(source_uuid, {}),
+            func,
+            *args,
+            interactive=True,
+        )
+
     async def set_datasource_creds(self, source_uuid):
         """
         Decrypts the encrypted key and sets the decrypted key in the data_sources dict
@@ -520,6 +760,15 @@ class sync_agent_class:
                 raise ValueError(self.data_sources[source_uuid]["error"])
             # reset the error message
             self.data_sources[source_uuid]["error"] = "No error message."
+            if self.shards is not None:
+                # the source's worker process holds its connections
+                self.data_sources[source_uuid]["connected"] = self.shards.call(
+                    source_uuid,
+                    "refresh_conn",
+                    source_uuid,
+                    picklable_source(self.data_sources[source_uuid]),
+                )
+                return
             # refresh conn
             integration_map[
                 self.data_sources[source_uuid]["connection_type"]
@@ -530,17 +779,84 @@ class sync_agent_class:
             log_error(e)
             log(f"failed to refresh connection for {source_uuid}")
 
+    def call_integration(self, source_uuid, function_name, *args):
+        """Calls an integration function with the source, in its worker process if it has one"""
+        source = self.data_sources[source_uuid]
+        if self.shards is not None:
+            return self.shards.call(
+                source_uuid,
+                "integration",
+                source_uuid,
+                picklable_source(source),
+                function_name,
+                *args,
+            )
+        return getattr(integration_map[source["connection_type"]], function_name)(
+            source, *args
+        )
+
+    def replication_slots(self) -> dict[str, set[str]]:
+        """{source uuid: uuids of its tables with a replication slot}"""
+        recorded = sqliteDB_setup.get_replication_slots()
+        slots: dict[str, set[str]] = {}
+        if recorded is not None:
+            for table_uuid, source_uuid in zip(
+                recorded["table_uuid"], recorded["source_uuid"]
+            ):
+                slots.setdefault(source_uuid, set()).add(table_uuid)
+        return slots
+
+    async def drop_replication_slot(self, source_uuid, table_uuid):
+        """Drops a table's replication slot, an abandoned one keeps the server from freeing its WAL"""
+        await self.run_interactive(
+            source_uuid,
+            self.call_integration,
+            source_uuid,
+            "drop_replication_slot",
+            table_uuid,
+        )
+        sqliteDB_setup.remove_replication_slot(table_uuid)
+
+    async def drop_abandoned_replication_slots(self):
+        """
+        Records the tables using change capture and drops the slots of the
+        ones that stopped, whether their change_capture was turned off or
+        they were replaced without a DELETE_TABLE. Drops that fail are tried
+        again on the next sync.
+        """
+        slots = self.replication_slots()
+        for source_uuid, source in self.data_sources.items():
+            for table_uuid, table_object in source["tables"].items():
+                if uses_change_capture(source, table_object) and table_uuid not in (
+                    slots.get(source_uuid, set())
+                ):
+                    sqliteDB_setup.add_replication_slot(table_uuid, source_uuid)
+        for source_uuid, table_uuids in slots.items():
+            source = self.data_sources.get(source_uuid)
+            if source is None:
+                continue
+            for table_uuid in table_uuids:
+                table_object = source["tables"].get(table_uuid)
+                if table_object is not None and uses_change_capture(
+                    source, table_object
+                ):
+                    continue
+                try:
+                    await self.drop_replication_slot(source_uuid, table_uuid)
+                except Exception as e:
+                    log(f"failed to drop the replication slot of {table_uuid}: ", e)
+
     def get_table_preview(self, source_uuid, table_name, number_of_rows):
         """this gets rows from a table for a preview"""
-        return integration_map[
-            self.data_sources[source_uuid]["connection_type"]
-        ].get_table_preview(self.data_sources[source_uuid], table_name, number_of_rows)
+        return self.call_integration(
+            source_uuid, "get_table_preview", table_name, number_of_rows
+        )
 
     def get_tables_and_views(self, source_uuid):
         try:
-            table_names, view_names = integration_map[
-                self.data_sources[source_uuid]["connection_type"]
-            ].get_tables_and_views(self.data_sources[source_uuid])
+            table_names, view_names = self.call_integration(
+                source_uuid, "get_tables_and_views"
+            )
 
             table_dict = {
                 "source_uuid": source_uuid,
@@ -562,6 +878,8 @@ class sync_agent_class:
                     # sending the agent_info request will trigger the sync
                     await self.send("agent_info")
                     await self.heartbeat()
+                    self.record_websocket_bytes()
+                    self.record_source_queues()
                     # make the loop happen every 60 seconds or if it took longer than 60 seconds just start it again
                     time_taken = time.time() - then
 
@@ -588,6 +906,7 @@ class sync_agent_class:
             )
             then = time.time()
             tasks = []
+            tables = {}
             if not self.token_dict["paused"]:
                 for source_uuid, data_source in self.data_sources.items():
                     try:
@@ -613,17 +932,11 @@ class sync_agent_class:
                             for table_uuid, table_object in data_source[
                                 "tables"
                             ].items():
-                                # add table to tasks
-                                tasks.append(
-                                    asyncio.create_task(
-                                        self.sync_table(
-                                            table_object,
-                                            data_source,
-                                            data_source["connection_type"],
-                                            source_uuid,
-                                            table_uuid,
-                                        )
-                                    )
+                                # the scheduler picks which of them are due
+                                tables[table_uuid] = (
+                                    table_object,
+                                    data_source,
+                                    source_uuid,
                                 )
                         except ConnectionError:
                             # If not connected try to reconnect
@@ -640,17 +953,11 @@ class sync_agent_class:
                                 for table_uuid, table_object in data_source[
                                     "tables"
                                 ].items():
-                                    # add table to tasks
-                                    tasks.append(
-                                        asyncio.create_task(
-                                            self.sync_table(
-                                                table_object,
-                                                data_source,
-                                                data_source["connection_type"],
-                                                source_uuid,
-                                                table_uuid,
-                                            )
-                                        )
+                                    # the scheduler picks which of them are due
+                                    tables[table_uuid] = (
+                                        table_object,
+                                        data_source,
+                                        source_uuid,
                                     )
                             else:
                                 # Creates the SQL to send to the local database that says the sync failed.
@@ -677,8 +984,42 @@ class sync_agent_class:
                             "sync_info.db", sql_to_run=connection_sql
                         )
 
+                await self.drop_abandoned_replication_slots()
+                due = self.scheduler.due_tables(set(tables))
+                log(f"syncing {len(due)} of {len(tables)} tables")
+                started = time.time()
+                last_deadline = started
+                for table_uuid in due:
+                    table_object, data_source, source_uuid = tables[table_uuid]
+                    deadline = started + (
+                        table_object.get("sync_timeout") or self.sync_timeout
+                    )
+                    last_deadline = max(last_deadline, deadline)
+                    tasks.append(
+                        asyncio.create_task(
+                            self.sync_table(
+                                table_object,
+                                data_source,
+                                data_source["connection_type"],
+                                source_uuid,
+                                table_uuid,
+                                deadline=deadline,
+                            )
+                        )
+                    )
+
                 if len(tasks) > 0:
-                    await asyncio.wait(tasks)
+                    # a few seconds past the deadlines for the statement timeouts to fire
+                    _, pending = await asyncio.wait(
+                        tasks, timeout=last_deadline - time.time() + 5
+                    )
+                    if pending:
+                        log(
+                            f"cancelling {len(pending)} table syncs past their deadline"
+                        )
+                        for task in pending:
+                            task.cancel()
+                        await asyncio.wait(pending)
             else:
                 log("customer paused, skipping sync")
             # ping the manager through the queue
@@ -705,24 +1046,29 @@ class sync_agent_class:
         source_uuid,
         table_uuid,
         run_datasets=True,
+        deadline=None,
     ):
+        # rows pulled by batch_pull, unknown for big tables and failed syncs
+        table_object.pop("rows_changed", None)
         try:
             # pull the data from the client db
             if "large_table" in table_object and table_object["large_table"]:
                 res = sqliteDB_setup.get_table_sync_info(table_uuid)
+                # None when the table hasn't been synced yet
+                untracked = res is None or res.empty
                 last_update = (
                     float(str(res.loc[0, "last_update"]))
-                    if not res.empty and res.loc[0, "last_update"] is not None
+                    if not untracked and res.loc[0, "last_update"] is not None
                     else 0
                 )
                 heartbeat = (
                     float(str(res.loc[0, "heartbeat"]))
-                    if not res.empty and res.loc[0, "heartbeat"] is not None
+                    if not untracked and res.loc[0, "heartbeat"] is not None
                     else 0
                 )
                 # check to make sure there isn't already a worker running on this table
                 # and that the right amount of time has passed since the last one ran
-                if res.empty or (
+                if untracked or (
                     time.time() - last_update > 60 * 15
                     and (
                         str(res.loc[0, "in_progress"]) != "true"
@@ -739,25 +1085,56 @@ class sync_agent_class:
                     #         self.data_sources[source_uuid]["tables"][table_uuid][
                     #             "last_update_value"
                     #         ] = self.big_table_last_update_values[table_uuid]
-                    # spawn a worker
-                    p = Process(
-                        target=start_big_table_sync,
-                        args=(
-                            table_object,
-                            source,
-                            conn_type,
-                            source_uuid,
-                            table_uuid,
-                            self.token,
-                            self.big_table_last_update_values,
-                        ),
+                    # queue it for a big table worker
+                    self.big_table_workers.submit(
+                        source_uuid,
+                        source,
+                        table_uuid,
+                        table_object,
+                        conn_type,
+                        self.token,
+                        self.big_table_last_update_values,
                     )
-                    p.start()
             else:
                 try:
-                    message = await self.loop.run_in_executor(
-                        None,
-                        batch_pull,
+                    table_object.setdefault("transform_engine", self.transform_engine)
+                    if self.shards is not None:
+                        # pulled and encoded in the source's worker process
+                        (
+                            frames,
+                            table_object["rows_changed"],
+                            progress,
+                        ) = await self.source_executors.run(
+                            source_uuid,
+                            source,
+                            self.shards.call,
+                            source_uuid,
+                            "batch_pull",
+                            deadline,
+                            self.token,
+                            self.uuid,
+                            table_object,
+                            table_uuid,
+                            source_uuid,
+                            picklable_source(source),
+                            conn_type,
+                            run_datasets,
+                        )
+                        sqliteDB_setup.set_table_sync_info(table_uuid)
+                        asyncio.ensure_future(
+                            self.send_data_update(
+                                table_uuid,
+                                self.send_encoded("data_update", frames),
+                                progress,
+                            ),
+                            loop=self.loop,
+                        )
+                        return
+                    message = await self.source_executors.run(
+                        source_uuid,
+                        source,
+                        batch_pull_before,
+                        deadline,
                         self.uuid,
                         table_object,
                         table_uuid,
@@ -767,14 +1144,24 @@ class sync_agent_class:
                     )
                     sqliteDB_setup.set_table_sync_info(table_uuid)
                     asyncio.ensure_future(
-                        self.send("data_update", message), loop=self.loop
+                        self.send_data_update(
+                            table_uuid,
+                            self.send("data_update", message),
+                            sent_progress(message),
+                        ),
+                        loop=self.loop,
                     )
 
                 except TableAlreadyProcessingData as e:
                     log(f"Table already processing data: {e}")
 
+        except asyncio.CancelledError:
+            log(f"sync of {table_uuid} was cancelled at its deadline")
+            raise
         except Exception as e:
             log_error(e)
+        finally:
+            self.scheduler.finished(table_uuid, table_object.get("rows_changed"))
 
 
 async def async_decrypt(dbkey, password, source_uuid, loop: asyncio.AbstractEventLoop):
@@ -789,6 +1176,27 @@ async def async_decrypt(dbkey, password, source_uuid, loop: asyncio.AbstractEven
         return password
 
 
+def run_big_table_job(
+    source_uuid,
+    source,
+    table_uuid,
+    table_object,
+    conn_type,
+    token,
+    big_table_last_update_values,
+):
+    """Runs a big table sync inside a BigTableWorkerPool process"""
+    start_big_table_sync(
+        table_object,
+        worker_source(source_uuid, source),
+        conn_type,
+        source_uuid,
+        table_uuid,
+        token,
+        big_table_last_update_values,
+    )
+
+
 def start_big_table_sync(
     table_object,
     source,
@@ -829,82 +1237,170 @@ def big_table_sync(
         url = "http://slave-driver:8001/slave-driver/data-ingest/"
     else:
         url = "https://api.resplendentdata.com/slave-driver/data-ingest/"
+    upload_options = {
+        # Stream payloads with chunked transfer encoding unless the table opts out
+        "stream": table_object.get("stream_uploads", True),
+        # gzip or zstd compress csv payloads, trading agent cpu for upload bandwidth
+        "compression": table_object.get("ingest_compression"),
+        "compression_level": table_object.get("ingest_compression_level"),
+        # only for servers that drop a payload sent again with the same key
+        "idempotency_keys": table_object.get("ingest_idempotency_keys", False),
+    }
+    # csv, or a columnar format (arrow or parquet) the server may fall back from
+    ingest_format = table_object.get("ingest_format", "csv")
+    sync_plan.plan_for(table_uuid, table_object, source, conn_type)
     log("doing big sync: ", table_object["sync_status"])
     if str(table_object["sync_status"]) == "1":
-        min_last_update = None
-        number_of_rows = 500000
-        for page in range(int(table_object["large_table_row_limit"] / number_of_rows)):
-            log("doing page: ", page)
-            table_object["crawler_step"] = page
-            times = {}
-            then = time.time()
-            df = integration_map[conn_type].get_old_rows(
-                table_object, {}, source, number_of_rows
+        checkpoint = sqliteDB_setup.get_crawl_checkpoint(table_uuid)
+        if checkpoint is not None:
+            # a previous worker was stopped part way through, carry on after
+            # the last pages the server acknowledged
+            ranges = checkpoint["ranges"]
+            ingest_format = checkpoint["ingest_format"]
+            metadata_sent = True
+            log(
+                "resuming initial load after ",
+                f"{sum(r['pages'] for r in ranges)} acknowledged pages",
             )
-            times["querying"] = time.time() - then
-
-            not_null_last_update = df[pd.notnull(df[table_object["last_update"]])][
-                table_object["last_update"]
-            ]
-            rows_pulled = len(df)
-            if page == 0:
-                last_pulled_update = not_null_last_update.max()
-                big_table_last_update_values[table_uuid] = last_pulled_update
-                df[0:0].to_feather(f"{table_uuid}.feather")
-                # send the columns and dtypes in a .feather file
-                with open(f"{table_uuid}.feather", "rb") as f:
-                    requests.post(
-                        url,
-                        f.read(),
-                        headers={
-                            "Auth": token,
-                            "Table-Uuid": table_uuid,
-                            "Message-Type": "table_metadata",
-                        },
-                        timeout=60,
-                    )
-                os.remove(f"{table_uuid}.feather")
-            else:
-                # get rid of duplicate values
-                if min_last_update is not None:
-                    df = df[df[table_object["last_update"]] < min_last_update]
-
-            min_last_update = not_null_last_update.min()
-
-            # # batches of 100,000 rows
-            # for i in range(int(number_of_rows/100000)):
-            then = time.time()
-
-            df.to_csv(f"{table_uuid}.csv", header=False, na_rep="\\N", index=False)
+        else:
+            # split the load into ranges that are crawled in parallel
+            ranges = plan_initial_load_ranges(
+                table_object, source, conn_type, source.get("initial_load_workers", 1)
+            )
+            metadata_sent = False
+        # the progress of the pages the server has received, by range
+        acknowledged_ranges = [dict(crawler_range) for crawler_range in ranges]
+        lock = Lock()
+        queue_depth = table_object.get("pipeline_depth", 2)
+        # size pages so every page that can be in the pipeline at once fits in
+        # the memory budget, starting from the size the last load settled on
+        page_sizer = PageSizer(
+            source.get("big_table_memory_mb", 1024),
+            len(ranges) + 2 * queue_depth + 3,
+            sqliteDB_setup.get_page_size(table_uuid) or 50000,
+        )
 
-            # Print the file size of the csv
-            file_size = os.path.getsize(f"{table_uuid}.csv")
-            log("file size: ", file_size)
+        def read_range(crawler_range):
+            nonlocal ingest_format, metadata_sent
+            # A whole table crawl stops at the row limit, ranges are already limited
+            row_limit = (
+                None
+                if crawler_range["column"]
+                else table_object["large_table_row_limit"]
+            )
+            for df in crawl_range(
+                table_object,
+                source,
+                conn_type,
+                crawler_range,
+                page_sizer.rows,
+                row_limit,
+                page_sizer,
+            ):
+                with lock:
+                    if (
+                        checkpoint is not None
+                        and table_uuid not in big_table_last_update_values
+                        and checkpoint["last_update_value"] is not None
+                    ):
+                        big_table_last_update_values[table_uuid] = restore_value(
+                            checkpoint["last_update_value"],
+                            df[table_object["last_update"]],
+                        )
+                    last_pulled_update = df[table_object["last_update"]].max()
+                    if pd.notnull(last_pulled_update) and (
+                        table_uuid not in big_table_last_update_values
+                        or last_pulled_update > big_table_last_update_values[table_uuid]
+                    ):
+                        big_table_last_update_values[table_uuid] = last_pulled_update
+                    if not metadata_sent:
+                        # send the columns and dtypes before any of the rows,
+                        # this also settles the format the pages are encoded in
+                        ingest_format = ingest.post_dataframe(
+                            url,
+                            df[0:0],
+                            headers={
+                                "Auth": token,
+                                "Table-Uuid": table_uuid,
+                                "Message-Type": "table_metadata",
+                            },
+                            ingest_format=ingest_format,
+                            **upload_options,
+                        )
+                        metadata_sent = True
+                yield {
+                    **crawler_range,
+                    "min_last_update": json_safe_value(
+                        df[table_object["last_update"]].min()
+                    ),
+                }, df
 
-            times["to_csv"] = time.time() - then
-            del df
+        page_headers = {
+            "Auth": token,
+            "Table-Uuid": table_uuid,
+            "Message-Type": "initial_table_data",
+        }
 
-            # send the full csv
-            then = time.time()
-            with open(f"{table_uuid}.csv", "rb") as f:
-                requests.post(
-                    url,
-                    f.read(),
-                    headers={
-                        "Auth": token,
-                        "Table-Uuid": table_uuid,
-                        "Message-Type": "initial_table_data",
+        def encode_page(page):
+            crawler_range, df = page
+            chunks, headers = ingest.dataframe_payload(df, page_headers, ingest_format)
+            # columnar pages keep their rows in case the server wants csv instead
+            if headers["Payload-Format"] not in ingest.COLUMNAR_FORMATS:
+                df = None
+            return crawler_range, df, list(chunks), headers
+
+        def upload_page(payload):
+            nonlocal ingest_format
+            crawler_range, df, chunks, headers = payload
+            response, bytes_sent = ingest.post_payload(
+                url, lambda: iter(chunks), headers, **upload_options
+            )
+            if response.status_code == 415 and df is not None:
+                log(
+                    f"server doesn't accept {headers['Payload-Format']} payloads,",
+                    "falling back to csv",
+                )
+                # pages encoded from here on are csv, and so is the checkpoint
+                ingest_format = "csv"
+                chunks, headers = ingest.dataframe_payload(df, page_headers, "csv")
+                chunks = list(chunks)
+                response, bytes_sent = ingest.post_payload(
+                    url, lambda: iter(chunks), headers, **upload_options
+                )
+            # only pages the server accepted are checkpointed
+            response.raise_for_status()
+            with lock:
+                acknowledged_ranges[crawler_range["index"]] = crawler_range
+                sqliteDB_setup.set_crawl_checkpoint(
+                    table_uuid,
+                    {
+                        "ranges": acknowledged_ranges,
+                        "ingest_format": ingest_format,
+                        "last_update_value": json_safe_value(
+                            big_table_last_update_values.get(table_uuid)
+                        ),
                     },
-                    timeout=60,
                 )
-            times["sending"] = time.time() - then
-            os.remove(f"{table_uuid}.csv")
-
-            log(json.dumps(times, indent=4))
-            if rows_pulled < number_of_rows:
-                log(f"only {rows_pulled} rows pulled stopping data import")
-                break
+            log(
+                f"sent range {crawler_range['index']} page {crawler_range['pages']}: ",
+                f"{bytes_sent} bytes",
+            )
 
+        if checkpoint is None:
+            big_table_last_update_values.pop(table_uuid, None)
+        stage_timings = PagePipeline(
+            [read_range(crawler_range) for crawler_range in ranges],
+            encode_page,
+            upload_page,
+            queue_depth=queue_depth,
+        ).run()
+        sqliteDB_setup.set_stage_timings(table_uuid, stage_timings)
+        sqliteDB_setup.set_page_size(table_uuid, page_sizer.rows)
+        log(f"settled on pages of {page_sizer.rows} rows")
+        log("stage timings: ", json.dumps(stage_timings, indent=4))
+
+        log(f"pulled {sum(r['rows'] for r in ranges)} rows, stopping data import")
+        sqliteDB_setup.clear_crawl_checkpoint(table_uuid)
         sqliteDB_setup.set_checked_for_deleted_rows(table_uuid)
 
     elif str(table_object["sync_status"]) == "3":
@@ -915,21 +1411,20 @@ def big_table_sync(
             big_table_last_update_values[table_uuid] = not_null_df[
                 table_object["last_update"]
             ].max()
-        df.to_csv(f"{table_uuid}.csv", header=False, na_rep="\\N", index=False)
-        with open(f"{table_uuid}.csv", "rb") as f:
-            requests.post(
-                url,
-                f.read(),
-                headers={
-                    "Auth": token,
-                    "Table-Uuid": table_uuid,
-                    "Message-Type": "update_table_data",
-                    "Primary-Key": table_object["primary_key"],
-                    "Columns": json.dumps(table_object["relevant_columns"]),
-                },
-                timeout=60,
-            )
-        os.remove(f"{table_uuid}.csv")
+        ingest_format = ingest.post_dataframe(
+            url,
+            df,
+            headers={
+                "Auth": token,
+                "Table-Uuid": table_uuid,
+                "Message-Type": "update_table_data",
+                "Primary-Key": table_object["primary_key"],
+                "Columns": json.dumps(table_object["relevant_columns"]),
+            },
+            ingest_format=ingest_format,
+            **upload_options,
+        )
+        del df
         last_del_check = sqliteDB_setup.get_table_sync_info(table_uuid).loc[
             0, "checked_for_deleted_rows"
         ]
@@ -939,14 +1434,14 @@ def big_table_sync(
             or last_del_check is None
             or time.time() - float(str(last_del_check)) > 60 * 60
         ):
-            df = integration_map[conn_type].get_primary_keys(
-                table_object, source, number_of_rows=5000000
-            )
-            df.to_feather(f"{table_uuid}.feather")
-            with open(f"{table_uuid}.feather", "rb") as f:
-                requests.post(
+
+            def send_newest_keys():
+                df = integration_map[conn_type].get_primary_keys(
+                    table_object, source, number_of_rows=5000000
+                )
+                ingest.post_dataframe(
                     url,
-                    f.read(),
+                    df,
                     headers={
                         "Auth": token,
                         "Table-Uuid": table_uuid,
@@ -954,14 +1449,109 @@ def big_table_sync(
                         "Primary-Key": table_object["primary_key"],
                         "Ordering-Key": table_object["last_update"],
                     },
-                    timeout=60,
+                    ingest_format=ingest_format,
+                    **upload_options,
+                )
+
+            def send_keys_in_ranges(df, key_ranges):
+                ingest.post_dataframe(
+                    url,
+                    df,
+                    headers={
+                        "Auth": token,
+                        "Table-Uuid": table_uuid,
+                        "Message-Type": "check_for_deleted_rows_in_ranges",
+                        "Primary-Key": table_object["primary_key"],
+                        "Key-Ranges": json.dumps(key_ranges),
+                    },
+                    ingest_format=ingest_format,
+                    **upload_options,
                 )
-            os.remove(f"{table_uuid}.feather")
+
+            # "checksums" only sends the keys of primary key ranges that changed
+            if table_object.get(
+                "deleted_rows_check", "keys"
+            ) == "checksums" and big_table_checksums.supports_checksums(conn_type):
+                big_table_checksums.check_for_deleted_rows(
+                    table_object,
+                    source,
+                    conn_type,
+                    table_uuid,
+                    send_keys_in_ranges,
+                    send_newest_keys,
+                )
+            else:
+                send_newest_keys()
             sqliteDB_setup.set_checked_for_deleted_rows(table_uuid)
 
     log("finished big pull")
 
 
+def batch_pull_before(deadline, *args):
+    """Runs batch_pull with its queries timing out at deadline"""
+    with read_engine.deadline(deadline):
+        return batch_pull(*args)
+
+
+def shard_refresh_conn(source_uuid, source):
+    """Connects a sync worker to a source again, returns whether it's connected"""
+    return worker_source(source_uuid, source, refresh=True).get("connected", False)
+
+
+def shard_integration_call(source_uuid, source, function_name, *args):
+    source = worker_source(source_uuid, source)
+    return getattr(integration_map[source["connection_type"]], function_name)(
+        source, *args
+    )
+
+
+def shard_batch_pull(
+    deadline,
+    token,
+    agent_uuid,
+    table_object,
+    table_uuid,
+    source_uuid,
+    source,
+    conn_type,
+    run_datasets,
+):
+    """
+    batch_pull in a sync worker. Returns the data_update message as frames,
+    ready to send, the rows it pulled and the progress to store once it's sent.
+    """
+    message = batch_pull_before(
+        deadline,
+        agent_uuid,
+        table_object,
+        table_uuid,
+        worker_source(source_uuid, source),
+        conn_type,
+        run_datasets,
+    )
+    frames = ws_messages.build_frames(
+        {"token": token, "message_type": "data_update", "message_body": message}
+    )
+    return frames, table_object.get("rows_changed"), sent_progress(message)
+
+
+def sent_progress(message):
+    """The crawler cursor and replication slot position a data_update message moves its table to"""
+    return {
+        "crawler_cursor": message.get("crawler_cursor"),
+        "replication_lsn": message.get("cdc_lsn"),
+    }
+
+
+# What the agent process can ask a sync worker to do
+SHARD_OPS = {
+    "refresh_conn": shard_refresh_conn,
+    "integration": shard_integration_call,
+    "batch_pull": shard_batch_pull,
+    "invalidate_plan": sync_plan.invalidate,
+}
+
+
 def batch_pull(
     agent_uuid: str,
     table_object: dict,
@@ -986,13 +1576,13 @@ def batch_pull(
         if not integration_map[client_db_type].has_row_updates:
             table_object["sync_status"] = 1
 
+        # the where clause and dtype overrides, compiled when the table config changes
+        plan = sync_plan.plan_for(table_uuid, table_object, source, client_db_type)
+
         # set local variables from the dataset_group dictionary
         primary_key = table_object["primary_key"]
         ordering_key = table_object["last_update"]
         last_pulled_update = table_object["last_update_value"]
-        last_pulled_pk = (
-            table_object["last_update_pk"] if "last_update_pk" in table_object else None
-        )
 
         sync_info = sqliteDB_setup.create_connection(
             "sync_info.db",
@@ -1007,6 +1597,14 @@ def batch_pull(
             batch_pull_size = table_object["batch_pull_size"]
         else:
             batch_pull_size = 10000
+        # send the rows as binary arrow frames instead of json strings
+        binary = table_object.get("message_format") == "arrow"
+        # pandas, or polars to convert datetime columns on every core at once
+        engine = table_object.get("transform_engine", "pandas")
+        # "logical" reads changes from a replication slot instead of polling
+        change_capture = table_object.get("change_capture") == "logical" and hasattr(
+            integration_map[client_db_type], "get_changes"
+        )
         # create message dictionary
         message = {
             "sync_status": table_object["sync_status"],
@@ -1015,6 +1613,7 @@ def batch_pull(
             "primary_key": primary_key,
             "crawler_step": table_object["crawler_step"],
             "crawler_step_info": table_object["crawler_step_info"],
+            "crawler_cursor": table_object.get("crawler_cursor"),
             "new_rows": {},
             "updated_rows": {},
             "deleted_rows_check": {},
@@ -1030,6 +1629,7 @@ def batch_pull(
         if table_object["sync_status"] == "3" or table_object["sync_status"] == 3:
             new_rows_df = pd.DataFrame()
             updated_rows = pd.DataFrame()
+            deleted_rows = pd.DataFrame()
 
             # code for pulling in old rows after the initial pull
             if (
@@ -1037,46 +1637,65 @@ def batch_pull(
                 and table_object["import_old_rows"]
                 and table_object["crawler_step_info"] != "completed"
             ):
+                if table_object.get("crawler_cursor") is None:
+                    # servers that don't send the cursor back leave it to the agent
+                    table_object["crawler_cursor"] = sqliteDB_setup.get_crawler_cursor(
+                        table_uuid
+                    )
+                    message["crawler_cursor"] = table_object["crawler_cursor"]
                 new_rows_df = integration_map[client_db_type].get_old_rows(
                     table_object, message, source, batch_pull_size
                 )
 
-                message["new_rows"] = df_to_dict(new_rows_df, table_object)
+                message["new_rows"] = df_to_dict(
+                    new_rows_df, table_object, binary, engine
+                )
 
             # code for pulling in new rows after the initial pull
-            if ordering_key is not None and last_pulled_update is not None:
+            if change_capture:
+                # inserts, updates and deletes from the table's replication slot
+                if integration_map[client_db_type].create_replication_slot(
+                    source, table_uuid
+                ):
+                    log(
+                        f"the replication slot for {table_uuid} was missing, ",
+                        "changes from before now weren't captured",
+                    )
+                    sqliteDB_setup.set_replication_lsn(table_uuid, None)
+                (
+                    updated_rows,
+                    deleted_rows,
+                    message["cdc_lsn"],
+                ) = integration_map[client_db_type].get_changes(
+                    table_object,
+                    source,
+                    table_uuid,
+                    sqliteDB_setup.get_replication_lsn(table_uuid),
+                    batch_pull_size,
+                    table_object.get("change_capture_batch_seconds", 60),
+                )
+                message["updated_rows"] = df_to_dict(
+                    updated_rows, table_object, binary, engine
+                )
+                message["deleted_rows"] = df_to_dict(deleted_rows, binary=binary)
+            elif ordering_key is not None and last_pulled_update is not None:
                 updated_rows = integration_map[client_db_type].get_updated_rows(
                     table_object, source
                 )
                 if not updated_rows.empty:
-                    if (
-                        primary_key in updated_rows.columns
-                        and last_pulled_pk is not None
-                    ):
-                        row_with_last_pulled_pk = updated_rows[
-                            updated_rows[primary_key] == last_pulled_pk
-                        ]
-                        if not row_with_last_pulled_pk.empty:
-                            last_pulled_update_iso = last_pulled_update.replace(
-                                " ", "T"
-                            )
-                            # Get the last update value of the row with the last pulled pk
-                            last_update_value = row_with_last_pulled_pk.iloc[0][
-                                ordering_key
-                            ]
-                            # The last update value will be a datetime object
-                            if "time" in str(type(last_update_value)).lower():
-                                last_update_value = last_update_value.isoformat()
-                            if last_pulled_update_iso == last_update_value:
-                                # Filter out any rows that are less than or equal to the last pulled update
-                                updated_rows = updated_rows[
-                                    updated_rows[ordering_key] > last_update_value
-                                ]
-
+                    # rows come ordered by (ordering key, primary key), so the
+                    # last one is where the next pull picks up from
+                    if primary_key in updated_rows.columns:
+                        message["last_update_pk"] = json_safe_value(
+                            updated_rows[primary_key].iloc[-1]
+                        )
                     # set the message variable for updated rows
-                    message["updated_rows"] = df_to_dict(updated_rows, table_object)
+                    message["updated_rows"] = df_to_dict(
+                        updated_rows, table_object, binary, engine
+                    )
 
-            # code for checking for deleted rows
+            # code for checking for deleted rows, kept up with change capture
+            # too since servers that don't know deleted_rows ignore it
             if table_object["check_for_deleted_rows_counter"] >= 10 and (
                 table_object["crawler_step_info"] == "completed"
                 or table_object["crawler_step_info"] is None
@@ -1084,51 +1703,40 @@ def batch_pull(
                 pk_df = integration_map[client_db_type].get_primary_keys(
                     table_object, source
                 )
-                message["deleted_rows_check"] = df_to_dict(pk_df)
+                message["deleted_rows_check"] = df_to_dict(pk_df, binary=binary)
                 message["check_for_deleted_rows_counter"] = 0
 
             else:
                 message["check_for_deleted_rows_counter"] += 1
 
+            # how soon the scheduler syncs the table again
+            table_object["rows_changed"] = (
+                len(new_rows_df) + len(updated_rows) + len(deleted_rows)
+            )
+
         # code for initial pull
         elif table_object["sync_status"] == "1" or table_object["sync_status"] == 1:
             log("doing a full pull!?", table_uuid)
 
+            if change_capture:
+                # the slot has to exist before the pull so no change falls between them
+                integration_map[client_db_type].create_replication_slot(
+                    source, table_uuid
+                )
+                sqliteDB_setup.set_replication_lsn(table_uuid, None)
+
+            # integrations that pull in the crawler's order set where it carries on
+            table_object["crawler_cursor"] = None
             new_rows_df = integration_map[client_db_type].initial_pull(
                 table_object, source, batch_pull_size
             )
+            message["crawler_cursor"] = table_object["crawler_cursor"]
 
             # set the message variable
-            message["new_rows"] = df_to_dict(new_rows_df, table_object)
+            message["new_rows"] = df_to_dict(new_rows_df, table_object, binary, engine)
+            table_object["rows_changed"] = len(new_rows_df)
 
-        if "force_dtypes" in table_object:
-            if message["new_rows"]:
-                for i, col in enumerate(message["new_rows"]["columns"]):
-                    if (
-                        col in table_object["force_dtypes"]
-                        and table_object["force_dtypes"][col] != "none"
-                    ):
-                        message["new_rows"]["dtypes"][i] = table_object["force_dtypes"][
-                            col
-                        ]
-            if message["updated_rows"]:
-                for i, col in enumerate(message["updated_rows"]["columns"]):
-                    if (
-                        col in table_object["force_dtypes"]
-                        and table_object["force_dtypes"][col] != "none"
-                    ):
-                        message["updated_rows"]["dtypes"][i] = table_object[
-                            "force_dtypes"
-                        ][col]
-            if message["deleted_rows_check"]:
-                for i, col in enumerate(message["deleted_rows_check"]["columns"]):
-                    if (
-                        col in table_object["force_dtypes"]
-                        and table_object["force_dtypes"][col] != "none"
-                    ):
-                        message["deleted_rows_check"]["dtypes"][i] = table_object[
-                            "force_dtypes"
-                        ][col]
+        plan.apply_dtype_overrides(message)
 
         return message
 
@@ -1143,7 +1751,13 @@ def batch_pull(
 
 def df_from_dict(df_dict):
     """convert dictionary from df_to_dict back to dataframe"""
-    df = pd.DataFrame(data=json.loads(df_dict["values"]), columns=df_dict["columns"])
+    if "arrow" in df_dict:
+        df = pa.ipc.open_stream(df_dict["arrow"]).read_pandas()
+        df.columns = df_dict["columns"]
+    else:
+        df = pd.DataFrame(
+            data=json_codec.loads(df_dict["values"]), columns=df_dict["columns"]
+        )
     for col_index, column in enumerate(df):
         if df_dict["dtypes"][col_index] == "timedelta64[ns]":
             df[column] = pd.to_timedelta(df[column])
@@ -1152,8 +1766,31 @@ def df_from_dict(df_dict):
     return df
 
 
+# Per source settings sent with the source and their defaults
+SOURCE_SETTINGS = {
+    # number of ranges a big table's initial load is split into and pulled in parallel
+    "initial_load_workers": 1,
+    # most big tables of the source that are synced at once
+    "big_table_workers": 2,
+    # memory a big table worker aims to stay under, in MB
+    "big_table_memory_mb": 1024,
+    # most queries run on the source at once by table syncs, None for the agent's setting
+    "max_parallel_queries": None,
+}
+
+
+def uses_change_capture(source, table_object) -> bool:
+    """Whether a table is synced from a replication slot"""
+    return table_object.get("change_capture") == "logical" and hasattr(
+        integration_map[source["connection_type"]], "drop_replication_slot"
+    )
+
+
 def format_creds(creds_row):
-    return integration_map[creds_row["engine_type"]].format_creds(creds_row)
+    source = integration_map[creds_row["engine_type"]].format_creds(creds_row)
+    for setting, default in SOURCE_SETTINGS.items():
+        source[setting] = creds_row.get(setting, default)
+    return source
 
 
 def decrypt_fast(s, key, salt, iters=2000) -> str:
@@ -1216,8 +1853,9 @@ def decrypt_fast(s, key, salt, iters=2000) -> str:
         raise e
 
 
-def get_size_in_mb(my_string):
-    bytes_size = sys.getsizeof(my_string)
+def get_size_in_mb(frames):
+    # the json is ascii, so its length is its size in bytes
+    bytes_size = sum(len(frame) for frame in frames)
     mb_size = bytes_size / 1048576  # Convert bytes to MB
     return mb_size
 
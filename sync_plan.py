@@ -0,0 +1,121 @@
+"""
+Per table sync plans, compiled from a table's config and reused every sync.
+
+The server sends every table's config again with each agent_info, so a plan
+is kept by table uuid along with a fingerprint of the config it was
+compiled from, and only compiled again when the fingerprint changes or the
+table is updated with UPDATE_TABLE_INFO. Compiling runs the table's query
+filter through the integration's create_where_clause, which reads a
+preview of the table to tell numeric columns from text ones, so the
+preview is read once per config instead of on every query.
+
+batch_pull and big_table_sync put the plan on table_object["sync_plan"],
+where the integrations' create_where_clause picks it up.
+"""
+import hashlib
+import json
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Any
+
+from functions import log
+from integration_mapping import integration_map
+
+# The parts of a table object a plan is compiled from
+CONFIG_KEYS = (
+    "table_name",
+    "relevant_columns",
+    "primary_key",
+    "last_update",
+    "use_query_filter",
+    "query_filter",
+    "force_dtypes",
+)
+
+# Message fields holding dataframes whose dtypes can be overridden
+DTYPE_OVERRIDE_FIELDS = (
+    "new_rows",
+    "updated_rows",
+    "deleted_rows",
+    "deleted_rows_check",
+)
+
+
+@dataclass
+class SyncPlan:
+    fingerprint: str
+    # conditions of the table's query filter, without the leading where
+    where: str = ""
+    # column -> dtype the server should treat it as
+    dtype_overrides: dict[str, str] = field(default_factory=dict)
+
+    def where_clause(self, no_where: bool = False) -> str:
+        """The query filter like create_where_clause returns it"""
+        if self.where == "" or no_where:
+            return self.where
+        return f"where {self.where}"
+
+    def apply_dtype_overrides(self, message: dict[str, Any]):
+        """Replaces the dtypes of the dataframes in a batch_pull message with force_dtypes"""
+        if not self.dtype_overrides:
+            return
+        for message_field in DTYPE_OVERRIDE_FIELDS:
+            df_dict = message.get(message_field)
+            if not df_dict:
+                continue
+            for i, col in enumerate(df_dict["columns"]):
+                if col in self.dtype_overrides:
+                    df_dict["dtypes"][i] = self.dtype_overrides[col]
+
+
+_plans: dict[str, SyncPlan] = {}
+_plans_lock = Lock()
+
+
+def config_fingerprint(table_object: dict) -> str:
+    config = {key: table_object.get(key) for key in CONFIG_KEYS}
+    return hashlib.sha1(
+        json.dumps(config, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def compile_plan(table_object: dict, source: dict, conn_type: str) -> SyncPlan:
+    integration = integration_map[conn_type]
+    table_object.pop("sync_plan", None)
+    where = ""
+    if hasattr(integration, "create_where_clause"):
+        where = integration.create_where_clause(table_object, source, no_where=True)
+    return SyncPlan(
+        fingerprint=config_fingerprint(table_object),
+        where=where,
+        dtype_overrides={
+            col: dtype
+            for col, dtype in (table_object.get("force_dtypes") or {}).items()
+            if dtype != "none"
+        },
+    )
+
+
+def plan_for(
+    table_uuid: str, table_object: dict, source: dict, conn_type: str
+) -> SyncPlan:
+    """
+    Returns the table's plan, compiling it if its config changed, and puts
+    it on table_object["sync_plan"]
+    """
+    fingerprint = config_fingerprint(table_object)
+    with _plans_lock:
+        plan = _plans.get(table_uuid)
+    if plan is None or plan.fingerprint != fingerprint:
+        log(f"compiling the sync plan for {table_uuid}")
+        plan = compile_plan(table_object, source, conn_type)
+        with _plans_lock:
+            _plans[table_uuid] = plan
+    table_object["sync_plan"] = plan
+    return plan
+
+
+def invalidate(table_uuid: str):
+    """Drops a table's plan so it's compiled again on its next sync"""
+    with _plans_lock:
+        _plans.pop(table_uuid, None)
@@ -0,0 +1,84 @@
+"""
+Decides which tables are synced on each sync cycle.
+
+Every table has its own sync interval. A sync that finds changed rows
+brings it back down to min_interval, and each sync that finds nothing
+grows it, up to max_interval, so quiet tables are queried less and less
+often while busy ones are synced every cycle. Tables wait in a heap
+ordered by their next run time and the due ones are popped off it.
+
+Tables are only synced when agent_info arrives, since the server sends
+each table's new last update value with it and syncing a table again
+before then would pull the same rows. Intervals are effectively rounded
+up to whole agent_info cycles.
+"""
+import heapq
+import time
+from threading import Lock
+
+
+class SyncScheduler:
+    def __init__(
+        self, min_interval: float = 60, max_interval: float = 900, growth: float = 2
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.lock = Lock()
+        # (next run, table uuid), with entries for rescheduled tables left in
+        self.queue: list[tuple[float, str]] = []
+        # next run of each table waiting in the queue
+        self.next_runs: dict[str, float] = {}
+        self.intervals: dict[str, float] = {}
+        self.running: set[str] = set()
+
+    def due_tables(self, table_uuids: set[str], now: float | None = None) -> list[str]:
+        """
+        Pops the tables that are due, out of table_uuids. Tables that haven't
+        been seen before are due right away. Popped tables aren't due again
+        until finished is called for them.
+        """
+        # a cycle can come around a little early
+        now = (now or time.time()) + 1
+        with self.lock:
+            for table_uuid in table_uuids:
+                if table_uuid not in self.next_runs and table_uuid not in self.running:
+                    self.schedule(table_uuid, now)
+            due = []
+            while self.queue and self.queue[0][0] <= now:
+                next_run, table_uuid = heapq.heappop(self.queue)
+                if self.next_runs.get(table_uuid) != next_run:
+                    # it was rescheduled since this entry was pushed
+                    continue
+                del self.next_runs[table_uuid]
+                if table_uuid in table_uuids:
+                    due.append(table_uuid)
+                    self.running.add(table_uuid)
+            return due
+
+    def finished(self, table_uuid: str, rows_changed: int | None):
+        """
+        Schedules a table's next sync. rows_changed is the number of rows its
+        sync pulled, or None if that isn't known, which keeps its interval.
+        """
+        with self.lock:
+            self.running.discard(table_uuid)
+            interval = self.intervals.get(table_uuid, self.min_interval)
+            if rows_changed is not None:
+                if rows_changed > 0:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.growth, self.max_interval)
+            self.intervals[table_uuid] = interval
+            self.schedule(table_uuid, time.time() + interval)
+
+    def reset(self, table_uuid: str):
+        """Makes a table due right away at the shortest interval, like a new table"""
+        with self.lock:
+            self.intervals.pop(table_uuid, None)
+            if table_uuid not in self.running:
+                self.schedule(table_uuid, 0)
+
+    def schedule(self, table_uuid: str, next_run: float):
+        self.next_runs[table_uuid] = next_run
+        heapq.heappush(self.queue, (next_run, table_uuid))
@@ -0,0 +1,222 @@
+"""
+Sync worker processes that sources are sharded across.
+
+All of a small table's pandas work, pulling, converting and encoding its
+rows, holds the GIL, so in one process table syncs use about one core no
+matter how many threads run them. With sync_workers set above 1 every
+source belongs to one of that many worker processes, picked from a hash
+of its uuid. The worker keeps the source's connections and runs its
+queries, batch pulls and message encoding, and the agent process is left
+with the websocket, scheduling, and passing calls and encoded messages
+between the two.
+
+The agent process listens on a local socket and workers connect to it, so
+manage_sync_agent can start, watch and restart every worker on its own,
+and a restarted worker or agent just connects again. Calls a worker had
+running when its connection dropped fail with WorkerLost, and calls a
+worker doesn't answer within CALL_TIMEOUT fail with CallTimedOut.
+"""
+import concurrent.futures
+import itertools
+import os
+import pickle
+import threading
+import time
+import zlib
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable
+
+from functions import log
+
+# seconds a call waits for its worker to connect
+CONNECT_WAIT = 30
+# seconds a call waits for its worker's answer, longer than any sync's deadline
+CALL_TIMEOUT = 600
+
+
+class WorkerLost(ConnectionError):
+    pass
+
+
+class CallTimedOut(TimeoutError):
+    pass
+
+
+def shard_for(source_uuid: str, workers: int) -> int:
+    """The worker a source belongs to, the same in every process"""
+    return zlib.crc32(source_uuid.encode()) % workers
+
+
+class SyncShards:
+    """The agent process's end, which sends calls to the workers"""
+
+    def __init__(self, workers: int, address: str, authkey: bytes):
+        self.workers = workers
+        if os.path.exists(address):
+            # left over from an agent process that was killed
+            os.unlink(address)
+        self.listener = Listener(address, family="AF_UNIX", authkey=authkey)
+        self.lock = threading.Lock()
+        self.connected = threading.Condition(self.lock)
+        self.connections: dict[int, Connection] = {}
+        self.send_locks: dict[int, threading.Lock] = {}
+        # job id -> (the connection it was sent on, future)
+        self.pending: dict[int, tuple[Connection, concurrent.futures.Future]] = {}
+        self.job_ids = itertools.count()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+                _, index, pid = conn.recv()
+            except Exception as e:
+                log("a sync worker failed to connect: ", e)
+                continue
+            log(f"sync worker {index} connected from process {pid}")
+            with self.lock:
+                previous = self.connections.get(index)
+                self.connections[index] = conn
+                self.send_locks[index] = threading.Lock()
+                self.connected.notify_all()
+            if previous is not None:
+                previous.close()
+            threading.Thread(target=self.read, args=(index, conn), daemon=True).start()
+
+    def read(self, index: int, conn: Connection):
+        """Hands the worker's results to the calls waiting on them until it disconnects"""
+        while True:
+            try:
+                job_id, ok, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            except Exception as e:
+                # the stream can't be trusted after a message it can't read,
+                # the worker reconnects once it's closed
+                log(f"failed to read from sync worker {index}: ", e)
+                conn.close()
+                break
+            with self.lock:
+                _, future = self.pending.pop(job_id, (None, None))
+            if future is None:
+                continue
+            try:
+                value = pickle.loads(payload)
+            except Exception as e:
+                # like an exception whose __init__ takes other arguments
+                ok, value = False, Exception(f"the worker's result can't be read: {e}")
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        log(f"sync worker {index} disconnected")
+        with self.lock:
+            if self.connections.get(index) is conn:
+                del self.connections[index]
+            lost = [
+                job_id
+                for job_id, (job_conn, _) in self.pending.items()
+                if job_conn is conn
+            ]
+            futures = [self.pending.pop(job_id)[1] for job_id in lost]
+        for future in futures:
+            future.set_exception(WorkerLost(f"sync worker {index} was lost"))
+
+    def connection(self, index: int) -> tuple[Connection, threading.Lock]:
+        with self.lock:
+            if not self.connected.wait_for(
+                lambda: index in self.connections, timeout=CONNECT_WAIT
+            ):
+                raise WorkerLost(f"sync worker {index} isn't running")
+            return self.connections[index], self.send_locks[index]
+
+    def submit(self, source_uuid: str, op: str, *args) -> concurrent.futures.Future:
+        index = shard_for(source_uuid, self.workers)
+        conn, send_lock = self.connection(index)
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        job_id = next(self.job_ids)
+        with self.lock:
+            if self.connections.get(index) is not conn:
+                raise WorkerLost(f"sync worker {index} was lost")
+            self.pending[job_id] = (conn, future)
+        try:
+            with send_lock:
+                conn.send((job_id, op, args))
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(job_id, None)
+            raise WorkerLost(f"sync worker {index} was lost") from e
+        return future
+
+    def call(
+        self, source_uuid: str, op: str, *args, timeout: float | None = CALL_TIMEOUT
+    ) -> Any:
+        """Runs op in the source's worker and waits up to timeout seconds for what it returns"""
+        future = self.submit(source_uuid, op, *args)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                # a late answer is dropped
+                for job_id, (_, pending) in list(self.pending.items()):
+                    if pending is future:
+                        del self.pending[job_id]
+            raise CallTimedOut(
+                f"sync worker {shard_for(source_uuid, self.workers)} didn't answer "
+                f"{op} within {timeout} seconds"
+            ) from None
+
+
+def run_worker(
+    index: int,
+    address: str,
+    authkey: bytes,
+    heartbeats,
+    ops: dict[str, Callable],
+    max_threads: int = 64,
+):
+    """
+    A sync worker process. Connects to the agent process, again whenever
+    it's restarted, and runs the calls it sends in threads. heartbeats[index]
+    is kept at the time of the worker's last sign of life.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads)
+    while True:
+        heartbeats[index] = time.time()
+        try:
+            conn = Client(address, family="AF_UNIX", authkey=authkey)
+        except OSError:
+            # the agent process isn't listening yet
+            time.sleep(1)
+            continue
+        conn.send(("hello", index, os.getpid()))
+        send_lock = threading.Lock()
+
+        def run(job_id: int, op: str, args: tuple, conn=conn, send_lock=send_lock):
+            # pickled apart from the job id, so a result the agent process
+            # can't unpickle only fails its own call
+            try:
+                ok, value = True, ops[op](*args)
+            except Exception as e:
+                ok, value = False, e
+            try:
+                payload = pickle.dumps(value)
+            except Exception as e:
+                ok, payload = False, pickle.dumps(
+                    Exception(f"{op} can't be sent back: {e}")
+                )
+            try:
+                with send_lock:
+                    conn.send((job_id, ok, payload))
+            except OSError:
+                # the agent process went away, its calls went with it
+                pass
+
+        try:
+            while True:
+                heartbeats[index] = time.time()
+                if conn.poll(1):
+                    executor.submit(run, *conn.recv())
+        except (EOFError, OSError):
+            log(f"sync worker {index} lost the agent process, reconnecting")
+            conn.close()
@@ -0,0 +1,123 @@
+"""
+permessage-deflate for the slave-driver websocket, and counters of the bytes
+sent by message type.
+
+Messages smaller than the threshold are sent uncompressed, which RFC 7692
+allows for any message, so heartbeats and other small messages don't pay
+for deflate. Bigger ones are compressed at the configured zlib level.
+
+Every data frame sent is added to byte_counters under the message type in
+the message_type context variable, with its size before and after
+compression. sync_agent_class.send sets the variable around each send.
+"""
+import threading
+from contextvars import ContextVar
+from typing import Any
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+)
+from websockets.frames import CTRL_OPCODES, Frame, Opcode
+
+DEFAULT_THRESHOLD = 1024
+# level 1 compresses data_update messages about 8 to 1 at a third of the
+# time of zlib's default level, and compression runs on the event loop
+DEFAULT_LEVEL = 1
+
+message_type: ContextVar[str] = ContextVar("message_type", default="other")
+
+
+class ByteCounters:
+    """Frames, bytes before compression and bytes sent, by message type"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts: dict[str, list[int]] = {}
+
+    def add(self, message_type: str, frames: int, payload_bytes: int, wire_bytes: int):
+        with self.lock:
+            counts = self.counts.setdefault(message_type, [0, 0, 0])
+            counts[0] += frames
+            counts[1] += payload_bytes
+            counts[2] += wire_bytes
+
+    def take(self) -> dict[str, tuple[int, int, int]]:
+        """Returns the counts since the last take and starts again from zero"""
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return {key: tuple(values) for key, values in counts.items()}
+
+
+byte_counters = ByteCounters()
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """PerMessageDeflate that leaves messages under threshold bytes uncompressed"""
+
+    def __init__(self, *args, threshold: int = DEFAULT_THRESHOLD, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.compressing = True
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not Opcode.CONT:
+            # the first frame decides for the whole message
+            self.compressing = len(frame.data) >= self.threshold
+        encoded = super().encode(frame) if self.compressing else frame
+        byte_counters.add(
+            message_type.get(),
+            int(frame.opcode is not Opcode.CONT),
+            len(frame.data),
+            len(encoded.data),
+        )
+        return encoded
+
+
+class ThresholdDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, threshold: int = DEFAULT_THRESHOLD, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+            threshold=self.threshold,
+        )
+
+
+def connect_options(config: dict[str, Any]) -> dict[str, Any]:
+    """
+    Keyword arguments for websockets' connect from the agent config.
+    websocket_compression turns deflate off when it's false, and
+    websocket_compression_threshold and websocket_compression_level tune it.
+    """
+    if not config.get("websocket_compression", True):
+        return {"compression": None}
+    return {
+        "extensions": [
+            ThresholdDeflateFactory(
+                threshold=config.get(
+                    "websocket_compression_threshold", DEFAULT_THRESHOLD
+                ),
+                compress_settings={
+                    "level": config.get("websocket_compression_level", DEFAULT_LEVEL),
+                    "memLevel": 5,
+                },
+            )
+        ]
+    }
+
+
+def negotiated(extensions) -> bool:
+    """Whether a connection negotiated ThresholdPerMessageDeflate"""
+    return any(
+        isinstance(extension, ThresholdPerMessageDeflate) for extension in extensions
+    )
@@ -0,0 +1,172 @@
+"""
+Framing for messages sent over the slave-driver websocket.
+
+A message is normally one JSON text frame. When its body holds dataframes
+encoded by df_to_dict with binary=True, the Arrow payloads are taken out
+and sent as binary frames right after the JSON header frame. The header
+says how many binary frames follow, and each dataframe's place in the body
+holds the index of its frame instead of its values.
+
+Big messages can be sent in parts instead, as binary frames that each
+start with a 4 byte length and a JSON part header holding the message's
+sequence id, the part number and whether it's the final part. Joined in
+order, the parts hold every frame of the message with an 8 byte length in
+front of it. Parts of different messages can be interleaved.
+
+The JSON in every frame is encoded and parsed with json_codec.
+"""
+import asyncio
+import struct
+import uuid
+from typing import Any, Iterator
+
+import json_codec
+
+PART_HEADER_LENGTH = struct.Struct(">I")
+FRAME_LENGTH = struct.Struct(">Q")
+
+# Message body fields that can hold dataframes
+DATAFRAME_FIELDS = ("new_rows", "updated_rows", "deleted_rows", "deleted_rows_check")
+
+
+def build_frames(message: dict[str, Any], sliced: bool = False) -> list[str | bytes]:
+    """
+    Splits a message into a JSON header frame and its binary frames. With
+    sliced the header is encoded with json_codec.dumps_sliced, for messages
+    encoded off the event loop.
+    """
+    body = message.get("message_body")
+    frames: list[bytes] = []
+    if isinstance(body, dict):
+        body = dict(body)
+        for field in DATAFRAME_FIELDS:
+            df_dict = body.get(field)
+            if isinstance(df_dict, dict) and "arrow" in df_dict:
+                body[field] = {
+                    **{key: value for key, value in df_dict.items() if key != "arrow"},
+                    "frame": len(frames),
+                }
+                frames.append(df_dict["arrow"])
+
+    header = {**message, "message_body": body}
+    if frames:
+        header["binary_frames"] = len(frames)
+    dumps = json_codec.dumps_sliced if sliced else json_codec.dumps
+    return [dumps(header), *frames]
+
+
+def read_frames(frames: list[str | bytes]) -> dict[str, Any]:
+    """Puts a message split by build_frames back together"""
+    message = json_codec.loads(frames[0])
+    binary_frames = frames[1:]
+    expected_frames = message.pop("binary_frames", 0)
+    if len(binary_frames) != expected_frames:
+        raise ValueError(
+            f"expected {expected_frames} binary frames, got {len(binary_frames)}"
+        )
+    body = message.get("message_body")
+    if isinstance(body, dict):
+        for field in DATAFRAME_FIELDS:
+            df_dict = body.get(field)
+            if isinstance(df_dict, dict) and "frame" in df_dict:
+                df_dict["arrow"] = binary_frames[df_dict.pop("frame")]
+    return message
+
+
+def encode_part(seq: str, part: int, final: bool, data: bytes) -> bytes:
+    header = json_codec.dumps({"seq": seq, "part": part, "final": final}).encode()
+    return PART_HEADER_LENGTH.pack(len(header)) + header + data
+
+
+def message_parts(frames: list[str | bytes], part_size: int) -> Iterator[bytes]:
+    """Splits the frames of a message into parts of at most part_size bytes of data"""
+    seq = uuid.uuid4().hex
+
+    def pieces():
+        for frame in frames:
+            data = frame.encode() if isinstance(frame, str) else frame
+            yield FRAME_LENGTH.pack(len(data))
+            yield from (
+                memoryview(data)[start : start + part_size]
+                for start in range(0, len(data), part_size)
+            )
+
+    part = 0
+    buffer = bytearray()
+    # one full part is held back so the last one can be marked final
+    pending = None
+    for piece in pieces():
+        while piece:
+            room = part_size - len(buffer)
+            buffer += piece[:room]
+            piece = piece[room:]
+            if len(buffer) == part_size:
+                if pending is not None:
+                    yield encode_part(seq, part, False, pending)
+                    part += 1
+                pending = bytes(buffer)
+                buffer.clear()
+    if buffer:
+        if pending is not None:
+            yield encode_part(seq, part, False, pending)
+            part += 1
+        pending = bytes(buffer)
+    yield encode_part(seq, part, True, pending or b"")
+
+
+class MessageAssembler:
+    """Puts messages sent with message_parts back together"""
+
+    def __init__(self):
+        self.parts: dict[str, dict[int, bytes]] = {}
+
+    def add(self, part: bytes) -> dict[str, Any] | None:
+        """Adds a part, returning the message once its final part is in"""
+        header_length = PART_HEADER_LENGTH.unpack_from(part)[0]
+        start = PART_HEADER_LENGTH.size
+        header = json_codec.loads(part[start : start + header_length])
+        parts = self.parts.setdefault(header["seq"], {})
+        parts[header["part"]] = part[start + header_length :]
+        if not header["final"]:
+            return None
+
+        del self.parts[header["seq"]]
+        if sorted(parts) != list(range(header["part"] + 1)):
+            raise ValueError(f"message {header['seq']} is missing parts")
+        stream = b"".join(parts[index] for index in range(header["part"] + 1))
+        frames: list[str | bytes] = []
+        offset = 0
+        while offset < len(stream):
+            length = FRAME_LENGTH.unpack_from(stream, offset)[0]
+            offset += FRAME_LENGTH.size
+            frames.append(stream[offset : offset + length])
+            offset += length
+        frames[0] = frames[0].decode()
+        return read_frames(frames)
+
+
+class SendBudget:
+    """
+    Bounds the bytes a connection has waiting to be sent. Senders reserve
+    the size of what they're about to send and wait while the budget is
+    used up. Anything bigger than the whole budget waits for it to be free.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        size = min(size, self.max_bytes)
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.reserved + size <= self.max_bytes
+            )
+            self.reserved += size
+        return size
+
+    async def release(self, size: int):
+        async with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()